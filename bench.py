@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# (can be run with either Python 2 or Python 3)
+
+# Benchmarks for jianpu-ly's hot paths, on synthetic scores.
+# Run:  python3 bench.py [options]
+#   --size=N        number of bars per movement (default 200)
+#   --movements=N   number of movements (default 4)
+#   --seed=N        random seed for the scores (default 1)
+#   --features=LIST comma-separated, from: lyrics hanzi chords
+#                   grace tuplets repeats withstaff angka
+#                   (default all of them)
+#   --repeat=N      timing runs per benchmark, best is kept (default 5)
+#   --only=LIST     comma-separated benchmark names
+#   --baseline=FILE JSON results to compare with (default
+#                   bench-baseline.json next to this script)
+#   --save          write the results to the baseline file
+#   --threshold=F   fail if throughput drops by more than this
+#                   fraction of the baseline (default 0.25)
+#   --mem-threshold=F  fail if peak memory grows by more than
+#                   this fraction of the baseline (default 0.10)
+# If the baseline file doesn't exist yet, it is written.  Baselines
+# are only comparable on the same machine with the same settings.
+
+import sys,os,time,json,random,gc
+try: import tracemalloc # Python 3.4+
+except ImportError: tracemalloc = None
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+jianpuly = __import__("jianpu-ly")
+get_option,unichr = jianpuly.get_option,jianpuly.unichr
+
+all_features = ["lyrics","hanzi","chords","grace","tuplets","repeats","withstaff","angka"]
+hanzi = u"\u4e00\u4e8c\u4e09\u56db\u4e94\u516d\u4e03\u516b\u4e5d\u5341\u6708\u5149\u660e\u5929\u5730\u6625\u98ce\u82b1"
+if not type("")==type(u""): hanzi = [c.encode('utf-8') for c in hanzi]
+
+class ScoreMaker(object):
+    # Writes random but valid jianpu text.  The same seed,
+    # size and features always give the same text.
+    def __init__(self,seed=1,bars=200,movements=4,features=all_features):
+        self.rng = random.Random(seed)
+        self.bars,self.movements = bars,movements
+        self.features = set(features)
+        self.notes = 0 # note, rest and dash words written
+    def pitch(self,angka):
+        r = self.rng
+        p = r.choice("1234567")
+        if not angka and r.random() < 0.05: p = r.choice("#b")+p
+        return p+r.choice(["","","'",","])
+    def note(self,beams,angka,dot=""):
+        # one note word, of beams (0, "q" or "s")
+        self.notes += 1
+        r = self.rng
+        if r.random() < 0.1: return beams+"0"+dot
+        if "chords" in self.features and r.random() < 0.08:
+            return beams+r.choice(["135","15","246","13"])+dot
+        n = beams+self.pitch(angka)+dot
+        if "grace" in self.features and r.random() < 0.04:
+            return "g[%s] %s" % (self.pitch(angka).replace(",",""),n)
+        return n
+    def beat(self,angka):
+        # one crotchet beat's worth of words
+        r,f = self.rng,self.features
+        x = r.random()
+        if "tuplets" in f and x < 0.05:
+            return "3[ "+" ".join(self.note("q",angka) for _ in range(3))+" ]"
+        if x < 0.35: return self.note("",angka)
+        if x < 0.65: return self.note("q",angka)+" "+self.note("q",angka)
+        if x < 0.8: return self.note("q",angka,".")+" "+self.note("s",angka)
+        return " ".join([self.note("s",angka),self.note("s",angka),self.note("q",angka)])
+    def bar(self,beats,angka):
+        r = [] ; i = 0
+        while i < beats:
+            if i < beats-1 and self.rng.random() < 0.15:
+                r.append(self.note("",angka)+" -")
+                self.notes += 1 ; i += 2
+            else:
+                r.append(self.beat(angka)) ; i += 1
+        return " ".join(r)
+    def movement(self,m):
+        r,f = self.rng,self.features
+        angka = "angka" in f and m%2==1
+        withStaff = "withstaff" in f and m%2==0
+        beats,time_sig = r.choice([(4,"4/4"),(3,"3/4"),(2,"2/4")])
+        lines = ["title=Movement %d" % (m+1)]
+        if angka: lines.append("angka")
+        if withStaff: lines.append("WithStaff")
+        lines.append(r.choice(["1=C","1=G","1=F","6=D","1=Bb"])+" "+time_sig+" 4=%d" % r.randint(60,140))
+        start = self.notes
+        music = [] ; b = 0
+        while b < self.bars:
+            if "repeats" in f and b+4 <= self.bars and r.random() < 0.1:
+                music.append("R{ %s %s } A{ %s | %s }" % tuple(self.bar(beats,angka) for _ in range(4)))
+                b += 4
+            else:
+                music.append(self.bar(beats,angka)) ; b += 1
+        for i in range(0,len(music),4): lines.append(" ".join(music[i:i+4]))
+        syllables = (self.notes-start)*3//4
+        if "lyrics" in f:
+            lines.append("L: "+" ".join(r.choice(["la","di","da","do-","re","mi"]) for _ in range(syllables)))
+        if "hanzi" in f:
+            lines.append("H: "+"".join(r.choice(hanzi) for _ in range(syllables)))
+        return "\n".join(lines)
+    def document(self):
+        return "\nNextScore\n".join(self.movement(m) for m in range(self.movements))
+
+def fullwidth(text):
+    # the ASCII in text as full-width characters (for fix_fullwidth)
+    return u"".join(unichr(ord(c)+0xfee0) if "!"<=c<="~" else c for c in jianpuly.asUnicode(text))
+
+def benchmarks(maker,text):
+    # name -> (units, number of units per call, function to time)
+    words = text.split()
+    notes = [w for w in words if jianpuly.classify(w)[0]=="note"]
+    first = text.split("\nNextScore\n")[0]
+    firstNotes = len([w for w in first.split() if jianpuly.classify(w)[0]=="note"])
+    # notehead_markup: whole bars of quavers in 4/4, so the
+    # timing state machine is always valid
+    calls = [jianpuly.parseNote("q"+f+o) for f in "1234567" for o in ["","'",","]]
+    calls = calls*8 # 21 bars
+    def process_input(): jianpuly.process_input(text)
+    def getLY(): jianpuly.Converter().getLY(first)
+    def notehead():
+        c = jianpuly.Converter() ; n = c.notehead_markup
+        for args in calls: n(*args)
+    # the jianpu staff of the first movement, parsed beforehand
+    converter = jianpuly.Converter() ; converter.scoreNo = converter.lineNo = 1
+    ir = converter.parse_score(first)
+    def jianpuEmitter():
+        converter.not_angka = False # (set by angka)
+        jianpuly.JianpuEmitter(converter)(ir)
+    def parseNote():
+        for w in notes: jianpuly.parseNote(w)
+    lines = [fullwidth(l) for l in text.split("\n")[:200]]
+    if not type("")==type(u""): lines = [l.encode('utf-8') for l in lines]
+    def fix_fullwidth():
+        for l in lines: jianpuly.fix_fullwidth(l)
+    graces = ["#45","1'2","5,,","b7","3216","1''","56,"]*20
+    def graceNotes():
+        for g in graces: jianpuly.graceNotes_markup(g,False)
+    return [("process_input","notes",maker.notes,process_input),
+            ("getLY","notes",firstNotes,getLY),
+            ("notehead_markup","notes",len(calls),notehead),
+            ("JianpuEmitter","notes",firstNotes,jianpuEmitter),
+            ("parseNote","words",len(notes),parseNote),
+            ("fix_fullwidth","chars",sum(len(l) for l in lines),fix_fullwidth),
+            ("graceNotes_markup","calls",len(graces),graceNotes)]
+
+def run(func,units,repeat):
+    # returns units per second (best of repeat) and peak bytes
+    # (small benchmarks are called several times per run, so
+    # each run is long enough for the timer)
+    loops = 1
+    while True:
+        t = time.time()
+        for _ in range(loops): func()
+        if time.time()-t >= 0.05: break
+        loops *= 2
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        t = time.time()
+        for _ in range(loops): func()
+        t = (time.time()-t)/loops
+        if best is None or t < best: best = t
+    peak = None
+    if tracemalloc:
+        gc.collect()
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return units/max(best,1e-9),peak
+
+def compare(results,baseline,threshold,memThreshold):
+    # returns a list of regressions
+    r = []
+    for name,res in sorted(results.items()):
+        old = baseline.get(name)
+        if not old: continue
+        if res["per_sec"] < old["per_sec"]*(1-threshold):
+            r.append("%s: %.0f %s/s, was %.0f (%.0f%% slower)" % (name,res["per_sec"],res["units"],old["per_sec"],100*(1-res["per_sec"]/old["per_sec"])))
+        if res["peak_bytes"] and old.get("peak_bytes") and res["peak_bytes"] > old["peak_bytes"]*(1+memThreshold):
+            r.append("%s: peak memory %d bytes, was %d (%.0f%% more)" % (name,res["peak_bytes"],old["peak_bytes"],100*(res["peak_bytes"]/float(old["peak_bytes"])-1)))
+    return r
+
+def main():
+    settings = {"size":int(get_option("--size",200)),
+                "movements":int(get_option("--movements",4)),
+                "seed":int(get_option("--seed",1)),
+                "features":sorted(get_option("--features",",".join(all_features)).split(","))}
+    for f in settings["features"]:
+        if f not in all_features: sys.exit("Unknown feature: "+f)
+    repeat = int(get_option("--repeat",5))
+    only = get_option("--only")
+    baselineFile = get_option("--baseline",os.path.join(os.path.dirname(os.path.abspath(__file__)),"bench-baseline.json"))
+    threshold = float(get_option("--threshold",0.25))
+    memThreshold = float(get_option("--mem-threshold",0.10))
+    save = "--save" in sys.argv
+    maker = ScoreMaker(settings["seed"],settings["size"],settings["movements"],settings["features"])
+    text = maker.document()
+    results = {}
+    for name,units,count,func in benchmarks(maker,text):
+        if only and name not in only.split(","): continue
+        per_sec,peak = run(func,count,repeat)
+        results[name] = {"units":units,"per_sec":per_sec,"peak_bytes":peak}
+        if peak is None: peakStr = ""
+        else: peakStr = "  peak %.1f MB" % (peak/1048576.0)
+        print ("%-18s %12.0f %s/s%s" % (name,per_sec,units,peakStr))
+    if os.path.exists(baselineFile) and not save:
+        baseline = json.load(open(baselineFile))
+        if not baseline.get("settings")==settings:
+            sys.exit("%s was made with different settings (%s), use --save to replace it" % (baselineFile,baseline.get("settings")))
+        regressions = compare(results,baseline["results"],threshold,memThreshold)
+        if regressions:
+            sys.stderr.write("Regressions against %s:\n" % baselineFile)
+            for r in regressions: sys.stderr.write("  "+r+"\n")
+            sys.exit(1)
+        print ("No regressions against "+baselineFile)
+    else:
+        json.dump({"settings":settings,"results":results},open(baselineFile,"w"),indent=1,sort_keys=True)
+        print ("Wrote "+baselineFile)
+
+if __name__=="__main__": main()
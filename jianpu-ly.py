@@ -67,151 +67,31 @@ Other Lilypond code: LP: (block of code) :LP (each delimeter at start of its lin
 Ignored: % a comment
 """
 
-import sys,os,re
-from fractions import Fraction as F # requires Python 2.6+
+import sys,os,re,itertools,time
+try: from math import gcd # Python 3.5+
+except ImportError: from fractions import gcd
 if type(u"")==type(""): # Python 3
     unichr,xrange = chr,range
     from string import ascii_letters as letters
 else: from string import letters # Python 2
+clock = getattr(time,"perf_counter",time.time) # for Profile
 def asUnicode(l):
     if type(l)==type(u""): return l
     return l.decode('utf-8')
 
-def all_scores_start(staff_size = 20):
-    # staff_size is the 5-line size in points; jianpu is smaller
-    r = r"""\version "2.18.0"
-#(set-global-staff-size %d)""" % staff_size
-    r += r"""
-
-% un-comment the next line to remove Lilypond tagline:
-% \header { tagline="" }
-
-\pointAndClickOff
-
-\paper {
-  print-all-headers = ##t %% allow per-score headers
-
-  % un-comment the next line for A5:
-  % #(set-default-paper-size "a5" )
-
-  % un-comment the next line for no page numbers:
-  % print-page-number = ##f
-
-  % un-comment the next 3 lines for a binding edge:
-  % two-sided = ##t
-  % inner-margin = 20\mm
-  % outer-margin = 10\mm
-
-  % un-comment the next line for a more space-saving header layout:
-  % scoreTitleMarkup = \markup { \center-column { \fill-line { \magnify #1.5 { \bold { \fromproperty #'header:dedication } } \magnify #1.5 { \bold { \fromproperty #'header:title } } \fromproperty #'header:composer } \fill-line { \fromproperty #'header:instrument \fromproperty #'header:subtitle \smaller{\fromproperty #'header:subsubtitle } } } }"""
-    if os.path.exists("/Library/Fonts/Arial Unicode.ttf"): r += r"""
-  % As jianpu-ly was run on a Mac, we include a Mac fonts workaround.
-  % The Mac version of Lilypond 2.18 used Arial Unicode MS as a
-  % fallback even in the Serif font, but 2.20 drops this in Serif
-  % (using it only in Sans), which means any Serif text (titles,
-  % lyrics etc) that includes Chinese will likely fall back to
-  % Japanese fonts which don't support all Simplified hanzi.
-  % This brings back 2.18's behaviour on 2.20+:
-  #(define fonts
-    (set-global-fonts
-     #:roman "Times New Roman,Arial Unicode MS"
-     #:factor (/ staff-height pt 20)
-    ))
-"""
-    if has_lyrics: r += r"""
-  % Might need to enforce a minimum spacing between systems, especially if lyrics are below the last staff in a system and numbers are on the top of the next
-  system-system-spacing = #'((basic-distance . 7) (padding . 5) (stretchability . 1e7))
-  score-markup-spacing = #'((basic-distance . 9) (padding . 5) (stretchability . 1e7))
-  score-system-spacing = #'((basic-distance . 9) (padding . 5) (stretchability . 1e7))
-  markup-system-spacing = #'((basic-distance . 2) (padding . 2) (stretchability . 0))
-"""
-    return r+"\n}\n"
-
-def score_start():
-    ret = "\\score {\n"
-    if midi: ret += "\\unfoldRepeats\n"
-    ret += r"<< "
-    if not notehead_markup.noBarNums and not midi: ret += ("\\override Score.BarNumber #'break-visibility = #center-visible\n\\override Score.BarNumber #'Y-offset = -1\n\\set Score.barNumberVisibility = #(every-nth-bar-number-visible %d)" % bar_number_every)
-    return ret
 bar_number_every = 5 # TODO customise?  (anyway don't leave it numbering at start of system, doesn't work well in jianpu+lyrics)
 
-def score_end(**headers):
-    ret = ">>\n"
-    if headers:
-        # since about Lilypond 2.7, music must come
-        # before the header block if it's per-score
-        ret += r"\header{"+'\n'
-        for k,v in headers.items(): ret+=k+'="'+v+'"\n'
-        ret += "}\n"
-    if midi: ret += r"\midi { \context { \Score tempoWholesPerMinute = #(ly:make-moment 84 4)}}" # will be overridden by any \tempo command used later
-    elif notehead_markup.noBarNums: ret += r'\layout { \context { \Score \remove "Bar_number_engraver" } }'
-    else: ret += r"\layout{}"
-    return ret + " }"
-
-tempCount = 0
-def jianpu_voice_start(voiceName="tmp"):
-    stemLenFrac = "0" # unless overridden to 0.5 below
-    if voiceName=="tmp": # make it unique just in case
-        global tempCount
-        voiceName += str(tempCount) ; tempCount += 1
-    elif maxBeams >= 2: stemLenFrac = "0.5" # sometimes needed if the semiquavers occur in isolation rather than in groups (TODO do we need to increase this for 3+ beams in some cases?)
-    r = (r"""\new Voice="%s" {"""%voiceName)+"\n"
-    r += r"""
-    \override Beam #'transparent = ##f % (needed for LilyPond 2.18 or the above switch will also hide beams)
-    """
-    if not_angka:
-        r +=r"""
-        \override Stem #'direction = #UP
-        \override Tie #'staff-position = #-2.5
-        \tupletDown"""
-        stemLenFrac=str(0.4+0.2*max(0,maxBeams-1))
-    else: r += r"""\override Stem #'direction = #DOWN
-    \override Tie #'staff-position = #2.5
-    \tupletUp"""+"\n"
-    r += (r"""
-    \override Stem #'length-fraction = #%s
-    \override Beam #'beam-thickness = #0.1
-    \override Beam #'length-fraction = #0.5
-    \override Voice.Rest #'style = #'neomensural %% this size tends to line up better (we'll override the appearance anyway)
-    \override Accidental #'font-size = #-4
-    \override TupletBracket #'bracket-visibility = ##t""" % stemLenFrac)
-    r += "\n"+r"""\set Voice.chordChanges = ##t %% 2.19 bug workaround""" # LilyPond 2.19.82: \applyOutput docs say "called for every layout object found in the context Context at the current time step" but 2.19.x breaks this by calling it for ALL contexts in the current time step, hence breaking our WithStaff by applying our jianpu numbers to the 5-line staff too.  Obvious workaround is to make our function check that the context it's called with matches our jianpu voice, but I'm not sure how to do this other than by setting a property that's not otherwise used, which we can test for in the function.  So I'm 'commandeering' the "chordChanges" property (there since at least 2.15 and used by Lilypond only when it's in chord mode, which we don't use, and if someone adds a chord-mode staff then it won't print noteheads anyway): we will substitute jianpu numbers for noteheads only if chordChanges = #t.
-    return r+"\n"
-def jianpu_staff_start(withStaff=False):
-    # (we add "BEGIN JIANPU STAFF" and "END JIANPU STAFF" comments to make it easier to copy/paste into other Lilypond files)
-    if not_angka: voiceName="notAngka"
-    else: voiceName="jianpu"
-    if not_angka: r=r"""
-%% === BEGIN NOT ANGKA STAFF ===
-    \new RhythmicStaff \with {"""
-    else: r=r"""
-%% === BEGIN JIANPU STAFF ===
-    \new RhythmicStaff \with {
-    \consists "Accidental_engraver" """
-    if withStaff: r+=r"""
-   %% Limit space between Jianpu and corresponding-Western staff
-   \override VerticalAxisGroup.staff-staff-spacing = #'((minimum-distance . 7) (basic-distance . 7) (stretchability . 0))
-""" # (whether this is needed or not depends on Lilypond version; 2.22 puts more space than 2.18,2.20.  Must set higher than 5, which sometimes gets collisions between beams in 2.20)
-    r+=r"""
-    %% Get rid of the stave but not the barlines:
-    \override StaffSymbol #'line-count = #0 %% tested in 2.15.40, 2.16.2, 2.18.0, 2.18.2, 2.20.0 and 2.22.2
-    \override BarLine #'bar-extent = #'(-2 . 2) %% LilyPond 2.18: please make barlines as high as the time signature even though we're on a RhythmicStaff (2.16 and 2.15 don't need this although its presence doesn't hurt; Issue 3685 seems to indicate they'll fix it post-2.18)
-    }
-    { """+jianpu_voice_start(voiceName)+r"""
-    \override Staff.TimeSignature #'style = #'numbered
-    \override Staff.Stem #'transparent = ##t
-    """
-    return r
-def jianpu_staff_end():
-     # \bar "|." is added separately if there's not a DC etc
-    if not_angka: return "} }\n% === END NOT ANGKA STAFF ===\n"
-    else: return "} }\n% === END JIANPU STAFF ===\n"
 def midi_staff_start(voiceName="midi"):
     return r"""
 %% === BEGIN MIDI STAFF ===
     \new Staff { \new Voice="%s" {""" % (voiceName,)
 def midi_staff_end(): return "} }\n% === END MIDI STAFF ===\n"
-def western_staff_start(voiceName="5line"):
+def western_staff_start(voiceName="5line",stylesheet=None):
+    if stylesheet: return r"""
+%% === BEGIN 5-LINE STAFF ===
+    \new Staff {
+    \new Voice="%s" { \westernVoice
+""" % (voiceName,)
     return r"""
 %% === BEGIN 5-LINE STAFF ===
     \new Staff {
@@ -221,25 +101,29 @@ def western_staff_start(voiceName="5line"):
     \override Staff.TimeSignature #'style = #'numbered
     \set Voice.chordChanges = ##f %% for 2.19.82 bug workaround
 """ % (voiceName,)
+withStaff_spacing = r"""
+   %% Limit space between Jianpu and corresponding-Western staff
+   \override VerticalAxisGroup.staff-staff-spacing = #'((minimum-distance . 7) (basic-distance . 7) (stretchability . 0))
+""" # (whether this is needed or not depends on Lilypond version; 2.22 puts more space than 2.18,2.20.  Must set higher than 5, which sometimes gets collisions between beams in 2.20)
+staffless_setup = r"""
+    %% Get rid of the stave but not the barlines:
+    \override StaffSymbol #'line-count = #0 %% tested in 2.15.40, 2.16.2, 2.18.0, 2.18.2, 2.20.0 and 2.22.2
+    \override BarLine #'bar-extent = #'(-2 . 2) %% LilyPond 2.18: please make barlines as high as the time signature even though we're on a RhythmicStaff (2.16 and 2.15 don't need this although its presence doesn't hurt; Issue 3685 seems to indicate they'll fix it post-2.18)"""
 def western_staff_end(): return "} }\n% === END 5-LINE STAFF ===\n"
 
-lyricsPtr = 0
-def lyrics_start(voiceName="jianpu"):
-    global lyricsPtr ; lyricsPtr += 1 # TODO: encapsulate
-    return r'\new Lyrics = "I%s" { \lyricsto "%s" { ' % (str(lyricsPtr).translate((letters*5)[:256]),voiceName)
 def lyrics_end(): return "} }"
 
 dashes_as_ties = True # Implement dash (-) continuations as invisible ties rather than rests; sometimes works better in awkward beaming situations
 use_rest_hack = True # Implement short rests as notes (and if there are lyrics, creates temporary voices so the lyrics miss them); sometimes works better for beaming (at least in 2.15, 2.16 and 2.18)
 if __name__=="__main__" and '--noRestHack' in sys.argv: # TODO: document
     use_rest_hack=False ; sys.argv.remove('--noRestHack')
+stencil_noteheads = False # Draw plain notes and rests with one NoteHead and Rest stencil override per staff, instead of an \applyOutput callback per note; much faster for LilyPond on long pieces
+if __name__=="__main__" and '--stencilNoteheads' in sys.argv:
+    stencil_noteheads=True ; sys.argv.remove('--stencilNoteheads')
 assert not (use_rest_hack and not dashes_as_ties), "This combination has not been tested"
 
-def errExit(msg):
-    if __name__=="__main__":
-        sys.stderr.write("Error: "+msg+"\n")
-        sys.exit(1)
-    else: raise Exception(msg)
+class JianpuError(Exception): pass # a problem with the input (main() reports it and exits)
+def errExit(msg): raise JianpuError(msg)
 
 placeholders = {
     # for accidentals and word-fitting to work
@@ -255,203 +139,186 @@ placeholders = {
     '7':'b',
     '-':'r'}
 
+figure_names = {'0':'nought',
+         '1':'one',
+         '2':'two',
+         '3':'three',
+         '4':'four',
+         '5':'five',
+         '6':'six',
+         '7':'seven',
+         '-':'dash'}
+
+class NoteIR(object):
+    # One note, rest or dash after the timing state machine has
+    # seen it.  The staff emitters only read these, so a score is
+    # parsed once however many staves are written from it.
+    __slots__ = ["figures", # lookup key for the notehead (see notehead_markup.__call__)
+                 "name", # Scheme name suffix for the notehead
+                 "chord", # figures the pitch comes from (previous note's if a tied dash)
+                 "nBeams","dot","octave","accidental",
+                 "length", # LilyPond duration number (4, 8, 16 ...)
+                 "ticks","scale", # exact duration: ticks, of which scale make a 64th note
+                 "barNo", # bar we're in
+                 "newBar", # first note of a bar other than bar 1
+                 "beatEnd", # note ends on a beat boundary
+                 "invisTie", # dash implemented as a tie to the previous note
+                 "accLeftBeams", # all figures differ from current accidentals
+                 "need_space_for_accidental",
+                 "onePage","withStaff"] # flags as they were at this note
+
 class notehead_markup:
-  def __init__(self):
-      self.defines_done = {} ; self.initOneScore()
+  # The timing state machine: bar position, beat boundaries,
+  # accidentals in force and dash continuations.  Markup for
+  # the staves is written later by the emitters.
+  # Times are integer ticks, self.scale to a 64th note.  When a
+  # note (e.g. in a tuplet) isn't a whole number of ticks, all
+  # the times are multiplied up (see ticks and rescale).
+  def __init__(self,converter):
+      self.converter = converter # for scoreNo and options
+      self.initOneScore()
   def initOneScore(self):
-      self.barLength = 64 ; self.beatLength = 16 # in 64th notes
-      self.barPos = self.startBarPos = F(0)
-      self.inBeamGroup = self.lastNBeams = self.onePage = self.noBarNums = self.separateTimesig = self.withStaff = 0
+      self.scale = 1
+      self.barLength = 64 ; self.beatLength = 16
+      self.barPos = self.startBarPos = 0
+      self.onePage = self.noBarNums = self.separateTimesig = self.withStaff = self.notAngka = 0
       self.current_accidentals = {}
       self.barNo = 1
-      self.tuplet = (1,1)
+      self.tuplets = [] # (num,fitIn) of each tuplet we're in
+      self.tupletNum = self.tupletDen = 1 # their product
+      self.percents = [] # [barPos at start,times-1] of each percent repeat we're in
       self.last_figures = None
       self.last_was_rest = False
       self.notesHad = []
+  def state(self):
+      # what initOneScore sets (but notesHad, which is only
+      # for messages), as a value that can be compared and
+      # given back to set_state (see IncrementalChecker)
+      return (self.scale,self.barLength,self.beatLength,self.barPos,self.startBarPos,
+              self.onePage,self.noBarNums,self.separateTimesig,self.withStaff,self.notAngka,
+              tuple(sorted((o,tuple(a)) for o,a in self.current_accidentals.items())),
+              self.barNo,tuple(self.tuplets),self.tupletNum,self.tupletDen,
+              tuple(tuple(p) for p in self.percents),self.last_figures,self.last_was_rest)
+  def set_state(self,state):
+      (self.scale,self.barLength,self.beatLength,self.barPos,self.startBarPos,
+       self.onePage,self.noBarNums,self.separateTimesig,self.withStaff,self.notAngka,
+       accidentals,self.barNo,tuplets,self.tupletNum,self.tupletDen,
+       percents,self.last_figures,self.last_was_rest) = state
+      self.current_accidentals = dict((o,list(a)) for o,a in accidentals)
+      self.tuplets = list(tuplets) ; self.percents = [list(p) for p in percents]
+  def ticks(self,num,den):
+      # num/den 64th notes, in ticks
+      t = num*self.scale
+      if t % den:
+          self.rescale(den//gcd(t,den))
+          t = num*self.scale
+      return t//den
+  def rescale(self,factor):
+      self.scale *= factor
+      self.barLength *= factor ; self.beatLength *= factor
+      self.barPos *= factor ; self.startBarPos *= factor
+      for p in self.percents: p[0] *= factor
+  def in64ths(self,ticks):
+      # for messages
+      return "%g" % (ticks/float(self.scale))
   def endScore(self):
-      if not self.barPos == self.startBarPos: errExit("Incomplete bar at end of score %d (pos %d, should be %d)" % (scoreNo,self.barPos,self.startBarPos))
+      if not self.barPos == self.startBarPos: self.converter.error("Incomplete bar at end of score %d (pos %s, should be %s)" % (self.converter.scoreNo,self.in64ths(self.barPos),self.in64ths(self.startBarPos)))
   def setTime(self,num,denom):
-      self.barLength = int(64*num/denom)
-      if denom>4 and num%3==0: self.beatLength = 24 # compound time
-      else: self.beatLength = 16
+      self.barLength = int(64*num/denom)*self.scale
+      if denom>4 and num%3==0: self.beatLength = 24*self.scale # compound time
+      else: self.beatLength = 16*self.scale
   def setAnac(self,denom,dotted):
-      self.barPos = F(self.barLength)-F(64)/denom
-      if dotted: self.barPos -= F(64)/denom/2
-      if not self.barPos: errExit("Anacrusis should be shorter than bar in score %d" % scoreNo)
+      t = self.ticks(64*(2+dotted),2*denom) # (first, as it may rescale barLength)
+      self.barPos = self.barLength-t
+      if not self.barPos: self.converter.error("Anacrusis should be shorter than bar in score %d" % self.converter.scoreNo)
       self.startBarPos = self.barPos
+  def startTuplet(self,num,fitIn):
+      self.tuplets.append((num,fitIn))
+      self.tupletNum *= num ; self.tupletDen *= fitIn
+  def endTuplet(self):
+      if not self.tuplets: return # (stray ])
+      num,fitIn = self.tuplets.pop()
+      self.tupletNum //= num ; self.tupletDen //= fitIn
+  def startPercent(self,times):
+      self.percents.append([self.barPos,times-1])
+  def endPercent(self):
+      # Re-synchronise so bar check still works if percent is less than a bar
+      oldBarPos,multiplier = self.percents.pop()
+      newBarPos = self.barPos
+      while newBarPos < oldBarPos: newBarPos += self.barLength
+      # newBarPos-oldBarPos now gives the remainder (mod barLength) of the percent section's length
+      self.barPos = (self.barPos + (newBarPos-oldBarPos)*multiplier) % self.barLength
+      # TODO: update barNo also (but it's used only for error reports)
   def __call__(self,figures,nBeams,dot,octave,accidental):
     # figures is a chord string of '1'-'7', or '0' or '-'
     # nBeams is 0, 1, 2 .. etc (number of beams for this note)
     # dot is "" or "." (dotted length)
     # octave is "", "'", "''", "," or ",,"
     # accidental is "", "#", "b"
-    if len(figures)>1 and accidental: errExit("Accidentals in chords not yet implemented") # see TODOs below
+    # Returns a NoteIR.
+    if len(figures)>1 and accidental: self.converter.error("Accidentals in chords not yet implemented") # see TODOs below
     self.notesHad.append(figures)
-    names = {'0':'nought',
-             '1':'one',
-             '2':'two',
-             '3':'three',
-             '4':'four',
-             '5':'five',
-             '6':'six',
-             '7':'seven',
-             '-':'dash'}
-    def get_placeholder_chord(figures):
-        if len(figures)==1:
-            return placeholders[figures]
-        elif not midi and not western: return 'c' # we'll override its appearance
-        else: return "< "+" ".join(placeholders[f] for f in list(figures))+" >"
-    placeholder_chord = get_placeholder_chord(figures)
-    invisTieLast = dashes_as_ties and self.last_figures and figures=="-" and not self.last_was_rest
+    n = NoteIR() ; n.chord = figures
+    invisTieLast = self.converter.dashes_as_ties and self.last_figures and figures=="-" and not self.last_was_rest
     self.last_was_rest = (figures=='0' or (figures=='-' and self.last_was_rest))
-    name = ''.join(names[f] for f in figures)
-    if not_angka:
+    name = ''.join(figure_names[f] for f in figures)
+    if self.notAngka:
         # include accidental in the lookup key
         # because it affects the notehead shape
         figures += accidental # TODO: chords?
         name += {"#":"-sharp","b":"-flat","":""}[accidental]
     if invisTieLast: # (so figures == "-")
         figures += self.last_figures # (so "-" + last)
-        name += ''.join(names[f] for f in self.last_figures)
-        placeholder_chord = get_placeholder_chord(self.last_figures)
+        name += ''.join(figure_names[f] for f in self.last_figures)
+        n.chord = self.last_figures
         octave = self.last_octave # for MIDI or 5-line
         accidental = self.last_accidental # ditto
     self.last_figures = figures
     if len(self.last_figures)>1 and self.last_figures[0]=='-': self.last_figures = self.last_figures[1:]
     self.last_octave = octave
     self.last_accidental = accidental
-    if figures not in self.defines_done and not midi and not western:
-        # Define a notehead graphical object for the figures
-        self.defines_done[figures] = "note-"+name
-        if figures.startswith("-"):
-          if not_angka: figuresNew="."
-          else:
-            figuresNew=u"\u2013"
-            if not type(u"")==type(""):
-                figuresNew=figuresNew.encode('utf-8')
-        else: figuresNew = figures
-        ret = """#(define (%s grob grob-origin context)
-  (if (and (eq? (ly:context-property context 'chordChanges) #t)
-      (or (grob::has-interface grob 'note-head-interface)
-        (grob::has-interface grob 'rest-interface)))
-    (begin
-      (ly:grob-set-property! grob 'stencil
-        (grob-interpret-markup grob
-          """ % self.defines_done[figures]
-        if len(figuresNew)==1 or figures.startswith("-"): ret += """(make-lower-markup 0.5 (make-bold-markup "%s")))))))
-""" % figuresNew
-        elif not_angka and accidental: # not chord
-            u338,u20e5=u"\u0338",u"\u20e5" # TODO: the \ looks better than the / in default font
-            if not type("")==type(u""): u338,u20e5=u338.encode('utf-8'),u20e5.encode('utf-8')
-            ret += '(make-lower-markup 0.5 (make-bold-markup "%s%s")))))))\n' % (figures[:1],{'#':u338,'b':u20e5}[accidental])
-        else: ret += """(markup (#:lower 0.5
-          (#:override (cons (quote direction) 1)
-          (#:override (cons (quote baseline-skip) 1.8)
-          (#:dir-column (\n""" + "".join('    #:line (#:bold "'+f+'")\n' for f in figuresNew) + """)))))))))))
-""" # TODO: can do accidentals e.g. #:halign 1 #:line ((#:fontsize -5 (#:raise 0.7 (#:flat))) (#:bold "3")) but might cause the beam not to extend its full length if this chord occurs at the end of a beamed group, + accidentals won't be tracked by Lilypond and would have be taken care of by jianpu-ly (which might mean if any chord has an accidental on one of its notes we'd have to do all notes in that bar like this, whether they are chords or not)
-    else: ret = ""
-    if self.barPos==0 and self.barNo > 1:
-        ret += "| " # barline in Lilypond file: not strictly necessary but may help readability
-        if self.onePage and not midi: ret += r"\noPageBreak "
-        ret += "%{ bar "+str(self.barNo)+": %} "
+    n.figures,n.name,n.nBeams,n.dot,n.octave,n.accidental = figures,name,nBeams,dot,octave,accidental
+    n.invisTie = invisTieLast ; n.onePage,n.withStaff = self.onePage,self.withStaff
+    n.newBar = self.barPos==0 and self.barNo > 1
+    n.barNo = self.barNo
     if not octave in self.current_accidentals: self.current_accidentals[octave] = [""]*7
-    if figures=="-" or all('1'<=figure<='7' and not accidental==self.current_accidentals[octave][int(figure)-1] for figure in list(figures)) and nBeams > self.lastNBeams: leftBeams = nBeams # beam needs to fit under the new accidental (or the dash which might be slightly to the left of where digits are), but if it's no more than last note's beams then we'll hang it only if in same beat.  (TODO: the current_accidentals logic may need revising if other accidental styles are used, e.g. modern-cautionary, although then would need to check anyway if our \consists "Accidental_engraver" is sufficient)
-    # TODO: if figures=="0" then that might be typeset a bit to the left as well (because it's also a rest), however extending the line TOO far left in this case could be counterproductive
-    elif self.inBeamGroup:
-        if nBeams < self.lastNBeams: leftBeams = nBeams
-        else: leftBeams = self.lastNBeams
-    else: leftBeams = 0
-    if leftBeams: assert nBeams, "following logic assumes if (leftBeams or nBeams) == if nBeams"
-    aftrlast0 = ""
-    if not nBeams and self.inBeamGroup:
-        if not self.inBeamGroup=="restHack":
-            aftrlast0 = "] "
-        self.inBeamGroup = 0
-    length = 4 ; b = 0 ; toAdd = F(16) # crotchet
-    while b < nBeams: b,length,toAdd = b+1,length*2,toAdd/2
-    if dot: toAdd += toAdd/2
-    if not self.tuplet[0]==self.tuplet[1]:
-        toAdd = toAdd*self.tuplet[0]/self.tuplet[1]
-    if nBeams and not midi and not western: # must set these unconditionally regardless of what we think their current values are (Lilypond's own beamer can change them from note to note)
-        if not_angka:
-            leftBeams=nBeams
-            if (self.barPos+toAdd)%self.beatLength == 0: nBeams = 0
-        ret += (r"\set stemLeftBeamCount = #%d"+"\n") % leftBeams
-        ret += (r"\set stemRightBeamCount = #%d"+"\n") % nBeams
-        if not_angka: nBeams = leftBeams
+    n.accLeftBeams = all('1'<=figure<='7' and not accidental==self.current_accidentals[octave][int(figure)-1] for figure in list(figures))
+    length = 4 << nBeams # crotchet, quaver ...
+    if dot: toAdd = self.ticks(96*self.tupletNum,length*self.tupletDen)
+    else: toAdd = self.ticks(64*self.tupletNum,length*self.tupletDen)
+    n.length = length
     need_space_for_accidental = False
     for figure in list(figures):
         if '1'<=figure<='7':
             if not accidental==self.current_accidentals[octave][int(figure)-1]:
                 need_space_for_accidental = True
             self.current_accidentals[octave][int(figure)-1] = accidental # TODO: not sensible (assumes accidental applies to EVERY note in the chord, see above)
-    inRestHack = 0
-    if not midi and not western:
-        if ret: ret = ret.rstrip()+"\n" # try to keep the .ly code vaguely readable
-        ret += r"  \applyOutput #'Voice #"+self.defines_done[figures]+" "
-        if placeholder_chord == "r" and use_rest_hack and nBeams:
-            placeholder_chord = "c"
-            # C to work around diagonal-tail problem with
-            # some isolated quaver rests in some Lilypond
-            # versions (usually at end of bar); new voice
-            # so lyrics miss it as if it were a rest:
-            if has_lyrics and not self.withStaff: # (OK if self.withStaff: lyrics will be attached to that instead)
-                ret = jianpu_voice_start() + ret
-                inRestHack = 1
-                if self.inBeamGroup and not self.inBeamGroup=="restHack": aftrlast0 = "] "
-    if placeholder_chord.startswith("<"):
-        # Octave with chords: apply to last note if up, 1st note if down
-        notes = placeholder_chord.split()[1:-1]
-        assert len(notes) >= 2
-        notes[0] += {",":"",",,":","}.get(octave,"'")
-        notes[-1] += {"'":"''","''":"'''"}.get(octave,"'")
-        ret += "< "+" ".join(notes)+" >"
-    else: # single note or rest
-        ret += placeholder_chord + {"":"", "#":"is", "b":"es"}[accidental]
-        if not placeholder_chord=="r": ret += {"":"'","'":"''","''":"'''",",":"",",,":","}[octave] # for MIDI + Western, put it so no-mark starts near middle C
-    ret += ("%d" % length) + dot
-    if nBeams and (not self.inBeamGroup or self.inBeamGroup=="restHack" or inRestHack) and not midi and not western:
-        # We need the above stemLeftBeamCount, stemRightBeamCount override logic to work even if we're an isolated quaver, so do this:
-        ret += '['
-        self.inBeamGroup = 1
+    n.need_space_for_accidental = need_space_for_accidental
+    n.ticks,n.scale = toAdd,self.scale
+    n.beatEnd = self.advance(toAdd,figures,nBeams)
+    return n
+  def time(self,figures,nBeams,dot,accidental):
+    # Just the timing of __call__ (for Converter.check)
+    if len(figures)>1 and accidental: self.converter.error("Accidentals in chords not yet implemented")
+    length = 4 << nBeams
+    if dot: toAdd = self.ticks(96*self.tupletNum,length*self.tupletDen)
+    else: toAdd = self.ticks(64*self.tupletNum,length*self.tupletDen)
+    self.advance(toAdd,figures,nBeams)
+  def advance(self,toAdd,figures,nBeams):
+    # Move on by a note of toAdd ticks and check the bar.
+    # Returns True if the note ends on a beat boundary.
     self.barPos += toAdd
-    # sys.stderr.write(accidental+figure+octave+dot+"/"+str(nBeams)+"->"+str(self.barPos)+" ") # if need to see where we are
-    if self.barPos > self.barLength: errExit("(notesHad=%s) barcheck fail: note crosses barline at \"%s\" with %d beams (%d skipped from %d to %d, bypassing %d), scoreNo=%d barNo=%d (but the error could be earlier)" % (' '.join(self.notesHad),figures,nBeams,toAdd,self.barPos-toAdd,self.barPos,self.barLength,scoreNo,self.barNo))
-    if self.barPos%self.beatLength == 0 and self.inBeamGroup: # (self.inBeamGroup is set only if not midi/western)
-        # jianpu printouts tend to restart beams every beat
-        # (but if there are no beams running anyway, it occasionally helps typesetting to keep the logical group running, e.g. to work around bugs involving beaming a dash-and-rest beat in 6/8) (TODO: what if there's a dash-and-rest BAR?  [..]-notated beams don't usually work across barlines
-        ret += ']'
-        self.inBeamGroup = 0 # DON'T reset lastNBeams here (needed for start-of-group accidental logic)
-    elif inRestHack and self.inBeamGroup:
-        ret += ']'
-        self.inBeamGroup = 'restHack'
-    self.lastNBeams = nBeams
+    # sys.stderr.write(figures+"/"+str(nBeams)+"->"+str(self.barPos)+" ") # if need to see where we are
+    if self.barPos > self.barLength:
+        msg = "barcheck fail: note crosses barline at \"%s\" with %d beams (%s skipped from %s to %s, bypassing %s), scoreNo=%d barNo=%d (but the error could be earlier)" % (figures,nBeams,self.in64ths(toAdd),self.in64ths(self.barPos-toAdd),self.in64ths(self.barPos),self.in64ths(self.barLength),self.converter.scoreNo,self.barNo)
+        if self.notesHad: msg = "(notesHad=%s) " % ' '.join(self.notesHad) + msg
+        self.converter.error(msg)
+        self.barPos = self.barLength # if checking, resume at the next bar
+    beatEnd = self.barPos%self.beatLength == 0
     if self.barPos == self.barLength:
         self.barPos = 0 ; self.barNo += 1
         self.current_accidentals = {}
-    # Octave dots:
-    if not midi and not western and not invisTieLast:
-      # Tweak the Y-offset, as Lilypond occasionally puts it too far down:
-      if not nBeams: ret += {",":r"-\tweak #'Y-offset #-1.2 ",
-                             ",,":r"-\tweak #'Y-offset #1 "}.get(octave,"")
-      oDict = {"":"",
-            "'":"^.",
-            "''":r"-\tweak #'X-offset #0.3 ^\markup{\bold :}",
-            ",":r"-\tweak #'X-offset #0.6 _.",
-            ",,":r"-\tweak #'X-offset #0.3 _\markup{\bold :}"}
-      if not_angka: oDict.update({
-              "'":r"-\tweak #'extra-offset #'(0.4 . 2.7) -\markup{\bold .}",
-              "''":r"-\tweak #'extra-offset #'(0.4 . 3.5) -\markup{\bold :}",
-              })
-      ret += oDict[octave]
-    if invisTieLast:
-        if midi or western: b4last, aftrlast = "", " ~"
-        else: b4last,aftrlast = r"\once \override Tie #'transparent = ##t \once \override Tie #'staff-position = #0 "," ~"
-    else: b4last,aftrlast = "",""
-    if inRestHack: ret += " } "
-    return b4last,aftrlast0+aftrlast,ret, need_space_for_accidental
-
-notehead_markup = notehead_markup()
+    return beatEnd
 
 def parseNote(word):
     if word==".": word = "-" # (for not angka, TODO: document that this is now acceptable as an input word?)
@@ -478,6 +345,74 @@ def parseNote(word):
             accidental = acc ; break
     return figures,nBeams,dot,octave,accidental
 
+class Token(object):
+    # One word of a line of music, classified by tokenize
+    __slots__ = ["kind", # "note", "time", "cmd" etc (see token_kinds and token_re), or "unknown"
+                 "word","value", # value is parseNote's result if kind=="note"
+                 "lineNo","col"] # 1-based
+token_kinds = {"(":"cmd",")":"cmd","~":"cmd",
+               "OnePage":"OnePage","NoBarNums":"NoBarNums",
+               "SeparateTimesig":"SeparateTimesig",
+               "angka":"angka","Indonesian":"angka",
+               "WithStaff":"WithStaff",
+               "R{":"volta","}":"endRepeat","A{":"alternative","|":"nextAlternative",
+               "]":"endTuplet","Fine":"Fine","DC":"DC"}
+token_re = re.compile("|".join([
+    r"(?P<tempo>[1-468]+[.]*=[1-9][0-9]*$)",
+    r"(?P<key>[16]=[A-Ga-g][#b]?$)",
+    r"(?P<finger>Fr=)",
+    r"(?P<time>[1-9][0-9]*/[1-468]+(?:,[1-9][0-9]*[.]?)?$)",
+    r"(?P<cmd>\\)", # Lilypond command, \p etc
+    r"(?P<percent>R[1-9][0-9]*{$)",
+    r"(?P<tuplet>[1-9][0-9]*\[$)",
+    r"(?P<grace>g\[[#b',1-9]+\]$)",
+    r"(?P<aftergrace>\[[#b',1-9]+\]g$)"]))
+word_re = re.compile(r"\S+")
+token_cache = {} # word -> (kind,value), as most words are repeated many times
+
+def classify(word):
+    r = token_cache.get(word)
+    if r: return r
+    kind,value = token_kinds.get(word),None
+    if not kind:
+        m = token_re.match(word)
+        if m: kind = m.lastgroup
+        else:
+            value = parseNote(word)
+            if value[0]: kind = "note"
+            else: kind = "unknown"
+    if len(token_cache) > 10000: token_cache.clear() # (unlikely)
+    r = token_cache[word] = (kind,value)
+    return r
+
+def unrecognised_message(t,line,col,scoreNo):
+    # t is the Token, in line which starts at column col
+    word = t.word
+    if len(word)>60: word=word[:50]+"..."
+    msg = "Unrecognised command %s in score %d (line %d column %d)" % (word,scoreNo,t.lineNo,t.col)
+    start = t.col-col ; end = start+len(t.word)
+    if len(line)>600: # show only the part around the word
+        cut = max(0,start-250)
+        line = line[cut:end+250] ; start -= cut ; end -= cut
+    if "xterm" in os.environ.get("TERM",""): msg += "\n"+line[:start]+"\x1b[4m"+line[start:end]+"\x1b[m"+line[end:]
+    elif re.match('[ -~]*$',line): # all ASCII: we can underline the word with ^^s
+        msg += "\n"+line+"\n"+" "*start+"^"*(end-start)
+    else: # don't try to underline the word (at least not without ANSI): don't know how the terminal will handle character widths
+        msg += "\nin this line: "+line
+    return msg
+
+def tokenize(line,lineNo=1,col=1):
+    # Returns the Tokens of a line of music (up to any
+    # comment); col is the column where line starts
+    tokens = []
+    for m in word_re.finditer(line):
+        word = m.group()
+        if word.startswith('%'): break # a comment
+        t = Token() ; t.kind,t.value = classify(word)
+        t.word,t.lineNo,t.col = word,lineNo,col+m.start()
+        tokens.append(t)
+    return tokens
+
 def write_docs():
     # Write an HTML or Markdown version of the doc string
     def htmlify(l):
@@ -508,42 +443,91 @@ def write_docs():
             print (htmlify(line))
     if inTable and "--html" in sys.argv: print ("</table>")
 
-def get_input():
-  inDat = []
-  for f in sys.argv[1:]:
-    try:
-        try: inDat.append(open(f,encoding="utf-8").read()) # Python 3: try UTF-8 first
-        except: inDat.append(open(f).read()) # Python 2, or Python 3 with locale-default encoding in case it's not UTF-8
+def read_input_file(f):
+    # (read and decoded in one go: see also normalise)
+    try: inDat = open(f,"rb").read()
     except: errExit("Unable to read file "+f)
+    if type("")==type(u""): # Python 3: try UTF-8 first
+        try: inDat = inDat.decode("utf-8")
+        except UnicodeDecodeError: # locale-default encoding in case it's not UTF-8
+            import locale
+            try: inDat = inDat.decode(locale.getpreferredencoding())
+            except UnicodeDecodeError: errExit("Unable to read file "+f)
+    return check_input(inDat)
+
+def check_input(inDat):
+    if type(inDat)==type(u""): bom = u"\ufeff"
+    else: bom = '\xef\xbb\xbf' # Python 2
+    if inDat.startswith(bom): inDat = inDat[len(bom):] # (only at the start of each file: see get_input)
+    if inDat.startswith(r'\version'): errExit("jianpu-ly does not READ Lilypond code.\nPlease see the instructions.")
+    return inDat
+
+def read_input_lines(f):
+    # Like read_input_file, but a line at a time
+    try:
+        try: lines = open(f,encoding="utf-8") # Python 3: try UTF-8 first
+        except TypeError: lines = open(f) # Python 2
+        first = lines.readline()
+    except:
+        try: lines = open(f) ; first = lines.readline() # Python 3 with locale-default encoding in case it's not UTF-8
+        except: errExit("Unable to read file "+f)
+    yield check_input(first)
+    try:
+        for line in lines: yield line
+    except UnicodeDecodeError: errExit("Unable to read file "+f)
+
+def setup_stdio():
+  # returns stdin to read from
   if type("")==type(u""): # Python 3: please use UTF-8 for Lilypond, even if the system locale says something else
-    import codecs
-    stdin=codecs.getreader("utf-8")(sys.stdin.buffer)
+    import codecs,io
+    stdin=io.TextIOWrapper(sys.stdin.buffer,encoding="utf-8") # (decodes in blocks, not per line like codecs)
     stdout=codecs.getwriter("utf-8")(sys.stdout.buffer)
-    old_stdout, sys.stdout = sys.stdout, stdout # for print() (and keep a reference to the old one in case of overzealous gc)
-  else: stdin = sys.stdin
+    global old_stdout ; old_stdout, sys.stdout = sys.stdout, stdout # for print() (and keep a reference to the old one in case of overzealous gc)
+    return stdin
+  else: return sys.stdin
+
+def get_input():
+  inDat = [read_input_file(f) for f in sys.argv[1:]]
+  stdin = setup_stdio()
   if not inDat:
     if sys.stdin.isatty():
         sys.stderr.write(__doc__)
         raise SystemExit
-    inDat=[stdin.read()]
-  for i in xrange(len(inDat)):
-    if inDat[i].startswith('\xef\xbb\xbf'):
-      inDat[i] = inDat[i][3:]
-    if inDat[i].startswith(r'\version'): errExit("jianpu-ly does not READ Lilypond code.\nPlease see the instructions.")
+    inDat=[check_input(stdin.read())]
   return " NextScore ".join(inDat)
 
+def get_input_lines():
+  # Like get_input, but reads lazily, a line at a time
+  files = sys.argv[1:]
+  stdin = setup_stdio()
+  if not files and sys.stdin.isatty():
+      sys.stderr.write(__doc__)
+      raise SystemExit
+  def lines():
+      if not files:
+          first = True
+          for line in stdin:
+              if first: line,first = check_input(line),False
+              yield line
+      for i,f in enumerate(files):
+          if i: yield " NextScore "
+          for line in read_input_lines(f): yield line
+  return lines()
+
+fullwidth_table = dict((c,c-0xfee0) for c in xrange(0xff01,0xff5f)) # full-width ASCII
+fullwidth_table[0x201a] = u"," # sometimes used as comma (incorrectly)
+fullwidth_table[0xff61] = u"."
+
 def fix_fullwidth(t):
-    if type(u"")==type(""): utext = t
-    else: utext = t.decode('utf-8')
-    r = []
-    for c in utext:
-        if 0xff01<=ord(c)<=0xff5e: r.append(unichr(ord(c)-0xfee0))
-        elif c==unichr(0x201a): r.append(",") # sometimes used as comma (incorrectly)
-        elif c==unichr(0xff61): r.append(".")
-        else: r.append(c)
-    utext = u"".join(r)
-    if type(u"")==type(""): return utext
-    else: return utext.encode('utf-8')
+    if not type(t)==type(u""): # Python 2
+        return fix_fullwidth(t.decode('utf-8')).encode('utf-8')
+    return t.translate(fullwidth_table)
+
+def normalise(line):
+    # Everything that is done to each line of input before
+    # it's parsed.  Done once per line as the input is read
+    # (see split_movements).
+    return fix_fullwidth(line)
 
 def graceNotes_markup(notes,isAfter):
     if isAfter: cmd = "jianpu-grace-after"
@@ -606,165 +590,33 @@ def gracenotes_western(notes):
             nextAcc = "" ; next8ve = "'"
     return ' '.join(r)
 
-def getLY(score):
-   lyrics = "" ; headers = {}
-   notehead_markup.initOneScore()
-   out = [] ; maxBeams = 0 ; need_final_barline = 0
-   repeatStack = [] ; lastPtr = 0
-   escaping = inTranspose = 0
-   aftrnext = defined_jianpuGrace = defined_JGR = None
-   for line in score.split("\n"):
-    line = fix_fullwidth(line).strip()
-    line=re.sub(r"^%%\s*tempo:\s*(\S+)\s*$",r"\1",line) # to provide an upgrade path for jihuan-tian's fork
-    if line.startswith("LP:"):
-        # Escaped LilyPond block.  Thanks to James Harkins for this suggestion.
-        # (Our internal barcheck does not understand code in LP blocks, so keep it to complete bars.)
-        # E.g. for multibar rests:
-        # LP:
-        # \compressFullBarRests \override MultiMeasureRest #'expand-limit = #1
-        # R1*5
-        # :LP
-        escaping = 1
-        if len(line)>3: out.append(line[3:]+"\n") # remainder of current line
-    elif line.startswith(":LP"):
-        escaping = 0 # TODO: and process the rest of the line?  (assume on line of own for now)
-    elif escaping:
-        out.append(line+"\n")
-    elif not line: pass
-    elif line.startswith("L:") or line.startswith("H:"):
-        # lyrics
-        do_hanzi_spacing = line.startswith("H:")
-        line = line[2:].strip()
-        lyrics += lyrics_start()
-        toAdd = ""
-        if line and '1' <= line[0] <= '9' and (line[1]=='.' or asUnicode(line)[1]==u"\uff0e"):
-            # a verse number
-            toAdd = r'\set stanza = #"%s." ' % line[:1]
-            if line[1]=='.': line=line[2:]
-            elif not type(line)==type(u""): line=line[4:] # for utf-8 full-width dot in Python 2
-            else: line = line[2:] # for full-width dot in Python 3
-            line = line.strip()
-        if do_hanzi_spacing: # this is not 100% perfect...
-            l2 = [r"\override LyricText #'self-alignment-X = #LEFT "] # for overhanging commas etc to work
-            if toAdd:
-                l2.append(toAdd) ; toAdd = ""
-            needSpace = 0
-            for c in list(asUnicode(line)):
-                if needSpace and (0x4e00 <= ord(c) < 0xa700 or c in u"\u2018\u201c"):
-                    l2.append(' ') ; needSpace = 0
-                    if c in u"\u2018\u201c":
-                        # we're just about to have an open quote - this needs to hang left.  Try:
-                        l2.append(r"\once \override LyricText #'self-alignment-X = #CENTER ") # or RIGHT if there's no punctuation after
-                if 0x4e00 <= ord(c) < 0xa700: needSpace=1
-                l2.append(c)
-            line = u"".join(l2)
-            if not type("")==type(u""): line = line.encode('utf-8') # Python 2
-        lyrics += toAdd+re.sub("(?<=[^- ])- "," -- ",line).replace(" -- "," --\n")+" "+lyrics_end()+" "
-    elif re.match(r"\s*[A-Za-z]+\s*=",line):
-        # Lilypond header
-        hName,hValue = line.split("=",1)
-        headers[hName.strip()] = hValue.strip()
-    else:
-        for word in line.split():
-            if word.startswith('%'): break # a comment
-            elif re.match("[1-468]+[.]*=[1-9][0-9]*$",word): out.append(r'\tempo '+word) # TODO: reduce size a little?
-            elif re.match("[16]=[A-Ga-g][#b]?$",word): #key
-                # Must use \transpose because \transposition doesn't always work.
-                # However, don't use \transpose if printing - it adds extra accidentals to the rhythm staff.
-                # So we have to do separate runs of \layout and \midi (hence the outer loop).
-                if midi or western:
-                    if inTranspose: out.append('}')
-                    if word[0]=="6": transposeFrom = "a"
-                    else: transposeFrom = "c"
-                    transposeTo = word[word.index('=')+1:].replace("#","is").replace("b","es").lower()
-                    if midi and transposeTo[0] in "gab": transposeTo += ','
-                    out.append(r"\transpose c "+transposeTo+r" { \key c \major ") # so that MIDI or Western pitches are correct
-                    inTranspose = 1
-                else: out.append(r'\mark \markup{%s}' % word.replace("b",r"\flat").replace("#",r"\sharp"))
-            elif word.startswith("Fr="):
-              finger = str(word.split("=")[1])
-              finger = {"1": "–", "2": "=", "3": "≡", "4": "四"}.get(finger, finger)
-              out.append(r'\finger "%s"' % finger)
-            elif re.match("[1-9][0-9]*/[1-468]+(,[1-9][0-9]*[.]?)?$",word): # time signature
-                if ',' in word: # anacrusis
-                    word,anac = word.split(",",1)
-                else: anac=""
-                if notehead_markup.separateTimesig and not midi: out.append(r'\mark \markup{'+word+'}')
-                out.append(r'\time '+word)
-                num,denom = word.split('/')
-                notehead_markup.setTime(int(num),int(denom))
-                if anac:
-                    if anac.endswith("."): # e.g. 2.
-                        a2 = anac[:-1] ; anacDotted = 1
-                    else: a2,anacDotted = anac,0
-                    notehead_markup.setAnac(int(a2),anacDotted)
-                    out.append(r'\partial '+anac)
-            elif word.startswith("\\") or word in ["(",")","~"]:
-                # Lilypond command, \p etc
-                if out and "afterGrace" in out[lastPtr]:
-                    # apply to inside afterGrace in midi/western
-                    out[lastPtr] = out[lastPtr][:-1] + word + " }"
-                else: out.append(word)
-            elif word=="OnePage":
-                if notehead_markup.onePage: sys.stderr.write("WARNING: Duplicate OnePage, did you miss out a NextScore?\n")
-                notehead_markup.onePage=1
-            elif word=="NoBarNums":
-                if notehead_markup.noBarNums: sys.stderr.write("WARNING: Duplicate NoBarNums, did you miss out a NextScore?\n")
-                notehead_markup.noBarNums=1
-            elif word=="SeparateTimesig":
-                if notehead_markup.separateTimesig: sys.stderr.write("WARNING: Duplicate SeparateTimesig, did you miss out a NextScore?\n")
-                notehead_markup.separateTimesig=1
-                out.append(r"\override Staff.TimeSignature #'stencil = ##f")
-            elif word in ["angka","Indonesian"]:
-                global not_angka
-                if not_angka: sys.stderr.write("WARNING: Duplicate angka, did you miss out a NextScore?\n")
-                not_angka = True
-            elif word=="WithStaff":
-                if notehead_markup.withStaff: sys.stderr.write("WARNING: Duplicate WithStaff, did you miss out a NextScore?\n")
-                notehead_markup.withStaff=1
-            elif word=="R{":
-                repeatStack.append((1,0,0))
-                out.append(r'\repeat volta 2 {')
-            elif re.match("R[1-9][0-9]*{$",word):
-                times = int(word[1:-1])
-                repeatStack.append((1,notehead_markup.barPos,times-1))
-                out.append(r'\repeat percent %d {' % times)
-            elif word=="}":
-                numBraces,oldBarPos,multiplier = repeatStack.pop()
-                out.append("}"*numBraces)
-                # Re-synchronise so bar check still works if percent is less than a bar:
-                newBarPos = notehead_markup.barPos
-                while newBarPos < oldBarPos: newBarPos += notehead_markup.barLength
-                # newBarPos-oldBarPos now gives the remainder (mod barLength) of the percent section's length
-                notehead_markup.barPos = (notehead_markup.barPos + (newBarPos-oldBarPos)*multiplier) % notehead_markup.barLength
-                # TODO: update barNo also (but it's used only for error reports)
-            elif word=="A{":
-                repeatStack.append((2,0,0))
-                out.append(r'\alternative { {')
-            elif word=="|":
-                if not (repeatStack and repeatStack[-1][0]==2):
-                    sys.stderr.write("| should be in an A{ .. } block (scoreNo=%d barNo=%d)\n" % (scoreNo,notehead_markup.barNo))
-                out.append("} {")
-            elif re.match(r"[1-9][0-9]*\[$",word):
-                # tuplet start, e.g. 3[
-                fitIn = int(word[:-1])
-                i=2
-                while i<fitIn: i*=2
-                if i==fitIn: num=int(fitIn*3/2)
-                else: num=int(i/2)
-                out.append("\\times %d/%d {" % (num,fitIn))
-                notehead_markup.tuplet = (num,fitIn)
-            elif word==']': # tuplet end
-                out.append("}")
-                notehead_markup.tuplet = (1,1)
-            elif re.match(r"g\[[#b',1-9]+\]$",word):
-                if midi or western: out.append(r"\grace { " + gracenotes_western(word[2:-1]) + " }")
-                else:
-                    aftrnext = graceNotes_markup(word[2:-1],0)
-                    if not notehead_markup.withStaff: out.append(r"\once \textLengthOn ")
-                    if not defined_jianpuGrace:
-                        defined_jianpuGrace = True
-                        out.append(r"""#(define-markup-command (jianpu-grace layout props text)
+# For stencil_noteheads: the jianpu voice's noteheads and rests
+# are drawn by these (see jianpu_voice_start), the figure coming
+# from the placeholder pitch (see placeholders).  Only chords,
+# dashes and rest-hack notes still need \applyOutput.
+jianpuNoteheads_define = u"""#(define (jianpu-figure grob)
+  (number->string (1+ (ly:pitch-notename (ly:event-property (event-cause grob) 'pitch)))))
+#(define (jianpu-note-stencil grob)
+  (let ((text (jianpu-figure grob)))
+    (grob-interpret-markup grob (markup #:lower 0.5 #:bold text))))
+#(define (jianpu-rest-stencil grob)
+  (grob-interpret-markup grob (markup #:lower 0.5 #:bold "0")))
+#(define (angka-note-stencil grob)
+  (let* ((alteration (ly:pitch-alteration (ly:event-property (event-cause grob) 'pitch)))
+         (text (string-append (jianpu-figure grob)
+                 (cond ((> alteration 0) "\u0338") ((< alteration 0) "\u20e5") (else "")))))
+    (grob-interpret-markup grob (markup #:lower 0.5 text))))
+#(define (angka-rest-stencil grob)
+  (grob-interpret-markup grob (markup #:lower 0.5 "0")))
+"""
+if not type("")==type(u""): jianpuNoteheads_define = jianpuNoteheads_define.encode('utf-8')
+def stencil_overrides(notAngka):
+    # for the start of a jianpu voice
+    style = notAngka and "angka" or "jianpu"
+    return r"""    \override NoteHead #'stencil = #%s-note-stencil
+    \override Rest #'stencil = #%s-rest-stencil""" % (style,style)
+
+jianpuGrace_define = r"""#(define-markup-command (jianpu-grace layout props text)
 (markup?) "Draw right-pointing jianpu grace under text."
 (let ((textWidth (cdr (ly:stencil-extent (interpret-markup layout props (markup (#:fontsize -4 text))) 0))))
 (interpret-markup layout props
@@ -787,16 +639,8 @@ def getLY(score):
               (list (quote moveto) 0 -0.3)
               (list (quote lineto) textWidth -0.3)
               (list (quote moveto) (* textWidth 0.5) -0.3)
-              (list (quote curveto) (* textWidth 0.5) -1 (* textWidth 0.5) -1 textWidth -1)))))))))))) """)
-            elif re.match(r"\[[#b',1-9]+\]g$",word):
-                if midi or western: out[lastPtr] = r" \afterGrace { " + out[lastPtr] + " } { " + gracenotes_western(word[1:-2]) + " }"
-                else:
-                    if not notehead_markup.withStaff:
-                        out[lastPtr] = r"\once \textLengthOn " + out[lastPtr]
-                    out.insert(lastPtr+1,graceNotes_markup(word[1:-2],1))
-                    if not defined_JGR:
-                        defined_JGR = True
-                        out[lastPtr] = r"""#(define-markup-command (jianpu-grace-after layout props text)
+              (list (quote curveto) (* textWidth 0.5) -1 (* textWidth 0.5) -1 textWidth -1)))))))))))) """
+jianpuGraceAfter_define = r"""#(define-markup-command (jianpu-grace-after layout props text)
 (markup?) "Draw left-pointing jianpu grace under text."
 (let ((textWidth (cdr (ly:stencil-extent (interpret-markup layout props (markup (#:fontsize -4 text))) 0))))
 (interpret-markup layout props
@@ -818,107 +662,2406 @@ def getLY(score):
              (list (quote moveto) 0 -0.3)
              (list (quote lineto) textWidth -0.3)
              (list (quote moveto) (* textWidth 0.5) -0.3)
-             (list (quote curveto) (* textWidth 0.5) -1 (* textWidth 0.5) -1 0 -1)))))))))))) """ + out[lastPtr]
-            elif word=="Fine":
-                need_final_barline = 0
-                out.append(r'''\once \override Score.RehearsalMark #'break-visibility = #begin-of-line-invisible \once \override Score.RehearsalMark #'self-alignment-X = #RIGHT \mark "Fine" \bar "|."''')
-            elif word=="DC":
-                need_final_barline = 0
-                out.append(r'''\once \override Score.RehearsalMark #'break-visibility = #begin-of-line-invisible \once \override Score.RehearsalMark #'self-alignment-X = #RIGHT \mark "D.C. al Fine" \bar "||"''')
-            else: # note (or unrecognised)
-                figures,nBeams,dot,octave,accidental = parseNote(word)
-                if figures:
-                    need_final_barline = 1
-                    b4last,aftrlast,this,need_space_for_accidental = notehead_markup(figures,nBeams,dot,octave,accidental)
-                    if b4last: out[lastPtr]=b4last+out[lastPtr]
-                    if aftrlast: out.insert(lastPtr+1,aftrlast)
-                    lastPtr = len(out)
-                    out.append(this)
-                    if aftrnext:
-                        if need_space_for_accidental: aftrnext = aftrnext.replace(r"\markup",r"\markup \halign #2 ",1)
-                        out.append(aftrnext)
-                        aftrnext = None
-                    if not_angka and "'" in octave: maxBeams=max(maxBeams,len(octave)*.8+nBeams)
-                    else: maxBeams=max(maxBeams,nBeams)
-                else:
-                    if len(word)>60: word=word[:50]+"..."
-                    msg = "Unrecognised command %s in score %d" % (word,scoreNo)
-                    if len(line)>600: line=line[:500]+"..."
-                    if not word in line: pass # above truncations caused problems
-                    elif "xterm" in os.environ.get("TERM",""): msg += "\n"+re.sub(r"(\s|^)"+re.escape(word)+r"(?=\s|$)",lambda m:m.group()[:1]+"\x1b[4m"+m.group()[1:]+"\x1b[m",line)
-                    elif re.match('[ -~]*$',line): # all ASCII: we can underline the word with ^^s
-                        msg += "\n"+line+"\n"+re.sub('[^^]',' ',re.sub(r"(\s|^)"+re.escape(word)+r"(?=\s|$)",lambda m:' '+'^'*(len(m.group())-1),line))
-                    else: # don't try to underline the word (at least not without ANSI): don't know how the terminal will handle character widths
-                        msg += "\nin this line: "+line
-                    errExit(msg)
-   if notehead_markup.barPos == 0 and notehead_markup.barNo == 1: errExit("No jianpu in score %d" % scoreNo)
-   if notehead_markup.inBeamGroup and not midi and not western and not notehead_markup.inBeamGroup=="restHack": out[lastPtr] += ']' # needed if ending on an incomplete beat
-   if inTranspose: out.append("}")
-   if repeatStack: errExit("Unterminated repeat in score %d" % scoreNo)
-   if escaping: errExit("Unterminated LP: in score %d" % scoreNo)
-   notehead_markup.endScore() # perform checks
-   if need_final_barline and not midi: out.append(r'\bar "|."')
-   i=0
-   while i < len(out)-1:
-       while i<len(out)-1 and out[i].startswith(r'\mark \markup{') and out[i].endswith('}') and out[i+1].startswith(r'\mark \markup{') and out[i+1].endswith('}'):
-           # merge time/key signatures
-           nbsp = unichr(0xA0)
-           if not type(u"")==type(""): # Python 2
-               nbsp = nbsp.encode('utf-8')
-           out[i]=out[i][:-1]+nbsp+' '+out[i+1][len(r'\mark \markup{'):]
-           del out[i+1]
-       i += 1
-   for i in xrange(len(out)-1):
-       if not out[i].endswith('\n'):
-           if '\n' in out[i] or len(out[i])>60:
-               out[i] += '\n'
-           else: out[i]+=' '
-   out = ''.join(out)
-   if western: # collapse/combine tied notes into longer notes
-       for numNotes,dot,result in [
-               (4,r"\.","1."), # in 12/8, 4 dotted crotchets = dotted semibreve
-               (4,"","1"), # 4 crotchets = semibreve
-               (3,"","2."), # 3 crotchets = dotted minim
-               (2,r"\.","2."), # in 6/8, 2 dotted crotchets = dotted minim
-               (2,"","2")]: # 2 crotchets = minim
-           out = re.sub(" +~ ".join(["(?P<note>[^ ]*)4"+dot]+["(?P=note)4"+dot]*(numNotes-1)),r"\g<1>"+result,out).replace(" ".join(["r4"+dot]*numNotes),"r"+result)
-       out = re.sub(r"(%\{ bar [0-9]*: %\} )r([^ ]* \\bar)",r"\g<1>R\g<2>",out)
-       out = out.replace(r"\new RhythmicStaff \with {",r"\new RhythmicStaff \with { \override VerticalAxisGroup.default-staff-staff-spacing = #'((basic-distance . 6) (minimum-distance . 6) (stretchability . 0)) ") # don't let it hang too far up in the air
-   if not_angka: out=out.replace("make-bold-markup","make-simple-markup")
-   return out,maxBeams,lyrics,headers
-
-def process_input(inDat):
- ret = []
- global scoreNo, western, has_lyrics, midi, not_angka, maxBeams
- scoreNo = 0 # incr'd to 1 below
- western = False
- for score in re.split(r"\sNextScore\s"," "+inDat+" "):
-  if not score.strip(): continue
-  scoreNo += 1
-  wordSet = set(score.split())
-  has_lyrics = "L:" in wordSet or "H:" in wordSet # the occasional false positive doesn't matter: has_lyrics==False is only an optimisation
-  for midi in [0,1]:
-   not_angka = False # may be set by getLY
-   out,maxBeams,lyrics,headers = getLY(score)
-   if notehead_markup.withStaff and notehead_markup.separateTimesig: errExit("Use of both WithStaff and SeparateTimesig in the same piece is not yet implemented")
-   if scoreNo==1 and not midi: ret.append(all_scores_start()) # not before here, so as not to confuse beginners who don't input a valid score 1
-   ret.append(score_start())
-   if midi:
-       ret.append(midi_staff_start()+" "+out+" "+midi_staff_end())
+             (list (quote curveto) (* textWidth 0.5) -1 (* textWidth 0.5) -1 0 -1)))))))))))) """
+
+class ScoreIR(object):
+    # One parsed movement: the events the staff emitters walk,
+    # plus the parts of the output that don't depend on the staff.
+    def __init__(self):
+        self.events = [] # ('note',NoteIR) ('raw',code[,meaning,args]) ('key',word) ('mark',code) ('cmd',word) ('grace',notes,withStaff) ('aftergrace',notes,withStaff) ('angka',)
+        # (meaning is for MidiEmitter: 'tempo' 'time' 'volta' 'percent' 'alternative' 'nextAlternative' or 'endRepeat')
+        self.lyrics = [] # one string per L: or H: line, without its \new Lyrics wrapper
+        self.headers = {}
+        self.maxBeams = 0
+        self.need_final_barline = 0
+
+class StaffEmitter(object):
+  # Writes the music of one staff from a ScoreIR.  This class
+  # does the MIDI staff (midi=1) and the 5-line staff (western=1);
+  # JianpuEmitter overrides what differs for jianpu.
+  # Code is only appended to self.out, apart from changes to
+  # the last note's item, out[lastPtr]; code to go after the
+  # last note goes in self.after[lastPtr] (see note) and is
+  # put in place by finish_list.  So it takes linear time.
+  def __init__(self,converter,midi=0,western=0):
+      self.converter = converter
+      self.midi,self.western = midi,western
+  def __call__(self,ir):
+      out = self.out = [] ; self.lastPtr = 0 ; self.after = {}
+      self.aftrnext = None ; self.inTranspose = 0
+      self.inBeamGroup = self.lastNBeams = 0
+      self.run = None # see western_note
+      for e in ir.events:
+          kind = e[0]
+          if self.run and not kind in ['note','angka']:
+              if kind=='cmd' and e[1]=='~' and not self.run.tie:
+                  self.run.tie = '~' ; continue
+              self.end_run()
+          if kind=='note': self.note(e[1])
+          elif kind=='raw':
+              if self.western: out.append(e[1].replace(r"\new RhythmicStaff \with {",r"\new RhythmicStaff \with { \override VerticalAxisGroup.default-staff-staff-spacing = #'((basic-distance . 6) (minimum-distance . 6) (stretchability . 0)) ")) # don't let it hang too far up in the air
+              else: out.append(e[1])
+          elif kind=='cmd':
+              if out and "afterGrace" in out[self.lastPtr]:
+                  # apply to inside afterGrace in midi/western
+                  out[self.lastPtr] = out[self.lastPtr][:-1] + e[1] + " }"
+              else: out.append(e[1])
+          elif kind=='key': self.key(e[1])
+          elif kind=='mark':
+              if not self.midi: self.mark(e[1])
+          elif kind=='grace': self.grace(e[1],e[2])
+          elif kind=='aftergrace': self.afterGrace(e[1],e[2])
+          elif kind=='angka': self.converter.not_angka = True
+      return self.finish(ir)
+  def key(self,word):
+      # Must use \transpose because \transposition doesn't always work.
+      # However, don't use \transpose if printing - it adds extra accidentals to the rhythm staff.
+      # So the jianpu staff is written without it (see JianpuEmitter.key).
+      if self.inTranspose: self.out.append('}')
+      if word[0]=="6": transposeFrom = "a"
+      else: transposeFrom = "c"
+      transposeTo = word[word.index('=')+1:].replace("#","is").replace("b","es").lower()
+      if self.midi and transposeTo[0] in "gab": transposeTo += ','
+      self.out.append(r"\transpose c "+transposeTo+r" { \key c \major ") # so that MIDI or Western pitches are correct
+      self.inTranspose = 1
+  def mark(self,code):
+      # \mark \markup{...}, merged with any mark just before it
+      # (e.g. time and key signatures)
+      out = self.out
+      if out and out[-1].startswith(r'\mark \markup{') and out[-1].endswith('}') and not len(out)-1 in self.after:
+          nbsp = unichr(0xA0)
+          if not type(u"")==type(""): # Python 2
+              nbsp = nbsp.encode('utf-8')
+          out[-1] = out[-1][:-1]+nbsp+' '+code[len(r'\mark \markup{'):]
+      else: out.append(code)
+  def after_last(self,code):
+      # code to go straight after the last note
+      self.after.setdefault(self.lastPtr,[]).insert(0,code)
+  def grace(self,notes,withStaff):
+      self.out.append(r"\grace { " + gracenotes_western(notes) + " }")
+  def afterGrace(self,notes,withStaff):
+      out,lastPtr = self.out,self.lastPtr
+      out[lastPtr] = r" \afterGrace { " + out[lastPtr] + " } { " + gracenotes_western(notes) + " }"
+  def note(self,n):
+      out = self.out
+      b4last,aftrlast,this = self.noteLY(n)
+      if self.western and self.western_note(n,aftrlast): return
+      if b4last: out[self.lastPtr]=b4last+out[self.lastPtr]
+      if aftrlast: self.after_last(aftrlast)
+      self.lastPtr = len(out)
+      out.append(this)
+      if self.aftrnext:
+          if n.need_space_for_accidental: self.aftrnext = self.aftrnext.replace(r"\markup",r"\markup \halign #2 ",1)
+          out.append(self.aftrnext)
+          self.aftrnext = None
+  def barMarker(self,n):
+      # barline in Lilypond file: not strictly necessary but may help readability
+      ret = "| "
+      if n.onePage and not self.midi: ret += r"\noPageBreak "
+      return ret + "%{ bar "+str(n.barNo)+": %} "
+  def pitchLY(self,n):
+      octave = n.octave
+      if len(n.chord)>1:
+          # Octave with chords: apply to last note if up, 1st note if down
+          notes = [placeholders[f] for f in n.chord]
+          notes[0] += {",":"",",,":","}.get(octave,"'")
+          notes[-1] += {"'":"''","''":"'''"}.get(octave,"'")
+          return "< "+" ".join(notes)+" >"
+      else: # single note or rest
+          placeholder = placeholders[n.chord]
+          ret = placeholder + {"":"", "#":"is", "b":"es"}[n.accidental]
+          if not placeholder=="r": ret += {"":"'","'":"''","''":"'''",",":"",",,":","}[octave] # for MIDI + Western, put it so no-mark starts near middle C
+          return ret
+  def noteLY(self,n):
+      # returns (code to put before the last note, code to put after it, code for this note)
+      if n.newBar: ret = self.barMarker(n)
+      else: ret = ""
+      ret += self.pitchLY(n) + ("%d" % n.length) + n.dot
+      if n.invisTie: return "", " ~", ret
+      return "", "", ret
+  def western_note(self,n,aftrlast):
+      # On the 5-line staff, crotchets tied to the same pitch
+      # (and crotchet rests in a row) are combined into longer
+      # notes, within a bar.  A run of such crotchets is held
+      # in self.run until it ends.  Returns True if n is held.
+      run = self.run
+      if not (n.length==4 and len(n.chord)==1):
+          if run: self.end_run()
+          return False
+      pitch = self.pitchLY(n)
+      if run and not n.newBar and pitch==run.pitch and n.dot==run.dot:
+          tie = aftrlast or run.tie
+          if aftrlast and run.tie: pass # two ties: leave as is
+          elif tie and run.kind in ["tie",None] or not tie and pitch=="r" and run.kind in ["rest",None]:
+              if tie: run.kind = "tie"
+              else: run.kind = "rest"
+              run.seps.append(tie) ; run.tie = None
+              return True
+      if run: self.end_run()
+      if aftrlast: self.after_last(aftrlast)
+      self.run = run = WesternRun()
+      if n.newBar: run.prefix = self.barMarker(n)
+      else: run.prefix = ""
+      run.pitch,run.dot = pitch,n.dot
+      run.kind = run.tie = None ; run.seps = []
+      return True
+  def end_run(self):
+      # Write out self.run (see western_note)
+      run,out = self.run,self.out
+      self.run = None
+      if run.dot: lengths = {0:[],1:["4."],2:["2."],3:["2.","4."]}
+      else: lengths = {0:[],1:["4"],2:["2"],3:["2."]}
+      numNotes = len(run.seps)+1
+      lengths = ["1"+run.dot]*(numNotes//4) + lengths[numNotes%4]
+      notesDone = 0
+      for i,length in enumerate(lengths):
+          if i: out.append(run.seps[notesDone-1]) # the tie at the end of the previous group
+          self.lastPtr = len(out)
+          if i: out.append(run.pitch+length)
+          else: out.append(run.prefix+run.pitch+length)
+          notesDone += {"1":4,"2":2,"4":1}[length[0]] + (length=="2." and not run.dot)
+      if run.tie: out.append(run.tie)
+  def finish(self,ir):
+      out = join_ly(self.finish_list(ir))
+      if self.converter.not_angka: out=out.replace("make-bold-markup","make-simple-markup")
+      return out
+  def finish_list(self,ir):
+      if self.run: self.end_run()
+      out = self.out
+      if self.after:
+          out = []
+          for i,item in enumerate(self.out):
+              out.append(item)
+              if i in self.after: out += self.after[i]
+      if self.inTranspose: out.append("}")
+      if ir.need_final_barline and not self.midi: out.append(r'\bar "|."')
+      if self.western:
+          # a bar rest before a barline: whole-bar rest
+          for i in xrange(len(out)-1):
+              if out[i+1].startswith(r"\bar") and len(out[i])<=60:
+                  m = re.search(r"%\{ bar [0-9]*: %\} r[^ \n]*$",out[i])
+                  if m: out[i] = out[i][:m.end()-len(m.group())]+m.group().replace("%} r","%} R")
+      return out
+
+class WesternRun(object):
+    # crotchets being combined by StaffEmitter.western_note
+    __slots__ = ["prefix", # bar marker before the first
+                 "pitch","dot",
+                 "kind", # "tie" (tied notes), "rest", or None if just one so far
+                 "seps", # tie (" ~" or "~") after each note but the last
+                 "tie"] # "~" command after the last, if any
+
+def join_ly(out):
+    # try to keep the .ly code vaguely readable
+    for i in xrange(len(out)-1):
+        if not out[i].endswith('\n'):
+            if '\n' in out[i] or len(out[i])>60:
+                out[i] += '\n'
+            else: out[i]+=' '
+    return ''.join(out)
+
+# Rest-hack voices are numbered through the document, so a
+# movement's jianpu staff marks where they start (using Unicode
+# noncharacters) and Converter.resolve fills them in as the
+# movements are assembled in order.  This lets movements be
+# converted independently.  (The Scheme definitions a movement
+# needs are similarly collected by JianpuEmitter for
+# Converter.prelude to write just once per document.)
+DEFER,DEFER_END = u"\ufdd0",u"\ufdd2"
+deferred_re = re.compile(DEFER+"V(1?)"+DEFER_END)
+
+note_templates = {} # (use_rest_hack,stencil_noteheads,not_angka) -> {note: JianpuEmitter.template}
+invisTie_b4last = r"\once \override Tie #'transparent = ##t \once \override Tie #'staff-position = #0 "
+
+class JianpuEmitter(StaffEmitter):
+  # Writes the jianpu staff: noteheads are replaced by figures
+  # via \applyOutput, and beams are set explicitly.  Returns
+  # a list for Converter.resolve and join_ly (see DEFER above),
+  # leaving the definitions it needs in self.defines.
+  def key(self,word):
+      self.mark(r'\mark \markup{%s}' % word.replace("b",r"\flat").replace("#",r"\sharp"))
+  def grace(self,notes,withStaff):
+      self.aftrnext = graceNotes_markup(notes,0)
+      if not withStaff: self.out.append(r"\once \textLengthOn ")
+      self.define_once("jianpu-grace",jianpuGrace_define)
+  def afterGrace(self,notes,withStaff):
+      out,lastPtr = self.out,self.lastPtr
+      if not withStaff:
+          out[lastPtr] = r"\once \textLengthOn " + out[lastPtr]
+      self.after_last(graceNotes_markup(notes,1))
+      self.define_once("jianpu-grace-after",jianpuGraceAfter_define)
+  def __call__(self,ir):
+      self.defines_done = {} # figures -> name, and grace commands
+      self.defines = [] # (key,Scheme code)
+      mode = (self.converter.use_rest_hack,self.converter.stencil_noteheads)
+      self.templates = dict((not_angka,note_templates.setdefault(mode+(not_angka,),{})) for not_angka in [False,True])
+      if self.converter.stencil_noteheads: self.define_once("jianpu-noteheads",jianpuNoteheads_define)
+      return StaffEmitter.__call__(self,ir)
+  def define_once(self,key,code):
+      if key not in self.defines_done:
+          self.defines_done[key] = True
+          self.defines.append((key,code))
+  def define(self,n):
+      # Define a notehead graphical object for the figures
+      figures,accidental = n.figures,n.accidental
+      not_angka = self.converter.not_angka
+      defines_done = self.defines_done
+      defines_done[figures] = "note-"+n.name
+      if figures.startswith("-"):
+        if not_angka: figuresNew="."
+        else:
+          figuresNew=u"\u2013"
+          if not type(u"")==type(""):
+              figuresNew=figuresNew.encode('utf-8')
+      else: figuresNew = figures
+      ret = """#(define (%s grob grob-origin context)
+  (if (and (eq? (ly:context-property context 'chordChanges) #t)
+      (or (grob::has-interface grob 'note-head-interface)
+        (grob::has-interface grob 'rest-interface)))
+    (begin
+      (ly:grob-set-property! grob 'stencil
+        (grob-interpret-markup grob
+          """ % defines_done[figures]
+      if len(figuresNew)==1 or figures.startswith("-"): ret += """(make-lower-markup 0.5 (make-bold-markup "%s")))))))
+""" % figuresNew
+      elif not_angka and accidental: # not chord
+          u338,u20e5=u"\u0338",u"\u20e5" # TODO: the \ looks better than the / in default font
+          if not type("")==type(u""): u338,u20e5=u338.encode('utf-8'),u20e5.encode('utf-8')
+          ret += '(make-lower-markup 0.5 (make-bold-markup "%s%s")))))))\n' % (figures[:1],{'#':u338,'b':u20e5}[accidental])
+      else: ret += """(markup (#:lower 0.5
+          (#:override (cons (quote direction) 1)
+          (#:override (cons (quote baseline-skip) 1.8)
+          (#:dir-column (\n""" + "".join('    #:line (#:bold "'+f+'")\n' for f in figuresNew) + """)))))))))))
+""" # TODO: can do accidentals e.g. #:halign 1 #:line ((#:fontsize -5 (#:raise 0.7 (#:flat))) (#:bold "3")) but might cause the beam not to extend its full length if this chord occurs at the end of a beamed group, + accidentals won't be tracked by Lilypond and would have be taken care of by jianpu-ly (which might mean if any chord has an accidental on one of its notes we'd have to do all notes in that bar like this, whether they are chords or not)
+      self.defines.append((figures,ret))
+  def template(self,n):
+    # The parts of n's code that depend only on n and the
+    # mode, kept in note_templates: (the \applyOutput code,
+    # or "" if the staff's overrides draw it, whether it uses
+    # the rest hack, the note itself, its octave dots)
+    figures,nBeams,octave,accidental = n.figures,n.nBeams,n.octave,n.accidental
+    converter = self.converter ; not_angka = converter.not_angka
+    if len(n.chord)>1: placeholder_chord = 'c' # we'll override its appearance
+    else: placeholder_chord = placeholders[n.chord]
+    restHack = placeholder_chord == "r" and converter.use_rest_hack and nBeams
+    if restHack: placeholder_chord = "c" # (see noteLY)
+    # with stencil_noteheads, the staff's overrides draw single figures and rests from the placeholder
+    if converter.stencil_noteheads and figures[:1]==n.chord and ("1"<=n.chord<="7" or n.chord=="0" and not restHack): applyOutput = ""
+    else: applyOutput = r"  \applyOutput #'Voice #note-"+n.name+" "
+    note = placeholder_chord + {"":"", "#":"is", "b":"es"}[accidental]
+    if not placeholder_chord=="r": note += {"":"'","'":"''","''":"'''",",":"",",,":","}[octave]
+    note += ("%d" % n.length) + n.dot
+    # Octave dots:
+    dots = ""
+    if not n.invisTie:
+      # Tweak the Y-offset, as Lilypond occasionally puts it too far down:
+      if not nBeams: dots += {",":r"-\tweak #'Y-offset #-1.2 ",
+                              ",,":r"-\tweak #'Y-offset #1 "}.get(octave,"")
+      oDict = {"":"",
+            "'":"^.",
+            "''":r"-\tweak #'X-offset #0.3 ^\markup{\bold :}",
+            ",":r"-\tweak #'X-offset #0.6 _.",
+            ",,":r"-\tweak #'X-offset #0.3 _\markup{\bold :}"}
+      if not_angka: oDict.update({
+              "'":r"-\tweak #'extra-offset #'(0.4 . 2.7) -\markup{\bold .}",
+              "''":r"-\tweak #'extra-offset #'(0.4 . 3.5) -\markup{\bold :}",
+              })
+      dots += oDict[octave]
+    t = (applyOutput,bool(restHack),note,dots)
+    table = self.templates[not_angka]
+    if len(table) > 10000: table.clear() # (unlikely)
+    table[(figures,n.chord,octave,accidental,nBeams,n.dot,n.invisTie)] = t
+    return t
+  def noteLY(self,n):
+    # Only what depends on the notes before is worked out
+    # here: the rest comes from template
+    figures,nBeams = n.figures,n.nBeams
+    converter = self.converter ; not_angka = converter.not_angka
+    t = self.templates[not_angka].get((figures,n.chord,n.octave,n.accidental,nBeams,n.dot,n.invisTie))
+    if t is None: t = self.template(n)
+    applyOutput,restHack,note,dots = t
+    if applyOutput and figures not in self.defines_done: self.define(n)
+    if n.newBar: ret = self.barMarker(n)
+    else: ret = ""
+    if figures=="-" or n.accLeftBeams and nBeams > self.lastNBeams: leftBeams = nBeams # beam needs to fit under the new accidental (or the dash which might be slightly to the left of where digits are), but if it's no more than last note's beams then we'll hang it only if in same beat.  (TODO: the current_accidentals logic may need revising if other accidental styles are used, e.g. modern-cautionary, although then would need to check anyway if our \consists "Accidental_engraver" is sufficient)
+    # TODO: if figures=="0" then that might be typeset a bit to the left as well (because it's also a rest), however extending the line TOO far left in this case could be counterproductive
+    elif self.inBeamGroup:
+        if nBeams < self.lastNBeams: leftBeams = nBeams
+        else: leftBeams = self.lastNBeams
+    else: leftBeams = 0
+    if leftBeams: assert nBeams, "following logic assumes if (leftBeams or nBeams) == if nBeams"
+    aftrlast0 = ""
+    if not nBeams and self.inBeamGroup:
+        if not self.inBeamGroup=="restHack":
+            aftrlast0 = "] "
+        self.inBeamGroup = 0
+    if nBeams: # must set these unconditionally regardless of what we think their current values are (Lilypond's own beamer can change them from note to note)
+        if not_angka:
+            leftBeams=nBeams
+            if n.beatEnd: nBeams = 0
+        ret += (r"\set stemLeftBeamCount = #%d"+"\n") % leftBeams
+        ret += (r"\set stemRightBeamCount = #%d"+"\n") % nBeams
+        if not_angka: nBeams = leftBeams
+    inRestHack = 0
+    if ret: ret = ret.rstrip()+"\n" # try to keep the .ly code vaguely readable
+    ret += applyOutput or "  "
+    if restHack:
+        # C to work around diagonal-tail problem with
+        # some isolated quaver rests in some Lilypond
+        # versions (usually at end of bar); new voice
+        # so lyrics miss it as if it were a rest:
+        if converter.has_lyrics and not n.withStaff: # (OK if withStaff: lyrics will be attached to that instead)
+            ret = DEFER+"V"+(not_angka and "1" or "")+DEFER_END + ret # jianpu_voice_start()
+            inRestHack = 1
+            if self.inBeamGroup and not self.inBeamGroup=="restHack": aftrlast0 = "] "
+    ret += note
+    if nBeams and (not self.inBeamGroup or self.inBeamGroup=="restHack" or inRestHack):
+        # We need the above stemLeftBeamCount, stemRightBeamCount override logic to work even if we're an isolated quaver, so do this:
+        ret += '['
+        self.inBeamGroup = 1
+    if n.beatEnd and self.inBeamGroup:
+        # jianpu printouts tend to restart beams every beat
+        # (but if there are no beams running anyway, it occasionally helps typesetting to keep the logical group running, e.g. to work around bugs involving beaming a dash-and-rest beat in 6/8) (TODO: what if there's a dash-and-rest BAR?  [..]-notated beams don't usually work across barlines
+        ret += ']'
+        self.inBeamGroup = 0 # DON'T reset lastNBeams here (needed for start-of-group accidental logic)
+    elif inRestHack and self.inBeamGroup:
+        ret += ']'
+        self.inBeamGroup = 'restHack'
+    self.lastNBeams = nBeams
+    ret += dots
+    if inRestHack: ret += " } "
+    if n.invisTie: return invisTie_b4last,aftrlast0+" ~",ret
+    return "",aftrlast0,ret
+  def finish(self,ir):
+      if self.inBeamGroup and not self.inBeamGroup=="restHack": self.out[self.lastPtr] += ']' # needed if ending on an incomplete beat
+      return self.finish_list(ir)
+
+class MidiEmitter(object):
+  # Plays a ScoreIR into MIDI events directly, for midi_file
+  # (much faster than writing the MIDI staff and running
+  # LilyPond).  Repeats are unfolded as \unfoldRepeats would;
+  # grace notes, dynamics and LP: blocks are left out.
+  ticksPer64th = 60 # 960 to a crotchet
+  def __init__(self,track,time=0):
+      self.track = track # (time,order,bytes): order 0 = meta, 1 = note off, 2 = note on
+      self.start = self.time = time
+  def __call__(self,ir):
+      # appends ir's events to self.track, returns the end time
+      self.keyOffset = 0
+      self.sounding = None # [pitches,end] of the last note, so ties can lengthen it
+      self.tie = False ; self.scale = 1 ; self.pos = 0 # pos is in 64ths*scale, exact
+      self.play(unfold(ir.events))
+      self.release()
+      return self.time
+  def play(self,events):
+      for e in events:
+          kind = e[0]
+          if kind=='note': self.note(e[1])
+          elif kind=='key': self.keyOffset = midi_key_offset(e[1])
+          elif kind=='cmd' and e[1]=='~': self.tie = True
+          elif kind=='raw' and len(e)>2:
+              if e[2]=='tempo': self.tempo(e[3])
+              elif e[2]=='time':
+                  num,denom = e[3],e[4] ; d = 0
+                  while (1<<d) < denom: d += 1
+                  self.meta(0x58,bytearray([num,d,24,8]))
+  def meta(self,kind,data):
+      self.track.append((self.time,0,bytearray([0xff,kind])+varlen(len(data))+data))
+  def tempo(self,word):
+      # e.g. 4=85, 4.=60
+      unit,bpm = word.split("=")
+      crotchets = 4.0/int(unit.rstrip(".")) * (1.5 if unit.endswith(".") else 1)
+      usec = int(round(60000000/(int(bpm)*crotchets)))
+      self.meta(0x51,bytearray([usec>>16,(usec>>8)&0xff,usec&0xff]))
+  def note(self,n):
+      if n.scale > self.scale: # see notehead_markup.rescale
+          self.pos *= n.scale//self.scale ; self.scale = n.scale
+      self.pos += n.ticks*(self.scale//n.scale)
+      end = self.start+self.pos*self.ticksPer64th//self.scale
+      tie,self.tie = self.tie,False
+      if n.chord in ['0','-'] and not (n.chord=='-' and self.sounding): # rest
+          self.release()
+      else:
+          pitches = self.pitches(n)
+          if self.sounding and (n.invisTie or n.chord=='-' or tie and pitches==self.sounding[0]):
+              self.sounding[1] = end # tied on
+          else:
+              self.release()
+              for p in pitches: self.track.append((self.time,2,bytearray([0x90,p,80])))
+              self.sounding = [pitches,end]
+      self.time = end
+  def release(self):
+      if self.sounding:
+          pitches,end = self.sounding
+          for p in pitches: self.track.append((end,1,bytearray([0x80,p,0])))
+          self.sounding = None
+  def pitches(self,n):
+      # as StaffEmitter.pitchLY
+      base = 60+self.keyOffset+{"":0,"'":12,"''":24,",":-12,",,":-24}[n.octave]
+      if len(n.chord)==1: return [base+midi_semitones[n.chord]+{"":0,"#":1,"b":-1}[n.accidental]]
+      # chords go upwards from the first figure, an octave
+      # mark moving the bottom note down or the top note up
+      r = [] ; up = n.octave in ["'","''"]
+      if up: base -= 12*len(n.octave)
+      for f in n.chord:
+          p = base+midi_semitones[f]
+          while r and p <= r[-1]: p += 12
+          r.append(p)
+      if up: r[-1] += 12*len(n.octave)
+      return r
+
+midi_semitones = {'1':0,'2':2,'3':4,'4':5,'5':7,'6':9,'7':11}
+def midi_key_offset(word):
+    # semitones from middle C to 1, for e.g. 1=Bb or 6=F#
+    # (putting 1 in the octave the MIDI staff does)
+    fig,note = word.split("=")
+    offset = {"c":0,"d":2,"e":4,"f":5,"g":7,"a":9,"b":11}[note[0].lower()]+{"#":1,"b":-1}.get(note[1:],0)
+    if note[0].lower() in "gab": offset -= 12
+    return offset-midi_semitones[fig]
+
+def unfold(events):
+    # events with repeats written out in full
+    top = [] ; stack = [(top,None,False)] # (list being added to, repeat it's for, is an alternative)
+    for e in events:
+        meaning = (e[0]=='raw' and len(e)>2) and e[2] or None
+        if meaning=='volta': stack.append(([],[2],False)) # repeat: [times,body,alternatives...]
+        elif meaning=='percent': stack.append(([],[e[3]],False))
+        elif meaning=='alternative': stack.append(([],stack[-1][0][-1],True)) # (of the repeat just ended)
+        elif meaning in ['nextAlternative','endRepeat']:
+            body,rep,isAlternative = stack.pop()
+            rep.append(body)
+            if not isAlternative: stack[-1][0].append(rep)
+            if meaning=='nextAlternative': stack.append(([],rep,True))
+        else: stack[-1][0].append(e)
+    if len(stack) > 1: return top # (unterminated: parse_score will have said)
+    return list(flatten(top))
+def flatten(items):
+    for item in items:
+        if type(item)==list: # [times,body,alternatives...]
+            times,body,alts = item[0],item[1],item[2:]
+            times = max(times,len(alts))
+            for i in xrange(times):
+                for e in flatten(body): yield e
+                if alts:
+                    for e in flatten(alts[max(0,i-(times-len(alts)))]): yield e
+        else: yield item
+
+def varlen(n):
+    # MIDI variable-length quantity
+    r = bytearray([n & 0x7f])
+    n >>= 7
+    while n:
+        r.insert(0,(n & 0x7f)|0x80) ; n >>= 7
+    return r
+
+def midi_file(file_or_lines,**options):
+    # A Standard MIDI File (as bytes) playing the movements
+    # of the input one after another.  options are as for
+    # Converter.
+    converter = Converter(**options)
+    track = [] ; time = 0
+    MidiEmitter(track).tempo("4=84") # as score_end's \midi block
+    for converter.scoreNo,converter.lineNo,score in split_movements(file_or_lines):
+        time = MidiEmitter(track,time)(converter.parse_score(score))
+    data = bytearray() ; last = 0
+    for t,_,event in sorted(track,key=lambda e:e[:2]):
+        data += varlen(t-last)+event ; last = t
+    data += bytearray([0,0xff,0x2f,0])
+    header = bytearray(b"MThd\0\0\0\6\0\0\0\1")+bytearray([960>>8,960&0xff])
+    return bytes(header+b"MTrk"+bytearray([len(data)>>24,(len(data)>>16)&0xff,(len(data)>>8)&0xff,len(data)&0xff])+data)
+
+class SvgSlot(object):
+    # a note, rest or dash as SvgEmitter lays it out
+    __slots__ = ["n", # the NoteIR
+                 "marks", # text above it: key, time, tempo, 1. etc
+                 "endMark", # text above its right, e.g. Fine
+                 "below", # dynamic
+                 "grace","afterGrace", # grace notes as written, e.g. "#45"
+                 "before","after", # barline ("|:" etc) before or after it, if not the usual
+                 "group", # beam group (as JianpuEmitter's), or 0 if no beams
+                 "takesLyric", # not a rest, a dash, or tied or slurred from before
+                 "syllables", # [(verse,text)] under it
+                 "width", # of the figures (stretched when drawn)
+                 "total", # of all of it, with grace notes etc
+                 "left","x","right","line"] # x is the figure's centre
+
+class SvgEmitter(object):
+  # Lays out a ScoreIR as jianpu in SVG, for svg_preview (a
+  # quick preview that doesn't need LilyPond).  Notes get
+  # fixed widths, widened for their lyrics, and lines are
+  # broken between bars and stretched to fill the width.
+  # Beams restart as on the jianpu staff.  LP: blocks,
+  # fingering and articulations are left out, and percent
+  # repeats are written once.
+  noteWidth,dotWidth,accWidth,graceWidth,barGap = 22,6,8,6,14
+  def __init__(self,width=760,margin=20):
+      self.width,self.margin = width,margin
+  def __call__(self,ir,y,out):
+      # appends ir's SVG elements to out, returns the y below them
+      self.out = out
+      bars = self.layout(ir)
+      self.verses = [lyric_syllables(l) for l in ir.lyrics]
+      self.assign_lyrics(bars)
+      self.set_widths(bars)
+      y = self.headers(ir.headers,y)
+      self.lines = [] # (arc y, lyrics y, right edge) of each line
+      lines = self.break_lines(bars)
+      for lineNo,(line,used) in enumerate(lines):
+          y = self.draw_line(line,used,lineNo,lineNo==len(lines)-1,y)
+      for a,b in self.arcs: self.arc(a,b)
+      for v,a,b in self.hyphens: self.hyphen(v,a,b)
+      return y
+  def layout(self,ir):
+      # returns the bars, as lists of SvgSlots
+      self.angka = False
+      self.arcs = [] # (from,to) slots of ties and slurs
+      bars = [[]] ; last = tieFrom = None
+      marks = [] ; grace = before = ""
+      slurs = [] ; repeats = [] ; alternative = 0
+      group = inGroup = 0 ; showTime = True
+      for e in ir.events:
+          kind = e[0]
+          if kind=='note':
+              n = e[1]
+              if n.newBar and bars[-1]: bars.append([])
+              s = SvgSlot() ; s.n = n
+              s.marks,s.grace,s.before = marks,grace,before
+              marks = [] ; grace = before = ""
+              s.endMark = s.below = s.afterGrace = s.after = ""
+              s.syllables = []
+              if n.nBeams:
+                  if not inGroup: group += 1 ; inGroup = 1
+                  s.group = group
+                  if n.beatEnd: inGroup = 0 # beams restart every beat
+              else: s.group = inGroup = 0
+              s.takesLyric = not (n.chord=="0" or n.figures=="-" or n.invisTie or tieFrom or slurs)
+              if tieFrom: self.arcs.append((tieFrom,s)) ; tieFrom = None
+              bars[-1].append(s) ; last = s
+          elif kind=='key': marks.append(svg_key(e[1]))
+          elif kind=='mark': marks.append(svg_markup(e[1]))
+          elif kind=='grace': grace = e[1]
+          elif kind=='aftergrace':
+              if last: last.afterGrace = e[1]
+          elif kind=='angka': self.angka = True
+          elif kind=='cmd':
+              if e[1]=='~': tieFrom = last
+              elif e[1]=='(':
+                  if last: slurs.append(last)
+              elif e[1]==')':
+                  if slurs: self.arcs.append((slurs.pop(),last))
+              elif last and svg_dynamic_re.match(e[1]): last.below = e[1][1:]
+          elif kind=='raw':
+              code,meaning = e[1],len(e)>2 and e[2]
+              if meaning=='tempo': marks.append(svg_tempo(e[3]))
+              elif meaning=='time':
+                  if showTime: marks.append("%d/%d" % (e[3],e[4]))
+              elif meaning in ['volta','percent']:
+                  repeats.append(meaning)
+                  if meaning=='volta': before = "|:"
+              elif meaning=='alternative':
+                  repeats.append(meaning)
+                  if last and last.after==":|": last.after = "" # the first ending has it
+                  alternative = 1 ; marks.append("1.")
+              elif meaning=='nextAlternative':
+                  if last: last.after = ":|"
+                  alternative += 1 ; marks.append("%d." % alternative)
+              elif meaning=='endRepeat':
+                  if repeats.pop()=='volta' and last: last.after = ":|"
+              elif "TimeSignature #'stencil" in code: showTime = False # SeparateTimesig (its marks come as 'mark')
+              else: # Fine, DC, tuplets
+                  m = re.search(r'\\mark "([^"]*)"',code)
+                  if m and last: last.endMark = m.group(1)
+                  m = re.search(r'\\bar "([^"]*)"',code)
+                  if m and last: last.after = m.group(1)
+                  m = re.match(r'\\times [0-9]+/([0-9]+) {',code)
+                  if m: marks.append(m.group(1))
+      if ir.need_final_barline and last and not last.after: last.after = "|."
+      return [bar for bar in bars if bar]
+  def assign_lyrics(self,bars):
+      # puts the syllables of each verse under the notes that take them
+      self.hyphens = [] # (verse,from,to) slots
+      slots = [s for bar in bars for s in bar if s.takesLyric]
+      for v,syllables in enumerate(self.verses):
+          for s,(text,hyphen) in zip(slots,syllables):
+              if text: s.syllables.append((v,text))
+          for i in xrange(min(len(slots),len(syllables))-1):
+              if syllables[i][1]: self.hyphens.append((v,slots[i],slots[i+1]))
+  def accidental(self,n):
+      if self.angka or n.figures.startswith("-") or not n.need_space_for_accidental: return ""
+      return {"#":u"\u266f","b":u"\u266d","":u"\u266e"}[n.accidental]
+  def set_widths(self,bars):
+      for bar in bars:
+          for i,s in enumerate(bar):
+              n = s.n
+              s.width = w = max([self.noteWidth]+[svg_text_width(t,7)+4 for v,t in s.syllables])
+              w += (len(s.grace)+len(s.afterGrace))*self.graceWidth
+              if n.dot: w += self.dotWidth
+              if self.accidental(n): w += self.accWidth
+              if s.before and i: w += self.barGap
+              if s.after and i<len(bar)-1: w += self.barGap
+              s.total = w
+  def break_lines(self,bars):
+      # returns [(bars,width used)]
+      avail = self.width-2*self.margin
+      lines = [] ; line = [] ; used = 0
+      for bar in bars:
+          w = sum(s.total for s in bar)+self.barGap
+          if line and used+w > avail:
+              lines.append((line,used)) ; line = [] ; used = 0
+          if not line and bar[0].before: w += self.barGap
+          line.append(bar) ; used += w
+      if line: lines.append((line,used))
+      return lines
+  def headers(self,headers,y):
+      out,width = self.out,self.width
+      if headers.get("title"):
+          y += 30 ; out.append(svg_text(width/2.0,y,headers["title"],"t"))
+      if headers.get("poet") or headers.get("composer"):
+          y += 18
+          if headers.get("poet"): out.append(svg_text(self.margin,y,headers["poet"],"s"))
+          if headers.get("composer"): out.append(svg_text(width-self.margin,y,headers["composer"],"s r"))
+      return y
+  def draw_line(self,line,used,lineNo,isLast,y):
+      # draws one line of bars below y, returns the y below it
+      out = self.out ; barGap = self.barGap
+      slots = [s for bar in line for s in bar]
+      stretch = 0
+      if not isLast: stretch = max(0,self.width-2*self.margin-used)/float(len(slots))
+      chordUp = 15*max([len(s.n.chord)-1 for s in slots if not s.n.figures.startswith("-")]+[0])
+      maxBeams = max(s.n.nBeams for s in slots)
+      markY = y+16 ; digitY = y+48+chordUp
+      barTop,barBottom = digitY-18-chordUp,digitY+6
+      belowY = digitY+20+3.5*maxBeams
+      lyricY = belowY + (any(s.below for s in slots) and 18 or 0)
+      x = self.margin
+      for bi,bar in enumerate(line):
+          for i,s in enumerate(bar):
+              n = s.n
+              if s.before and (i or not bi):
+                  self.barline(s.before,x+barGap/2.0,barTop,barBottom) ; x += barGap
+              s.left,s.line = x,lineNo
+              if s.grace:
+                  out.append(svg_text(x,digitY-10,svg_grace(s.grace),"g"))
+                  x += len(s.grace)*self.graceWidth
+              acc = self.accidental(n)
+              if acc:
+                  out.append(svg_text(x+self.accWidth/2.0,digitY-7,acc,"s c"))
+                  x += self.accWidth
+              s.x = x+(s.width+stretch)/2.0 ; x += s.width+stretch
+              self.figures(s,digitY)
+              if n.dot:
+                  out.append('<circle cx="%.1f" cy="%.1f" r="1.8"/>' % (x+1,digitY-5))
+                  x += self.dotWidth
+              if s.afterGrace:
+                  out.append(svg_text(x,digitY-10,svg_grace(s.afterGrace),"g"))
+                  x += len(s.afterGrace)*self.graceWidth
+              s.right = x
+              if s.marks: out.append(svg_text(s.left,markY," ".join(s.marks),"s"))
+              if s.endMark: out.append(svg_text(s.right,markY,s.endMark,"s r"))
+              if s.below: out.append(svg_text(s.x,belowY,s.below,"s c d"))
+              for v,text in s.syllables: out.append(svg_text(s.x,lyricY+18*v,text,"l"))
+              if s.after and i<len(bar)-1:
+                  self.barline(s.after,x+barGap/2.0,barTop,barBottom) ; x += barGap
+          kind = bar[-1].after or "|"
+          if bi<len(line)-1 and line[bi+1][0].before: kind = {"|":"|:",":|":":|:"}.get(kind,kind)
+          self.barline(kind,x+barGap/2.0,barTop,barBottom) ; x += barGap
+      for k in xrange(1,maxBeams+1): self.beams(slots,k,digitY+4+3.5*(k-1))
+      self.lines.append((digitY-24-chordUp,lyricY,x))
+      if self.verses: return lyricY+18*(len(self.verses)-1)+12
+      return lyricY-6
+  def figures(self,s,digitY):
+      # the figures of a note, with its octave dots
+      n,out = s.n,self.out
+      if n.figures.startswith("-"):
+          out.append(svg_text(s.x,digitY,self.angka and "." or u"\u2013","n"))
+          return
+      cls = self.angka and "n a" or "n"
+      for k,f in enumerate(n.chord):
+          if self.angka and n.accidental: f += {"#":u"\u0338","b":u"\u20e5"}[n.accidental] # as JianpuEmitter.define
+          out.append(svg_text(s.x,digitY-15*k,f,cls))
+      if not n.octave: return
+      if "'" in n.octave: y,dy = digitY-15*(len(n.chord)-1)-18,-5
+      else: y,dy = digitY+7+3.5*n.nBeams,5
+      for k in xrange(len(n.octave)): out.append('<circle cx="%.1f" cy="%.1f" r="1.8"/>' % (s.x,y+dy*k))
+  def beams(self,slots,k,y):
+      # the k'th beam of each group in a line
+      start = prev = None
+      for s in slots + [None]:
+          if s and s.n.nBeams>=k and s.group and prev and s.group==prev.group:
+              prev = s ; continue
+          if start: self.out.append('<line x1="%.1f" y1="%.1f" x2="%.1f" y2="%.1f"/>' % (start.x-8,y,prev.x+8,y))
+          if s and s.n.nBeams>=k and s.group: start = prev = s
+          else: start = prev = None
+  def barline(self,kind,x,top,bottom):
+      out = self.out
+      def line(x,width=1): out.append('<line x1="%.1f" y1="%.1f" x2="%.1f" y2="%.1f" stroke-width="%d"/>' % (x,top,x,bottom,width))
+      def dots(x):
+          for y in [top+(bottom-top)*0.35,top+(bottom-top)*0.65]: out.append('<circle cx="%.1f" cy="%.1f" r="1.5"/>' % (x,y))
+      if kind=="||": line(x-2) ; line(x+2)
+      elif kind=="|.": line(x-3) ; line(x+1,3)
+      elif kind=="|:": line(x-4,3) ; line(x) ; dots(x+4)
+      elif kind==":|": dots(x-4) ; line(x) ; line(x+4,3)
+      elif kind==":|:": dots(x-5) ; line(x-1,3) ; line(x+2) ; dots(x+6)
+      else: line(x)
+  def arc(self,a,b):
+      # tie or slur from slot a to slot b (which may be on a later line)
+      if a.line==b.line: parts = [(a.x+3,b.x-3,a.line)]
+      else: parts = [(a.x+3,self.lines[a.line][2],a.line),(self.margin,b.x-3,b.line)]
+      for x1,x2,lineNo in parts:
+          y = self.lines[lineNo][0]
+          self.out.append('<path d="M%.1f %.1fQ%.1f %.1f %.1f %.1f"/>' % (x1,y,(x1+x2)/2.0,y-8,x2,y))
+  def hyphen(self,v,a,b):
+      y = self.lines[a.line][1]+18*v
+      if a.line==b.line: x = (a.x+b.x)/2.0
+      else: x = a.right
+      self.out.append(svg_text(x,y,"-","l"))
+
+svg_dynamic_re = re.compile(r"\\(p+|mp|mf|f+|fp|sf|sfz|rfz)$")
+def svg_key(word):
+    # e.g. 1=Bb -> 1=B flat
+    fig,note = word.split("=")
+    return fig+"="+note[0]+note[1:].replace("b",u"\u266d").replace("#",u"\u266f")
+def svg_tempo(word):
+    # e.g. 4=85 -> crotchet=85 (other units are left as they are)
+    unit,bpm = word.split("=")
+    sign = {"4":u"\u2669","8":u"\u266a"}.get(unit.rstrip("."))
+    if not sign: return word
+    return sign+unit[len(unit.rstrip(".")):]+"="+bpm
+def svg_markup(code):
+    # the text of \mark \markup{...}
+    text = code[len(r'\mark \markup{'):-1].replace(r"\flat",u"\u266d").replace(r"\sharp",u"\u266f")
+    return re.sub(r"\\[A-Za-z-]+","",text).strip()
+def svg_grace(notes):
+    return notes.replace("#",u"\u266f").replace("b",u"\u266d")
+def svg_text_width(text,charWidth):
+    # roughly, counting CJK as two characters
+    return sum(charWidth*(1+(ord(c)>=0x2e80)) for c in asUnicode(text))
+def svg_escape(text):
+    return asUnicode(text).replace("&","&amp;").replace("<","&lt;").replace(">","&gt;")
+def svg_text(x,y,text,cls):
+    return u'<text x="%.1f" y="%.1f" class="%s">%s</text>' % (x,y,cls,svg_escape(text))
+
+def lyric_syllables(lyrics):
+    # [(text,hyphen after)] from a lyrics string of parse_score,
+    # "" for a note skipped with _ (verse numbers go on the first)
+    lyrics = asUnicode(lyrics)
+    stanza = re.search(r'\\set stanza = #"([^"]*)"',lyrics)
+    lyrics = re.sub(r'''\\set stanza = #"[^"]*"|(\\once )?\\override LyricText #'self-alignment-X = #[A-Z]+''',"",lyrics)
+    r = []
+    for w in lyrics.split():
+        if w=="--":
+            if r: r[-1][1] = True
+        elif w=="_": r.append(["",False])
+        elif not w=="__": r.append([w.replace("_"," "),False])
+    if stanza and r: r[0][0] = stanza.group(1)+" "+r[0][0]
+    return [tuple(x) for x in r]
+
+svg_style = """<style>
+text { font-family: sans-serif; font-size: 13px }
+.n { font-size: 18px; font-weight: bold; text-anchor: middle }
+.a { font-weight: normal }
+.s { font-size: 11px }
+.g { font-size: 9px }
+.l { text-anchor: middle }
+.t { font-size: 20px; text-anchor: middle }
+.c { text-anchor: middle }
+.r { text-anchor: end }
+.d { font-style: italic }
+line, path { stroke: black }
+path { fill: none }
+</style>
+"""
+
+def svg_preview(file_or_lines,width=760,**options):
+    # An SVG picture (as a string) of the movements of the
+    # input one under another, drawn directly by SvgEmitter
+    # without LilyPond.  options are as for Converter.
+    converter = Converter(**options)
+    emitter = SvgEmitter(width) ; out = [] ; y = 0
+    for converter.scoreNo,converter.lineNo,score in split_movements(file_or_lines):
+        y = emitter(converter.parse_score(score),y,out)+12
+    return u'<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" viewBox="0 0 %d %d">\n' % (width,y,width,y) + svg_style + u"\n".join(out) + u"\n</svg>\n"
+
+all_targets = ["jianpu", # the jianpu staff (and its lyrics)
+               "western", # the 5-line staff, if WithStaff or no jianpu
+               "midi"] # the \midi score
+
+lyrics_spacing = r"""
+  % Might need to enforce a minimum spacing between systems, especially if lyrics are below the last staff in a system and numbers are on the top of the next
+  system-system-spacing = #'((basic-distance . 7) (padding . 5) (stretchability . 1e7))
+  score-markup-spacing = #'((basic-distance . 9) (padding . 5) (stretchability . 1e7))
+  score-system-spacing = #'((basic-distance . 9) (padding . 5) (stretchability . 1e7))
+  markup-system-spacing = #'((basic-distance . 2) (padding . 2) (stretchability . 0))
+"""
+
+class Converter(object):
+  # Converts jianpu text to LilyPond.  All the state of a
+  # conversion lives in here rather than in module globals, so
+  # separate Converter objects can be used in separate threads.
+  def __init__(self,**options):
+      # options: use_rest_hack, dashes_as_ties and stencil_noteheads
+      # (default to the module-level settings of the same names),
+      # stylesheet (name of a file of stylesheet_ly() to \include
+      # instead of writing the setup out in full, default None),
+      # targets (which of all_targets to write, default all), jobs (number
+      # of processes for converting movements, default 1),
+      # cache (a MovementCache, default None) and profile (a
+      # Profile to record timings and counts in, default None)
+      self.use_rest_hack = options.pop("use_rest_hack",use_rest_hack)
+      self.dashes_as_ties = options.pop("dashes_as_ties",dashes_as_ties)
+      self.stencil_noteheads = options.pop("stencil_noteheads",stencil_noteheads)
+      self.stylesheet = options.pop("stylesheet",None)
+      self.targets = sorted(options.pop("targets",all_targets))
+      self.jobs = options.pop("jobs",1)
+      self.cache = options.pop("cache",None)
+      self.profile = options.pop("profile",None)
+      if options: raise TypeError("Unknown Converter option(s): "+", ".join(sorted(options)))
+      for t in self.targets:
+          if not t in all_targets: raise ValueError("Unknown target: "+t)
+      assert not (self.use_rest_hack and not self.dashes_as_ties), "This combination has not been tested"
+      self.notehead_markup = notehead_markup(self)
+      self.scoreNo = self.tempCount = self.lyricsPtr = 0
+      self.lineNo = 1 # of the score being parsed
+      self.curLineNo = 1 # line being parsed (for messages)
+      self.diagnostics = None # list of Diagnostics while checking (see check)
+      self.has_lyrics = self.not_angka = False
+      self.maxBeams = 0
+      self.defines_done = {}
+  def error(self,msg,col=None):
+      # errExit, or if checking, record the error and carry on
+      if self.diagnostics is None: errExit(msg)
+      self.diagnostics.append(Diagnostic("error",msg,self.scoreNo,self.curLineNo,col,self.notehead_markup.barNo))
+  def warn(self,msg):
+      if self.diagnostics is None: sys.stderr.write("WARNING: "+msg+"\n")
+      else: self.diagnostics.append(Diagnostic("warning",msg,self.scoreNo,self.curLineNo,None,self.notehead_markup.barNo))
+  def options(self):
+      # what a worker process needs to make an equivalent Converter
+      return {"use_rest_hack":self.use_rest_hack,"dashes_as_ties":self.dashes_as_ties,"stencil_noteheads":self.stencil_noteheads,"stylesheet":self.stylesheet,"targets":self.targets}
+  def all_scores_start(self,staff_size = 20):
+      # staff_size is the 5-line size in points; jianpu is smaller
+      if self.stylesheet:
+          r = '\\version "2.18.0"\n\\include "%s"\n' % self.stylesheet
+          if self.has_lyrics: r += r"\paper {"+lyrics_spacing+"}\n"
+          return r
+      r = r"""\version "2.18.0"
+#(set-global-staff-size %d)""" % staff_size
+      r += r"""
+
+% un-comment the next line to remove Lilypond tagline:
+% \header { tagline="" }
+
+\pointAndClickOff
+
+\paper {
+  print-all-headers = ##t %% allow per-score headers
+
+  % un-comment the next line for A5:
+  % #(set-default-paper-size "a5" )
+
+  % un-comment the next line for no page numbers:
+  % print-page-number = ##f
+
+  % un-comment the next 3 lines for a binding edge:
+  % two-sided = ##t
+  % inner-margin = 20\mm
+  % outer-margin = 10\mm
+
+  % un-comment the next line for a more space-saving header layout:
+  % scoreTitleMarkup = \markup { \center-column { \fill-line { \magnify #1.5 { \bold { \fromproperty #'header:dedication } } \magnify #1.5 { \bold { \fromproperty #'header:title } } \fromproperty #'header:composer } \fill-line { \fromproperty #'header:instrument \fromproperty #'header:subtitle \smaller{\fromproperty #'header:subsubtitle } } } }"""
+      if os.path.exists("/Library/Fonts/Arial Unicode.ttf"): r += r"""
+  % As jianpu-ly was run on a Mac, we include a Mac fonts workaround.
+  % The Mac version of Lilypond 2.18 used Arial Unicode MS as a
+  % fallback even in the Serif font, but 2.20 drops this in Serif
+  % (using it only in Sans), which means any Serif text (titles,
+  % lyrics etc) that includes Chinese will likely fall back to
+  % Japanese fonts which don't support all Simplified hanzi.
+  % This brings back 2.18's behaviour on 2.20+:
+  #(define fonts
+    (set-global-fonts
+     #:roman "Times New Roman,Arial Unicode MS"
+     #:factor (/ staff-height pt 20)
+    ))
+"""
+      if self.has_lyrics: r += lyrics_spacing
+      return r+"\n}\n"
+
+  def score_start(self,midi=0,noBarNums=0):
+      ret = "\\score {\n"
+      if midi: ret += "\\unfoldRepeats\n"
+      ret += r"<< "
+      if not noBarNums and not midi and self.stylesheet: ret += r"\jianpuBarNumbers"
+      elif not noBarNums and not midi: ret += ("\\override Score.BarNumber #'break-visibility = #center-visible\n\\override Score.BarNumber #'Y-offset = -1\n\\set Score.barNumberVisibility = #(every-nth-bar-number-visible %d)" % bar_number_every)
+      return ret
+  def score_end(self,headers,midi=0,noBarNums=0):
+      ret = ">>\n"
+      if headers:
+          # since about Lilypond 2.7, music must come
+          # before the header block if it's per-score
+          ret += r"\header{"+'\n'
+          for k,v in headers.items(): ret+=k+'="'+v+'"\n'
+          ret += "}\n"
+      if midi: ret += r"\midi { \context { \Score tempoWholesPerMinute = #(ly:make-moment 84 4)}}" # will be overridden by any \tempo command used later
+      elif noBarNums: ret += r'\layout { \context { \Score \remove "Bar_number_engraver" } }'
+      else: ret += r"\layout{}"
+      return ret + " }"
+  def jianpu_voice_start(self,voiceName="tmp"):
+      stemLenFrac = "0" # unless overridden to 0.5 below
+      if voiceName=="tmp": # make it unique just in case
+          voiceName += str(self.tempCount) ; self.tempCount += 1
+      elif self.maxBeams >= 2: stemLenFrac = "0.5" # sometimes needed if the semiquavers occur in isolation rather than in groups (TODO do we need to increase this for 3+ beams in some cases?)
+      if self.not_angka: stemLenFrac=str(0.4+0.2*max(0,self.maxBeams-1))
+      r = (r"""\new Voice="%s" {"""%voiceName)+"\n"
+      if not self.stylesheet: return r+self.voice_setup(self.not_angka,stemLenFrac,self.stencil_noteheads)+"\n"
+      # the rest is in the stylesheet, with the stem length for
+      # maxBeams<2 (see stylesheet_ly below)
+      if self.not_angka: r += r"\notAngkaVoice" ; default = "0.4"
+      else: r += r"\jianpuVoice" ; default = "0"
+      if not stemLenFrac==default: r += r" \override Stem #'length-fraction = #"+stemLenFrac
+      if self.stencil_noteheads: r += "\n"+stencil_overrides(self.not_angka)
+      return r+"\n"
+  def voice_setup(self,notAngka,stemLenFrac,stencils):
+      # the overrides at the start of each jianpu voice
+      r = r"""
+    \override Beam #'transparent = ##f % (needed for LilyPond 2.18 or the above switch will also hide beams)
+    """
+      if notAngka:
+          r +=r"""
+        \override Stem #'direction = #UP
+        \override Tie #'staff-position = #-2.5
+        \tupletDown"""
+      else: r += r"""\override Stem #'direction = #DOWN
+    \override Tie #'staff-position = #2.5
+    \tupletUp"""+"\n"
+      r += (r"""
+    \override Stem #'length-fraction = #%s
+    \override Beam #'beam-thickness = #0.1
+    \override Beam #'length-fraction = #0.5
+    \override Voice.Rest #'style = #'neomensural %% this size tends to line up better (we'll override the appearance anyway)
+    \override Accidental #'font-size = #-4
+    \override TupletBracket #'bracket-visibility = ##t""" % stemLenFrac)
+      if stencils: r += "\n"+stencil_overrides(notAngka)
+      r += "\n"+r"""\set Voice.chordChanges = ##t %% 2.19 bug workaround""" # LilyPond 2.19.82: \applyOutput docs say "called for every layout object found in the context Context at the current time step" but 2.19.x breaks this by calling it for ALL contexts in the current time step, hence breaking our WithStaff by applying our jianpu numbers to the 5-line staff too.  Obvious workaround is to make our function check that the context it's called with matches our jianpu voice, but I'm not sure how to do this other than by setting a property that's not otherwise used, which we can test for in the function.  So I'm 'commandeering' the "chordChanges" property (there since at least 2.15 and used by Lilypond only when it's in chord mode, which we don't use, and if someone adds a chord-mode staff then it won't print noteheads anyway): we will substitute jianpu numbers for noteheads only if chordChanges = #t.
+      return r
+  def jianpu_staff_start(self,withStaff=False):
+      # (we add "BEGIN JIANPU STAFF" and "END JIANPU STAFF" comments to make it easier to copy/paste into other Lilypond files)
+      if self.not_angka: voiceName="notAngka"
+      else: voiceName="jianpu"
+      if self.stylesheet: # (see stylesheet_ly below)
+          r = "\n%% === BEGIN "+{0:"JIANPU",1:"NOT ANGKA"}[self.not_angka]+" STAFF ===\n    \\new RhythmicStaff \\with { \\"+voiceName+"Staff"
+          if withStaff: r += withStaff_spacing
+          return r+" }\n    { "+self.jianpu_voice_start(voiceName)+"    "
+      if self.not_angka: r=r"""
+%% === BEGIN NOT ANGKA STAFF ===
+    \new RhythmicStaff \with {"""
+      else: r=r"""
+%% === BEGIN JIANPU STAFF ===
+    \new RhythmicStaff \with {
+    \consists "Accidental_engraver" """
+      if withStaff: r+=withStaff_spacing
+      r+=staffless_setup+r"""
+    }
+    { """+self.jianpu_voice_start(voiceName)+r"""
+    \override Staff.TimeSignature #'style = #'numbered
+    \override Staff.Stem #'transparent = ##t
+    """
+      return r
+  def jianpu_staff_end(self):
+      # \bar "|." is added separately if there's not a DC etc
+      if self.not_angka: return "} }\n% === END NOT ANGKA STAFF ===\n"
+      else: return "} }\n% === END JIANPU STAFF ===\n"
+  def lyrics_start(self,voiceName="jianpu"):
+      self.lyricsPtr += 1
+      return r'\new Lyrics = "I%s" { \lyricsto "%s" { ' % (str(self.lyricsPtr).translate((letters*5)[:256]),voiceName)
+  def parse_score(self,score):
+     # Tokenise one movement and run the timing state machine
+     # over it.  Done once per movement: each staff is then
+     # written from the ScoreIR by its emitter.
+     ir = ScoreIR()
+     self.notehead_markup.initOneScore()
+     self.repeatStack = [] ; self.escaping = 0
+     prof = self.profile
+     if prof: tStart = clock() ; self.parseTimes = [0,0]
+     self.parse_lines(score.split("\n"),self.lineNo,ir)
+     self.end_score()
+     if prof:
+         prof.add("parse",self.scoreNo,tStart,parts=[("tokenize",self.parseTimes[0]),("lyrics",self.parseTimes[1])])
+         prof.count_score(self.scoreNo,ir,self.notehead_markup)
+     return ir
+  def parse_lines(self,lines,lineNo,ir):
+     # The lines of a movement from lineNo, for parse_score,
+     # carrying on from the timing state, self.repeatStack
+     # and self.escaping (IncrementalChecker sets these to
+     # check a movement a line at a time).
+     events = ir.events
+     notehead_markup = self.notehead_markup ; scoreNo = self.scoreNo
+     maxBeams = ir.maxBeams ; repeatStack = self.repeatStack ; escaping = self.escaping
+     prof = self.profile
+     if prof: tTok = tLyrics = 0
+     checking = self.diagnostics is not None
+     for lineNo,line in enumerate(lines,lineNo):
+      self.curLineNo = lineNo
+      col = len(line)-len(line.lstrip())+1 ; line = line.strip()
+      line=re.sub(r"^%%\s*tempo:\s*(\S+)\s*$",r"\1",line) # to provide an upgrade path for jihuan-tian's fork
+      if line.startswith("LP:"):
+          # Escaped LilyPond block.  Thanks to James Harkins for this suggestion.
+          # (Our internal barcheck does not understand code in LP blocks, so keep it to complete bars.)
+          # E.g. for multibar rests:
+          # LP:
+          # \compressFullBarRests \override MultiMeasureRest #'expand-limit = #1
+          # R1*5
+          # :LP
+          escaping = 1
+          if len(line)>3: events.append(('raw',line[3:]+"\n")) # remainder of current line
+      elif line.startswith(":LP"):
+          escaping = 0 # TODO: and process the rest of the line?  (assume on line of own for now)
+      elif escaping:
+          events.append(('raw',line+"\n"))
+      elif not line: pass
+      elif line.startswith("L:") or line.startswith("H:"):
+          # lyrics
+          if checking: continue # nothing to check
+          if prof: t0 = clock()
+          do_hanzi_spacing = line.startswith("H:")
+          line = line[2:].strip()
+          toAdd = ""
+          if line and '1' <= line[0] <= '9' and (line[1]=='.' or asUnicode(line)[1]==u"\uff0e"):
+              # a verse number
+              toAdd = r'\set stanza = #"%s." ' % line[:1]
+              if line[1]=='.': line=line[2:]
+              elif not type(line)==type(u""): line=line[4:] # for utf-8 full-width dot in Python 2
+              else: line = line[2:] # for full-width dot in Python 3
+              line = line.strip()
+          if do_hanzi_spacing: # this is not 100% perfect...
+              l2 = [r"\override LyricText #'self-alignment-X = #LEFT "] # for overhanging commas etc to work
+              if toAdd:
+                  l2.append(toAdd) ; toAdd = ""
+              needSpace = 0
+              for c in list(asUnicode(line)):
+                  if needSpace and (0x4e00 <= ord(c) < 0xa700 or c in u"\u2018\u201c"):
+                      l2.append(' ') ; needSpace = 0
+                      if c in u"\u2018\u201c":
+                          # we're just about to have an open quote - this needs to hang left.  Try:
+                          l2.append(r"\once \override LyricText #'self-alignment-X = #CENTER ") # or RIGHT if there's no punctuation after
+                  if 0x4e00 <= ord(c) < 0xa700: needSpace=1
+                  l2.append(c)
+              line = u"".join(l2)
+              if not type("")==type(u""): line = line.encode('utf-8') # Python 2
+          ir.lyrics.append(toAdd+re.sub("(?<=[^- ])- "," -- ",line).replace(" -- "," --\n"))
+          if prof: tLyrics += clock()-t0
+      elif re.match(r"\s*[A-Za-z]+\s*=",line):
+          # Lilypond header
+          hName,hValue = line.split("=",1)
+          ir.headers[hName.strip()] = hValue.strip()
+      else:
+          if prof: t0 = clock()
+          tokens = tokenize(line,lineNo,col)
+          if prof: tTok += clock()-t0
+          for t in tokens:
+              kind,word = t.kind,t.word
+              if kind=="note":
+                  figures,nBeams,dot,octave,accidental = t.value
+                  if checking:
+                      notehead_markup.time(figures,nBeams,dot,accidental)
+                      continue
+                  ir.need_final_barline = 1
+                  events.append(('note',notehead_markup(figures,nBeams,dot,octave,accidental)))
+                  if notehead_markup.notAngka and "'" in octave: maxBeams=max(maxBeams,len(octave)*.8+nBeams)
+                  else: maxBeams=max(maxBeams,nBeams)
+              elif kind=="tempo": events.append(('raw',r'\tempo '+word,'tempo',word)) # TODO: reduce size a little?
+              elif kind=="key": events.append(('key',word))
+              elif kind=="finger":
+                finger = str(word.split("=")[1])
+                finger = {"1": "–", "2": "=", "3": "≡", "4": "四"}.get(finger, finger)
+                events.append(('raw',r'\finger "%s"' % finger))
+              elif kind=="time": # time signature
+                  if ',' in word: # anacrusis
+                      word,anac = word.split(",",1)
+                  else: anac=""
+                  if notehead_markup.separateTimesig: events.append(('mark',r'\mark \markup{'+word+'}'))
+                  num,denom = word.split('/')
+                  events.append(('raw',r'\time '+word,'time',int(num),int(denom)))
+                  notehead_markup.setTime(int(num),int(denom))
+                  if anac:
+                      if anac.endswith("."): # e.g. 2.
+                          a2 = anac[:-1] ; anacDotted = 1
+                      else: a2,anacDotted = anac,0
+                      notehead_markup.setAnac(int(a2),anacDotted)
+                      events.append(('raw',r'\partial '+anac))
+              elif kind=="cmd":
+                  # Lilypond command, \p etc
+                  events.append(('cmd',word))
+              elif kind=="OnePage":
+                  if notehead_markup.onePage: self.warn("Duplicate OnePage, did you miss out a NextScore?")
+                  notehead_markup.onePage=1
+              elif kind=="NoBarNums":
+                  if notehead_markup.noBarNums: self.warn("Duplicate NoBarNums, did you miss out a NextScore?")
+                  notehead_markup.noBarNums=1
+              elif kind=="SeparateTimesig":
+                  if notehead_markup.separateTimesig: self.warn("Duplicate SeparateTimesig, did you miss out a NextScore?")
+                  notehead_markup.separateTimesig=1
+                  events.append(('raw',r"\override Staff.TimeSignature #'stencil = ##f"))
+              elif kind=="angka":
+                  if notehead_markup.notAngka: self.warn("Duplicate angka, did you miss out a NextScore?")
+                  notehead_markup.notAngka = True
+                  events.append(('angka',))
+              elif kind=="WithStaff":
+                  if notehead_markup.withStaff: self.warn("Duplicate WithStaff, did you miss out a NextScore?")
+                  notehead_markup.withStaff=1
+              elif kind=="volta":
+                  repeatStack.append((1,False))
+                  events.append(('raw',r'\repeat volta 2 {','volta'))
+              elif kind=="percent":
+                  times = int(word[1:-1])
+                  repeatStack.append((1,True))
+                  notehead_markup.startPercent(times)
+                  events.append(('raw',r'\repeat percent %d {' % times,'percent',times))
+              elif kind=="endRepeat":
+                  if not repeatStack:
+                      self.error("} without R{ or A{ in score %d (line %d column %d)" % (scoreNo,t.lineNo,t.col),t.col)
+                      continue
+                  numBraces,percent = repeatStack.pop()
+                  events.append(('raw',"}"*numBraces,'endRepeat'))
+                  if percent: notehead_markup.endPercent()
+              elif kind=="alternative":
+                  repeatStack.append((2,False))
+                  events.append(('raw',r'\alternative { {','alternative'))
+              elif kind=="nextAlternative":
+                  if not (repeatStack and repeatStack[-1][0]==2):
+                      self.warn("| should be in an A{ .. } block (scoreNo=%d barNo=%d)" % (scoreNo,notehead_markup.barNo))
+                  events.append(('raw',"} {",'nextAlternative'))
+              elif kind=="tuplet":
+                  # tuplet start, e.g. 3[
+                  fitIn = int(word[:-1])
+                  i=2
+                  while i<fitIn: i*=2
+                  if i==fitIn: num=int(fitIn*3/2)
+                  else: num=int(i/2)
+                  events.append(('raw',"\\times %d/%d {" % (num,fitIn)))
+                  notehead_markup.startTuplet(num,fitIn)
+              elif kind=="endTuplet":
+                  events.append(('raw',"}"))
+                  notehead_markup.endTuplet()
+              elif kind=="grace":
+                  events.append(('grace',word[2:-1],notehead_markup.withStaff))
+              elif kind=="aftergrace":
+                  events.append(('aftergrace',word[1:-2],notehead_markup.withStaff))
+              elif kind=="Fine":
+                  ir.need_final_barline = 0
+                  events.append(('raw',r'''\once \override Score.RehearsalMark #'break-visibility = #begin-of-line-invisible \once \override Score.RehearsalMark #'self-alignment-X = #RIGHT \mark "Fine" \bar "|."'''))
+              elif kind=="DC":
+                  ir.need_final_barline = 0
+                  events.append(('raw',r'''\once \override Score.RehearsalMark #'break-visibility = #begin-of-line-invisible \once \override Score.RehearsalMark #'self-alignment-X = #RIGHT \mark "D.C. al Fine" \bar "||"'''))
+              else: self.error(unrecognised_message(t,line,col,scoreNo),t.col)
+     ir.maxBeams = maxBeams ; self.escaping = escaping
+     if prof: self.parseTimes[0] += tTok ; self.parseTimes[1] += tLyrics
+  def end_score(self):
+     # checks at the end of a movement
+     notehead_markup,scoreNo = self.notehead_markup,self.scoreNo
+     if notehead_markup.barPos == 0 and notehead_markup.barNo == 1: self.error("No jianpu in score %d" % scoreNo)
+     if self.repeatStack: self.error("Unterminated repeat in score %d" % scoreNo)
+     if self.escaping: self.error("Unterminated LP: in score %d" % scoreNo)
+     notehead_markup.endScore() # perform checks
+     if self.diagnostics is not None and notehead_markup.withStaff and notehead_markup.separateTimesig: self.error("Use of both WithStaff and SeparateTimesig in the same piece is not yet implemented")
+  def getLY(self,score,midi=0,western=0):
+     # Parse and write just one staff.  process_input parses
+     # each score only once; this is for callers that want a
+     # single staff.
+     ir = self.parse_score("".join(normalise(line) for line in score.splitlines(True)))
+     if midi or western: out = StaffEmitter(self,midi,western)(ir)
+     else:
+         emitter = JianpuEmitter(self)
+         out = self.resolve(emitter(ir),self.not_angka)
+         prelude = self.prelude(emitter.defines)
+         if prelude: out = prelude+"\n"+out
+     lyrics = "".join(self.lyrics_start()+l+" "+lyrics_end()+" " for l in ir.lyrics)
+     return out,ir.maxBeams,lyrics,ir.headers
+  def resolve(self,out,notAngka):
+     # Fill in a jianpu staff's deferred parts (see DEFER),
+     # in document order, and join it up
+     def fill(m):
+         self.not_angka = bool(m.group(1))
+         return self.jianpu_voice_start()
+     out = join_ly([deferred_re.sub(fill,item) for item in out])
+     if notAngka: out=out.replace("make-bold-markup","make-simple-markup")
+     return out
+  def prelude(self,defines):
+     # The Scheme definitions from a JianpuEmitter that the
+     # document doesn't already have
+     r = []
+     if self.stylesheet: inStylesheet = dict(common_defines())
+     else: inStylesheet = {}
+     for key,code in defines:
+         if key not in self.defines_done:
+             self.defines_done[key] = True
+             if not inStylesheet.get(key)==code: r.append(code.rstrip())
+     if self.profile: self.profile.count(self.scoreNo,"defines",len(r))
+     return "\n".join(r)
+  def convert_movement(self,score):
+     # Parse one movement and write its staves.  Depends on
+     # nothing from earlier movements except scoreNo and lineNo
+     # (for messages), so can be run in a worker process (see
+     # convert_movement below).
+     r = MovementResult()
+     wordSet = set(score.split())
+     self.has_lyrics = r.has_lyrics = "L:" in wordSet or "H:" in wordSet # the occasional false positive doesn't matter: has_lyrics==False is only an optimisation
+     ir = self.parse_score(score)
+     r.withStaff = self.notehead_markup.withStaff
+     r.noBarNums = self.notehead_markup.noBarNums
+     if r.withStaff and self.notehead_markup.separateTimesig: self.error("Use of both WithStaff and SeparateTimesig in the same piece is not yet implemented")
+     prof = self.profile
+     if prof: t0 = clock()
+     self.not_angka = False # may be set by the emitter
+     targets = self.targets
+     if "jianpu" in targets:
+         emitter = JianpuEmitter(self)
+         r.jianpu = emitter(ir)
+         r.notAngka = self.not_angka
+         r.defines = emitter.defines
+         if r.notAngka: r.defines = [(key,code.replace("make-bold-markup","make-simple-markup")) for key,code in r.defines]
+         if prof: t0 = prof.add("jianpu",self.scoreNo,t0)
+     else: r.jianpu,r.notAngka,r.defines = None,False,[]
+     if "western" in targets and (r.withStaff or not r.jianpu):
+         r.western = StaffEmitter(self,western=1)(ir)
+         if prof: t0 = prof.add("western",self.scoreNo,t0)
+     else: r.western = None
+     self.not_angka = False
+     if "midi" in targets:
+         r.midi = StaffEmitter(self,midi=1)(ir)
+         if prof: prof.add("midi",self.scoreNo,t0)
+     else: r.midi = None
+     r.lyrics,r.headers,r.maxBeams = ir.lyrics,ir.headers,ir.maxBeams
+     return r
+  def convert_movements(self,scores):
+     # Yields the MovementResult of each (scoreNo,lineNo,score)
+     # in order.  scores can be an iterator: it is read a batch
+     # at a time (one at a time unless using several jobs).
+     pool = None
+     try:
+         batch = []
+         for item in scores:
+             batch.append(item)
+             if len(batch) < (self.jobs < 2 and 1 or self.jobs*4): continue
+             if self.jobs > 1 and not pool:
+                 import multiprocessing
+                 pool = multiprocessing.Pool(self.jobs)
+             for r in self.convert_batch(batch,pool): yield r
+             batch = []
+         for r in self.convert_batch(batch,pool): yield r
+     except:
+         if pool: pool.terminate()
+         raise
+     if pool: pool.close() ; pool.join()
+  def convert_batch(self,scores,pool):
+     if self.cache:
+         keys = [self.cache.key(score,self.options()) for _,_,score in scores]
+         results = [self.cache.get(k) for k in keys]
+         todo = [(i,scores[i]) for i in xrange(len(scores)) if results[i] is None]
+         if self.profile:
+             for (scoreNo,_,_),r in zip(scores,results):
+                 if r: self.profile.count(scoreNo,"cached")
+         for (i,_),r in zip(todo,self.convert_uncached([s for _,s in todo],pool)):
+             self.cache.put(keys[i],r) ; results[i] = r
+         return results
+     return self.convert_uncached(scores,pool)
+  def convert_uncached(self,scores,pool):
+     if not pool or len(scores) < 2:
+         r = []
+         for self.scoreNo,self.lineNo,score in scores:
+             r.append(self.convert_movement(score))
+         return r
+     jobs = [item+(self.options(),) for item in scores]
+     if self.profile:
+         r = []
+         for result,profile in pool.map(profiled_convert_movement,jobs,1):
+             self.profile.merge(profile) ; r.append(result)
+         return r
+     return pool.map(convert_movement,jobs,1)
+  def iter_process(self,file_or_lines):
+   # Yields the LilyPond code a movement at a time, reading
+   # the input (a file, an iterable of lines or a string)
+   # only as far as needed
+   return self.assemble(self.convert_movements(split_movements(file_or_lines,self.profile)))
+  def iter_parts(self,file_or_lines):
+   # Like iter_process, but yields each movement's parts
+   # separately (see parts)
+   for self.scoreNo,r in enumerate(self.convert_movements(split_movements(file_or_lines,self.profile)),1):
+       yield self.parts(r)
+  def parts(self,r):
+   # The LilyPond code of a MovementResult as a dict: the
+   # "jianpu", "western" and "midi" staves (None if not in
+   # targets), "lyrics" (a list of Lyrics contexts), "defines"
+   # (Scheme code the jianpu staff needs that this Converter
+   # hasn't already given) and "headers"
+   p = {"headers":r.headers,"western":None,"midi":None}
+   p["defines"] = self.prelude(r.defines)
+   if r.jianpu is None: p["jianpu"] = None
+   else:
+       out = self.resolve(r.jianpu,r.notAngka)
+       self.maxBeams = r.maxBeams # (after resolve: any rest-hack voices it started used the previous score's)
+       self.not_angka = r.notAngka
+       p["jianpu"] = self.jianpu_staff_start(r.withStaff)+" "+out+" "+self.jianpu_staff_end()
+   if r.jianpu is None and r.western is None: p["lyrics"] = []
    else:
-       ret.append(jianpu_staff_start(notehead_markup.withStaff)+" "+out+" "+jianpu_staff_end())
-       if notehead_markup.withStaff:
-           western=True ; ret.append(western_staff_start()+" "+getLY(score)[0]+" "+western_staff_end()) ; western = False
-           lyrics = lyrics.replace(r'\lyricsto "jianpu"',r'\lyricsto "5line"')
-       if lyrics: ret.append(lyrics)
-   ret.append(score_end(**headers))
- return "".join(r+"\n" for r in ret)
+       p["lyrics"] = [self.lyrics_start()+l+" "+lyrics_end()+" " for l in r.lyrics]
+       self.lyricsPtr += len(r.lyrics)*(1+r.withStaff) # keep the names the one-pass-per-staff code gave
+   if r.western is not None:
+       p["western"] = western_staff_start(stylesheet=self.stylesheet)+" "+r.western+" "+western_staff_end()
+       p["lyrics"] = [l.replace(r'\lyricsto "jianpu"',r'\lyricsto "5line"') for l in p["lyrics"]]
+   if r.midi is not None: p["midi"] = midi_staff_start()+" "+r.midi+" "+midi_staff_end()
+   return p
+  def assemble(self,results):
+   # Yields the LilyPond code of each MovementResult, as
+   # the movements of a document
+   prof = self.profile
+   for self.scoreNo,r in enumerate(results,1):
+    if prof: t0 = clock()
+    ret = []
+    if self.scoreNo==1:
+        self.has_lyrics = r.has_lyrics
+        ret.append(self.all_scores_start()) # not before here, so as not to confuse beginners who don't input a valid score 1
+    p = self.parts(r)
+    if p["defines"]: ret.append(p["defines"])
+    if p["jianpu"] or p["western"]:
+        ret.append(self.score_start(0,r.noBarNums))
+        ret += [p[k] for k in ["jianpu","western"] if p[k]]
+        if p["lyrics"]: ret.append("".join(p["lyrics"]))
+        ret.append(self.score_end(r.headers,0,r.noBarNums))
+    if p["midi"]:
+        ret.append(self.score_start(1,r.noBarNums))
+        ret.append(p["midi"])
+        ret.append(self.score_end(r.headers,1,r.noBarNums))
+    ret = "".join(r+"\n" for r in ret)
+    if prof:
+        prof.add("assemble",self.scoreNo,t0)
+        prof.count(self.scoreNo,"output_bytes",len(asUnicode(ret).encode("utf-8")))
+    yield ret
+  def process_input(self,inDat):
+   return "".join(self.iter_process(inDat))
+  def check(self,file_or_lines):
+   # Check the input without converting it: only the timing
+   # and syntax are looked at, and after an error we carry
+   # on from the next bar (or movement).  Returns a list of
+   # Diagnostics, empty if all is well.
+   self.diagnostics = []
+   try:
+       for self.scoreNo,self.lineNo,score in split_movements(file_or_lines,self.profile):
+           self.curLineNo = self.lineNo
+           self.parse_score(score)
+       return self.diagnostics
+   finally: self.diagnostics = None
+
+def common_defines():
+    # (key,Scheme code) of the notehead definitions that most
+    # jianpu staves need: single figures and dashes, and the
+    # stencil_noteheads procedures
+    emitter = JianpuEmitter(Converter())
+    emitter.defines_done,emitter.defines = {},[("jianpu-noteheads",jianpuNoteheads_define)]
+    for figures in list("01234567-")+["-"+f for f in "1234567"]:
+        n = NoteIR() ; n.figures,n.accidental = figures,""
+        n.name = "".join(figure_names[f] for f in figures)
+        emitter.define(n)
+    return emitter.defines
+
+def stylesheet_ly():
+    # The fixed setup of the document and its staves, for
+    # Converter(stylesheet=...) documents to \include (written
+    # to the stylesheet file by convert_files)
+    converter = Converter()
+    r = [converter.all_scores_start()]
+    r += [code.rstrip() for _,code in common_defines()]
+    r.append("jianpuBarNumbers = {"+converter.score_start()[len("\\score {\n<< "):]+"\n}\n")
+    for name,notAngka,stemLenFrac in [("jianpu",0,"0"),("notAngka",1,"0.4")]:
+        r.append(name+"Voice = {"+converter.voice_setup(notAngka,stemLenFrac,False)+"\n}\n")
+        if notAngka: consists = ""
+        else: consists = '\n    \\consists "Accidental_engraver"'
+        r.append(name+"Staff = \\with {"+consists+staffless_setup+r"""
+    \override TimeSignature #'style = #'numbered
+    \override Stem #'transparent = ##t
+}
+""")
+    western = western_staff_start("").split("\n")
+    r.append("westernVoice = {\n"+"\n".join(l for l in western[3:] if not "new Voice" in l)+"}\n")
+    return "\n".join(r)
+
+class MovementResult(object):
+    # The staves of one movement, as made by
+    # Converter.convert_movement, waiting to be assembled
+    __slots__ = ["has_lyrics","withStaff","noBarNums","notAngka",
+                 "jianpu", # list for Converter.resolve
+                 "defines", # for Converter.prelude
+                 "western", # or None if not WithStaff
+                 "midi","lyrics","headers","maxBeams"]
+
+class Diagnostic(object):
+    # An error or warning found by Converter.check
+    __slots__ = ["severity", # "error" or "warning"
+                 "message","scoreNo",
+                 "lineNo","col", # 1-based (col is None if not known)
+                 "barNo"]
+    def __init__(self,severity,message,scoreNo,lineNo,col,barNo):
+        self.severity,self.message,self.scoreNo = severity,message,scoreNo
+        self.lineNo,self.col,self.barNo = lineNo,col,barNo
+    def moved(self,lines):
+        # the same problem, lines further down the input
+        if not lines: return self
+        message = self.message.replace("(line %d column" % self.lineNo,"(line %d column" % (self.lineNo+lines))
+        return Diagnostic(self.severity,message,self.scoreNo,self.lineNo+lines,self.col,self.barNo)
+    def __str__(self):
+        if self.col: where = "%d:%d" % (self.lineNo,self.col)
+        else: where = str(self.lineNo)
+        return "%s: %s (bar %d): %s" % (where,self.severity,self.barNo,self.message)
+
+class CheckedSegment(object):
+    # A line of input as IncrementalChecker last checked it
+    # (or part of a line, if NextScore is in the middle of it)
+    __slots__ = ["lineNo","text", # text is normalised
+                 "starts", # the first of a movement
+                 "scoreNo", # number of its movement (or of the one before, if its own is blank)
+                 "blank", # its movement is blank (and skipped, as in split_movements)
+                 "state", # parse state before it (see IncrementalChecker.state)
+                 "diagnostics", # found in it
+                 "end"] # found at the end of the movement, if it's the last of one (else None)
+    def moved(self,lines):
+        if not lines: return self
+        s = CheckedSegment()
+        s.lineNo,s.text,s.starts,s.scoreNo,s.blank,s.state = self.lineNo+lines,self.text,self.starts,self.scoreNo,self.blank,self.state
+        s.diagnostics = [d.moved(lines) for d in self.diagnostics]
+        if self.end is None: s.end = None
+        else: s.end = [d.moved(lines) for d in self.end]
+        return s
+
+class IncrementalChecker(object):
+  # Converter.check for a document that is being edited (see
+  # LanguageServer).  The parse state before each line is
+  # kept, so after an edit, checking starts again at the
+  # first changed line and stops at the first unchanged line
+  # after it with the same state before it as last time (bar
+  # position, accidentals, repeats etc: usually a line or two
+  # later), keeping what was found from there on.
+  def __init__(self,**options):
+      self.converter = Converter(**options)
+      self.segments = []
+      self.normalised = {} # line -> normalise(line)
+      self.reparsed = 0 # segments checked by the last update
+  def state(self):
+      c = self.converter
+      return (c.notehead_markup.state(),tuple(c.repeatStack),c.escaping)
+  def set_state(self,state):
+      c = self.converter
+      c.notehead_markup.set_state(state[0])
+      c.repeatStack,c.escaping = list(state[1]),state[2]
+  def split(self,text):
+      # CheckedSegments of text (not yet checked): the
+      # movements split_movements would give, split into
+      # lines as parse_score would
+      normalised = self.normalised
+      if len(normalised) > 20000: normalised.clear()
+      lines = []
+      for line in text.splitlines(True):
+          n = normalised.get(line)
+          if n is None: n = normalised[line] = normalise(line)
+          lines.append(n)
+      segs = [] ; scoreNo = 0
+      for lineNo,score in movement_texts(lines):
+          blank = not score.strip()
+          if not blank: scoreNo += 1
+          for i,piece in enumerate(score.split("\n")):
+              s = CheckedSegment() ; segs.append(s)
+              s.lineNo,s.text,s.starts,s.scoreNo,s.blank = lineNo+i,piece,not i,scoreNo,blank
+      return segs
+  def update(self,text):
+      # Checks the new text of the document, returns all its Diagnostics
+      old,new = self.segments,self.split(text)
+      same = lambda a,b: a.text==b.text and a.starts==b.starts and a.scoreNo==b.scoreNo and a.blank==b.blank
+      n = min(len(old),len(new)) ; p = s = 0
+      while p < n and same(old[p],new[p]) and old[p].lineNo==new[p].lineNo: p += 1
+      while s < n-p and same(old[-1-s],new[-1-s]): s += 1
+      if p: p -= 1 # (its movement might now end somewhere else)
+      new[:p] = old[:p]
+      c = self.converter ; c.diagnostics = diagnostics = []
+      self.reparsed = 0
+      try:
+          j = p
+          while j < len(new):
+              seg = new[j]
+              if seg.blank: seg.state,seg.diagnostics,seg.end = None,[],None
+              else:
+                  c.scoreNo = seg.scoreNo
+                  if seg.starts:
+                      c.notehead_markup.initOneScore()
+                      c.repeatStack = [] ; c.escaping = 0
+                  elif j==p: self.set_state(old[p].state)
+                  seg.state = self.state()
+                  c.parse_lines([seg.text],seg.lineNo,ScoreIR())
+                  seg.diagnostics = diagnostics[:] ; del diagnostics[:]
+                  if j+1==len(new) or new[j+1].starts:
+                      c.end_score()
+                      seg.end = diagnostics[:] ; del diagnostics[:]
+                  else: seg.end = None
+              self.reparsed += 1 ; j += 1
+              o = j-len(new)+len(old) # the same line in old, if j is in the unchanged end
+              if j < len(new) and j >= len(new)-s and (new[j].starts or new[j].blank or self.state()==old[o].state):
+                  new[j:] = [seg.moved(new[j].lineNo-old[o].lineNo) for seg in old[o:]]
+                  break
+      finally: c.diagnostics = None
+      self.segments = new
+      r = []
+      for seg in new:
+          r += seg.diagnostics
+          if seg.end: r += seg.end
+      return r
+
+def convert_movement(job):
+    # Worker for Converter(jobs=N): convert one movement
+    scoreNo,lineNo,score,options = job
+    converter = Converter(**options)
+    converter.scoreNo,converter.lineNo = scoreNo,lineNo
+    return converter.convert_movement(score)
+
+def profiled_convert_movement(job):
+    # convert_movement for Converter(jobs=N,profile=...):
+    # also returns the worker's Profile, to be merged
+    scoreNo,lineNo,score,options = job
+    converter = Converter(profile=Profile(),**options)
+    converter.scoreNo,converter.lineNo = scoreNo,lineNo
+    return converter.convert_movement(score),converter.profile
+
+class Profile(object):
+    # Wall-clock times of the phases of a conversion, per
+    # movement, and counts of what was converted.  Give one to
+    # Converter(profile=...) or process_input, or use --profile.
+    # Without one, the Converter only tests self.profile at the
+    # start and end of each phase.
+    # Phases: read (and normalise the input), tokenize, lyrics
+    # (L: and H: lines), timing (the rest of parsing, mostly
+    # the notehead_markup state machine), jianpu, western and
+    # midi (writing each staff), assemble (putting a movement
+    # into the document), and write (for --profile only).
+    def __init__(self):
+        self.start = clock()
+        self.events = [] # [phase,scoreNo,start,duration,pid,parts]
+        self.counters = {} # scoreNo -> {name: count}
+        self.pending = {} # phase -> seconds, see timed
+    def add(self,phase,scoreNo,start,duration=None,parts=None):
+        # record a phase that started at start (a clock()
+        # value) and ended now (or lasted duration); parts is
+        # [(phase,seconds)] of phases within it, the rest of
+        # it being "timing".  Returns the end time.
+        end = clock()
+        if duration is None: duration = end-start
+        self.events.append([phase,scoreNo,start,duration,os.getpid(),parts])
+        return end
+    def timed(self,phase,iterable):
+        # iterates, adding the time taken to self.pending
+        # until add_pending is called
+        it = iter(iterable)
+        while True:
+            t0 = clock()
+            try: item = next(it)
+            except StopIteration: return
+            self.pending[phase] = self.pending.get(phase,0)+clock()-t0
+            yield item
+    def add_pending(self,phase,scoreNo):
+        duration = self.pending.pop(phase,0)
+        self.add(phase,scoreNo,clock()-duration,duration)
+    def count(self,scoreNo,name,n=1):
+        c = self.counters.setdefault(scoreNo,{})
+        c[name] = c.get(name,0)+n
+    def count_score(self,scoreNo,ir,notehead_markup):
+        for e in ir.events:
+            if e[0]=='note':
+                n = e[1]
+                if n.figures[0] in "0-": continue # rest or dash
+                self.count(scoreNo,"notes")
+                if len(n.chord)>1: self.count(scoreNo,"chords")
+            elif e[0] in ['grace','aftergrace']: self.count(scoreNo,"grace_notes",len(re.findall("[1-9]",e[1])))
+        self.count(scoreNo,"bars",notehead_markup.barNo-(notehead_markup.barPos==0))
+    def merge(self,other):
+        # add a worker process's Profile
+        self.events += other.events
+        for scoreNo,c in other.counters.items():
+            for name,n in c.items(): self.count(scoreNo,name,n)
+    def peak_memory(self):
+        # bytes, of this process or any of its workers
+        try: import resource
+        except ImportError: return None # not on Windows
+        r = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        if sys.platform=="darwin": return r
+        return r*1024 # (Linux gives KiB)
+    def phases(self,event):
+        # [(phase,seconds)] of an event, with parts split out
+        phase,scoreNo,start,duration,pid,parts = event
+        if not parts: return [(phase,duration)]
+        return parts+[("timing",duration-sum(d for _,d in parts))]
+    def report(self):
+        # a dict for JSON: totals, and per movement
+        phases,movements,totals = {},{},{}
+        for e in self.events:
+            m = movements.setdefault(e[1],{"seconds":{}})
+            for phase,d in self.phases(e):
+                phases[phase] = phases.get(phase,0)+d
+                if e[1]: m["seconds"][phase] = m["seconds"].get(phase,0)+d
+        for scoreNo,c in self.counters.items():
+            movements.setdefault(scoreNo,{"seconds":{}})["counters"] = c
+            for name,n in c.items(): totals[name] = totals.get(name,0)+n
+        movements.pop(None,None) # (phases not of a movement)
+        return {"wall_seconds":clock()-self.start,
+                "phases":phases,"counters":totals,
+                "peak_memory_bytes":self.peak_memory(),
+                "movements":[dict(m,score=scoreNo) for scoreNo,m in sorted(movements.items())]}
+    def trace(self):
+        # a dict for JSON in Chrome's trace event format
+        # (chrome://tracing or https://ui.perfetto.dev)
+        r = []
+        for e in self.events:
+            phase,scoreNo,start,duration,pid,parts = e
+            args = {"score":scoreNo}
+            if parts: args.update(self.phases(e))
+            r.append({"name":phase,"cat":"jianpu-ly","ph":"X","pid":pid,"tid":pid,
+                      "ts":round((start-self.start)*1e6,3),"dur":round(duration*1e6,3),"args":args})
+        return {"traceEvents":r,"displayTimeUnit":"ms"}
+
+class MovementCache(object):
+    # Directory of MovementResults keyed by a hash of the
+    # movement's text, the options and this program's code.
+    # A MovementResult does not depend on the movement's
+    # position in the document (see DEFER), so it can be
+    # reused anywhere.  When the files total more than
+    # max_bytes, the least recently used are removed.
+    # The total is counted once, then kept up to date by put
+    # (so other processes' files are noticed at the next evict).
+    def __init__(self,directory,max_bytes=100*1024*1024):
+        self.directory,self.max_bytes = directory,max_bytes
+        if not os.path.isdir(directory): os.makedirs(directory)
+        self.code_hash = None
+        self.evict() # sets self.total
+    def key(self,score,options):
+        import hashlib
+        if not self.code_hash:
+            self.code_hash = hashlib.sha256(open(__file__.replace(".pyc",".py"),"rb").read()).hexdigest()
+        text = repr((self.code_hash,sorted(options.items()),asUnicode(score.strip())))
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+    def get(self,key):
+        import json
+        fname = os.path.join(self.directory,key+".json")
+        try: d = json.load(open(fname))
+        except (IOError,OSError,ValueError): return None # missing or damaged
+        os.utime(fname,None) # mark as recently used
+        r = MovementResult()
+        for k in MovementResult.__slots__: setattr(r,k,d[k])
+        return r
+    def put(self,key,r):
+        import json
+        fname = os.path.join(self.directory,key+".json")
+        tmpName = "%s.%d.tmp" % (fname,os.getpid())
+        f = open(tmpName,"w")
+        json.dump(dict((k,getattr(r,k)) for k in MovementResult.__slots__),f)
+        f.close()
+        try: self.total -= os.path.getsize(fname) # replacing it
+        except OSError: pass
+        self.total += os.path.getsize(tmpName)
+        os.rename(tmpName,fname) # (atomic, so other processes never see partial files)
+        if self.total > self.max_bytes: self.evict()
+    def evict(self):
+        files = []
+        for f in os.listdir(self.directory):
+            if not f.endswith(".json"): continue
+            try: st = os.stat(os.path.join(self.directory,f))
+            except OSError: continue # removed by another process
+            files.append((st.st_mtime,st.st_size,f))
+        total = sum(size for _,size,_ in files)
+        for _,size,f in sorted(files):
+            if total <= self.max_bytes: break
+            try: os.remove(os.path.join(self.directory,f))
+            except OSError: pass
+            total -= size
+        self.total = total
+
+def lines_of(file_or_lines):
+    if type(file_or_lines) in [type(""),type(u"")]:
+        return file_or_lines.splitlines(True)
+    return file_or_lines
+
+def split_movements(file_or_lines,profile=None):
+    # Yields (scoreNo,lineNo,score) for each movement of the
+    # input (see lines_of), reading only as far as needed
+    lines = (normalise(line) for line in lines_of(file_or_lines))
+    if profile: lines = profile.timed("read",lines)
+    scoreNo = 0
+    for lineNo,score in movement_texts(lines):
+        if score.strip():
+            scoreNo += 1
+            if profile: profile.add_pending("read",scoreNo)
+            yield scoreNo,lineNo,score
+
+def movement_texts(lines):
+    # Yields (lineNo,text) for each movement of the normalised
+    # lines (with their line endings), blank ones included
+    lineNo,rest = 1," "
+    for line in itertools.chain(lines,[None]):
+        if line is None: rest += " " # end of input
+        elif "NextScore" in line: rest += line
+        else:
+            rest += line ; continue
+        parts = re.split(r"(\sNextScore\s)",rest)
+        if line is None: parts += ["",""]
+        rest = parts.pop() # (might not be complete)
+        for i in xrange(0,len(parts),2):
+            yield lineNo,parts[i]
+            lineNo += parts[i].count("\n")+parts[i+1].count("\n")
+
+def iter_process(file_or_lines,jobs=1,cache=None,profile=None,targets=all_targets):
+    # Like process_input, but yields the result a movement
+    # at a time (so the whole document need not be in memory)
+    return Converter(jobs=jobs,cache=cache,profile=profile,targets=targets).iter_process(file_or_lines)
+
+def process_input(inDat,jobs=1,cache=None,profile=None,targets=all_targets):
+    # Convert a whole document using a fresh Converter.
+    # Safe to call from several threads at once.
+    # jobs>1 converts movements in that many processes;
+    # cache is a MovementCache to reuse unchanged movements;
+    # profile is a Profile to record timings and counts in;
+    # targets are the parts to write (see all_targets).
+    return Converter(jobs=jobs,cache=cache,profile=profile,targets=targets).process_input(inDat)
+
+def iter_parts(file_or_lines,**options):
+    # Yields a dict of the parts of each movement (see
+    # Converter.parts), for callers that put them together
+    # themselves
+    return Converter(**options).iter_parts(file_or_lines)
+
+def check(file_or_lines,**options):
+    # Returns the Diagnostics of the input (see Converter.check)
+    return Converter(**options).check(file_or_lines)
+
+def output_filename(inFile,outDir=None):
+    outFile = os.path.splitext(inFile)[0]+".ly"
+    if outDir: outFile = os.path.join(outDir,os.path.basename(outFile))
+    return outFile
+
+def convert_file(job):
+    # Batch-mode worker: convert one file to one .ly file.
+    # Returns None, or the error message if it failed.
+    inFile,outFile,options = job
+    try:
+        if os.path.abspath(inFile)==os.path.abspath(outFile): errExit("Would overwrite input file")
+        if options.get("stylesheet"): return write_compact(read_input_file(inFile),outFile,options)
+        out = Converter(**options).process_input(read_input_file(inFile))
+        write_output(outFile,out)
+    except JianpuError as e: return str(e)
+    except Exception as e: return "%s: %s" % (e.__class__.__name__,e) # (probably a bug in jianpu-ly)
+
+def write_compact(inDat,outFile,options):
+    # Batch mode with a stylesheet: song.ly just \includes
+    # song-1.ly, song-2.ly etc, each a complete document of
+    # one movement, so they can also be run separately
+    base = os.path.splitext(outFile)[0] ; names = []
+    for scoreNo,ly in movement_documents(inDat,**options):
+        name = "%s-%d.ly" % (base,scoreNo)
+        write_output(name,ly) ; names.append(os.path.basename(name))
+    write_output(outFile,'\\version "2.18.0"\n'+"".join('\\include "%s"\n' % n for n in names))
+
+def write_output(outFile,out):
+    # Write out as print() would, replacing any old outFile
+    # atomically so readers never see a partial file
+    import io
+    tmpName = "%s.%d.tmp" % (outFile,os.getpid())
+    f = io.open(tmpName,"w",encoding="utf-8") # (Python 2's open has no encoding)
+    f.write(asUnicode(out)+u"\n") ; f.close()
+    replace_file(tmpName,outFile)
+
+def replace_file(src,dest):
+    if hasattr(os,"replace"): os.replace(src,dest)
+    else: os.rename(src,dest) # Python 2 (not atomic on Windows)
+
+def convert_files(inFiles,outDir=None,jobs=None,**options):
+    # Convert each input file to its own .ly file, using a
+    # pool of jobs worker processes (default: one per CPU).
+    # Yields (inFile,outFile,error or None) in input order.
+    # An error in one file does not stop the others.
+    # With a stylesheet option (see Converter), it's written
+    # to each output directory and each file is written as
+    # a .ly per movement (see write_compact).
+    if outDir and not os.path.isdir(outDir): os.makedirs(outDir)
+    work = [(f,output_filename(f,outDir),options) for f in inFiles]
+    if options.get("stylesheet"):
+        for d in set(os.path.dirname(outFile) for _,outFile,_ in work):
+            write_output(os.path.join(d,options["stylesheet"]),stylesheet_ly())
+    import multiprocessing
+    if jobs is None: jobs = multiprocessing.cpu_count()
+    if jobs < 2 or len(work) < 2:
+        for job in work: yield job[0],job[1],convert_file(job)
+        return
+    pool = multiprocessing.Pool(min(jobs,len(work)))
+    try:
+        for job,err in zip(work,pool.imap(convert_file,work,max(1,len(work)//(jobs*4)))):
+            yield job[0],job[1],err
+    finally:
+        pool.close() ; pool.join()
+
+def movement_documents(file_or_lines,**options):
+    # Yields (scoreNo,ly) for each movement of the input,
+    # where ly is a complete LilyPond document of just that
+    # movement, not depending on the other movements
+    for scoreNo,lineNo,score in split_movements(file_or_lines):
+        converter = Converter(**options)
+        converter.scoreNo,converter.lineNo = scoreNo,lineNo
+        yield scoreNo,"".join(converter.assemble([converter.convert_movement(score)]))
+
+class RenderCache(object):
+    # Directory of LilyPond's output files (PDF, MIDI) for
+    # each movement, keyed by a hash of its LilyPond code.
+    # key.json lists a movement's files once they're all in.
+    def __init__(self,directory):
+        self.directory = directory
+        if not os.path.isdir(directory): os.makedirs(directory)
+    def key(self,ly):
+        import hashlib
+        return hashlib.sha256(asUnicode(ly).encode("utf-8")).hexdigest()
+    def get(self,key):
+        # the paths of key's files, or None
+        import json
+        try: files = json.load(open(os.path.join(self.directory,key+".json")))
+        except (IOError,OSError,ValueError): return None
+        files = [os.path.join(self.directory,f) for f in files]
+        for f in files:
+            if not os.path.exists(f): return None
+        return files
+
+def render_movement(job):
+    # Worker for render_files: run LilyPond on one movement's
+    # code and put its output in the RenderCache directory.
+    # Returns None, or the error message if it failed.
+    lilypond,ly,key,cacheDir = job
+    import tempfile,subprocess,shlex,shutil,json,io
+    tmpDir = os.path.abspath(tempfile.mkdtemp(dir=cacheDir)) # (LilyPond is run in it)
+    try:
+        lyFile = os.path.join(tmpDir,key+".ly")
+        f = io.open(lyFile,"w",encoding="utf-8") ; f.write(asUnicode(ly)) ; f.close()
+        cmd = shlex.split(lilypond,posix=not os.name=="nt")+["-o",os.path.join(tmpDir,key),lyFile]
+        try: p = subprocess.Popen(cmd,cwd=tmpDir,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+        except OSError as e: return "Could not run %s: %s" % (lilypond,e)
+        log = p.communicate()[0].decode("utf-8","replace")
+        if p.returncode: return "%s failed (exit status %d):\n%s" % (lilypond,p.returncode,log[-2000:].strip())
+        made = sorted(f for f in os.listdir(tmpDir) if f.startswith(key+".") and not os.path.splitext(f)[1] in [".ly",".log"])
+        if not made: return "%s wrote no output files" % lilypond
+        for f in made: replace_file(os.path.join(tmpDir,f),os.path.join(cacheDir,f))
+        listFile = os.path.join(tmpDir,key+".json")
+        json.dump(made,open(listFile,"w")) ; replace_file(listFile,os.path.join(cacheDir,key+".json"))
+    finally: shutil.rmtree(tmpDir,ignore_errors=True)
+
+def render_files(inFiles,outDir=None,jobs=None,lilypond="lilypond",cacheDir=None,**options):
+    # Convert each input file and run LilyPond on it, a job per
+    # movement, using a pool of jobs worker processes (default:
+    # one per CPU).  LilyPond's output for each movement is kept
+    # in a RenderCache in cacheDir (default: .jianpu-ly-render
+    # in outDir), so it is only run for movements that changed.
+    # song.txt gives song.pdf and song.midi, or song-1.pdf,
+    # song-1.midi, song-2.pdf etc if it has several movements.
+    # Yields (inFile,[output files],error or None) in input order.
+    if outDir and not os.path.isdir(outDir): os.makedirs(outDir)
+    cache = RenderCache(cacheDir or os.path.join(outDir or ".",".jianpu-ly-render"))
+    docs,todo = [],{} # todo: key -> ly
+    for inFile in inFiles:
+        outBase = os.path.splitext(output_filename(inFile,outDir))[0]
+        try:
+            keys = []
+            for _,ly in movement_documents(read_input_file(inFile),**options):
+                key = cache.key(ly) ; keys.append(key)
+                if cache.get(key) is None: todo[key] = ly
+            docs.append((inFile,outBase,keys,None))
+        except JianpuError as e: docs.append((inFile,outBase,[],str(e)))
+    work = [(lilypond,ly,key,cache.directory) for key,ly in todo.items()]
+    import multiprocessing
+    if jobs is None: jobs = multiprocessing.cpu_count()
+    if jobs < 2 or len(work) < 2: errors = [render_movement(job) for job in work]
+    else:
+        pool = multiprocessing.Pool(min(jobs,len(work)))
+        try: errors = pool.map(render_movement,work,1)
+        finally: pool.close() ; pool.join()
+    errors = dict((job[2],err) for job,err in zip(work,errors))
+    import shutil
+    for inFile,outBase,keys,err in docs:
+        outFiles = []
+        for scoreNo,key in enumerate(keys,1):
+            if err: break
+            if errors.get(key):
+                err = "LilyPond error in score %d: %s" % (scoreNo,errors[key]) ; break
+            for f in cache.get(key):
+                if len(keys) > 1: outFile = "%s-%d%s" % (outBase,scoreNo,os.path.splitext(f)[1])
+                else: outFile = outBase+os.path.splitext(f)[1]
+                shutil.copyfile(f,outFile+".tmp") ; replace_file(outFile+".tmp",outFile)
+                outFiles.append(outFile)
+        yield inFile,outFiles,err
+
+class PreviousVersion(object):
+    # Cache for watch mode: the MovementResults of the last
+    # version of a file, by movement text, so a new version
+    # reconverts only the movements that differ
+    def __init__(self):
+        self.results,self.used,self.changed = {},{},0
+    def key(self,score,options): return score.strip()
+    def get(self,key):
+        r = self.results.get(key)
+        if r: self.used[key] = r
+        return r
+    def put(self,key,r):
+        self.used[key] = r ; self.changed += 1
+    def next_version(self):
+        # forget movements the latest version doesn't have
+        self.results,self.used,self.changed = self.used,{},0
+
+class Watcher(object):
+    # Reconverts files to .ly files whenever they change,
+    # by polling their modification times
+    def __init__(self,inFiles,outDir=None,**options):
+        if outDir and not os.path.isdir(outDir): os.makedirs(outDir)
+        self.files = [(f,output_filename(f,outDir),PreviousVersion()) for f in inFiles]
+        self.options,self.stamps = options,{}
+    def check(self):
+        # Convert any changed files.  Returns a list of
+        # (inFile,outFile,error or None,movements reconverted)
+        done = []
+        for inFile,outFile,previous in self.files:
+            try: st = os.stat(inFile)
+            except OSError: continue # may be part-way through being saved
+            stamp = (st.st_mtime,st.st_size)
+            if self.stamps.get(inFile)==stamp: continue
+            self.stamps[inFile] = stamp
+            try:
+                if os.path.abspath(inFile)==os.path.abspath(outFile): errExit("Would overwrite input file")
+                out = Converter(cache=previous,**self.options).process_input(read_input_file(inFile))
+                write_output(outFile,out)
+                done.append((inFile,outFile,None,previous.changed))
+                previous.next_version()
+            except JianpuError as e:
+                # keep the last good output and movements
+                previous.used,previous.changed = {},0
+                done.append((inFile,outFile,str(e),0))
+        return done
+    def run(self,interval=1):
+        while True:
+            for inFile,outFile,err,changed in self.check():
+                if err: sys.stderr.write("Error in %s: %s\n" % (inFile,err))
+                else: sys.stderr.write("Wrote %s (%d movement%s reconverted)\n" % (outFile,changed,"s"[:changed!=1]))
+            time.sleep(interval)
+
+def error_dict(kind,message):
+    # structured error for --serve
+    r = {"error":kind,"message":message}
+    m = re.search(r"in score ([0-9]+) \(line ([0-9]+) column ([0-9]+)\)",message)
+    if m: r["score"],r["line"],r["column"] = [int(x) for x in m.groups()]
+    return r
+
+def serve_worker(conn):
+    # A WorkerPool process: converts (text,options) from conn
+    # until it gets None
+    os.environ.pop("TERM",None) # (messages are for the client, not a terminal: see unrecognised_message)
+    while True:
+        job = conn.recv()
+        if job is None: return
+        text,options = job
+        try: r = ("ok",Converter(**options).process_input(check_input(text)))
+        except JianpuError as e: r = ("error",error_dict("input",str(e)))
+        except Exception as e: r = ("error",error_dict("internal",repr(e)))
+        conn.send(r)
+
+class ServerBusy(Exception): pass # WorkerPool's queue is full
+class WorkerTimeout(Exception): pass
+
+class WorkerPool(object):
+    # Worker processes for --serve, started once and reused,
+    # so each conversion costs no interpreter startup or
+    # import.  A request waits for a free worker, unless
+    # max_queue requests are already waiting (ServerBusy).
+    # A worker that takes more than timeout seconds is
+    # replaced (WorkerTimeout).  Safe to use from the
+    # server's threads.  options are the Converter options
+    # for requests that don't give their own (a worker does
+    # not necessarily have the server's command-line settings).
+    def __init__(self,workers=None,timeout=30,max_queue=None,**options):
+        import multiprocessing,threading
+        self.workers = workers or multiprocessing.cpu_count()
+        self.options = options
+        self.timeout = timeout
+        if max_queue is None: max_queue = self.workers*4
+        self.max_queue = max_queue
+        self.lock = threading.Condition()
+        self.idle = [self.start_worker() for _ in xrange(self.workers)]
+        self.queued = 0
+        self.stats = dict((k,0) for k in ["requests","converted","errors","timeouts","rejected","crashes","max_queued"])
+    def start_worker(self):
+        import multiprocessing
+        conn,childConn = multiprocessing.Pipe()
+        p = multiprocessing.Process(target=serve_worker,args=(childConn,))
+        p.daemon = True ; p.start()
+        childConn.close()
+        return p,conn
+    def convert(self,text,options={}):
+        # returns the output, or ("error",error_dict) tuple
+        with self.lock:
+            self.stats["requests"] += 1
+            if not self.idle and self.queued >= self.max_queue:
+                self.stats["rejected"] += 1
+                raise ServerBusy()
+            self.queued += 1
+            self.stats["max_queued"] = max(self.stats["max_queued"],self.queued)
+            while not self.idle: self.lock.wait()
+            self.queued -= 1
+            worker = self.idle.pop()
+        p,conn = worker
+        options = dict(self.options,**options)
+        try:
+            try:
+                conn.send((text,options))
+                if not conn.poll(self.timeout):
+                    self.count("timeouts")
+                    p.terminate() ; p.join() ; worker = self.start_worker()
+                    raise WorkerTimeout()
+                status,r = conn.recv()
+            except (EOFError,IOError,OSError): # worker died
+                self.count("crashes")
+                p.join() ; worker = self.start_worker()
+                return "error",error_dict("internal","worker process exited")
+        finally:
+            with self.lock:
+                self.idle.append(worker) ; self.lock.notify()
+        if status=="ok": self.count("converted")
+        else: self.count("errors")
+        return status,r
+    def count(self,name):
+        with self.lock: self.stats[name] += 1
+    def metrics(self):
+        with self.lock:
+            r = dict(self.stats)
+            r.update({"workers":self.workers,"busy":self.workers-len(self.idle),
+                      "queued":self.queued,"max_queue":self.max_queue,
+                      "timeout":self.timeout})
+            return r
+    def close(self):
+        with self.lock:
+            for p,conn in self.idle:
+                conn.send(None) ; p.join()
+            self.idle = []
+
+def make_server(address,pool):
+    # An HTTP server for --serve, on 127.0.0.1 port address
+    # (0 to choose one: see server.server_address), or on the
+    # Unix socket at path address if it's a string.
+    #   POST /convert (body: the jianpu text as UTF-8,
+    #   ?use_rest_hack=0 etc for Converter options) returns
+    #   the LilyPond code, or a JSON error: see error_dict
+    #   GET /metrics returns pool.metrics() as JSON
+    # Call serve_forever() to run it, shutdown() to stop.
+    import json
+    try:
+        from http.server import HTTPServer,BaseHTTPRequestHandler
+        from socketserver import ThreadingMixIn,TCPServer
+        from urllib.parse import urlparse,parse_qsl
+    except ImportError: # Python 2
+        from BaseHTTPServer import HTTPServer,BaseHTTPRequestHandler
+        from SocketServer import ThreadingMixIn,TCPServer
+        from urlparse import urlparse,parse_qsl
+    class Handler(BaseHTTPRequestHandler):
+        def send(self,code,body,contentType="application/json"):
+            if not type(body)==type(u""): body = json.dumps(body,sort_keys=True)
+            body = body.encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type",contentType+"; charset=utf-8")
+            self.send_header("Content-Length",str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def do_GET(self):
+            if urlparse(self.path).path=="/metrics": self.send(200,pool.metrics())
+            else: self.send(404,error_dict("request","Unknown path "+self.path))
+        def do_POST(self):
+            url = urlparse(self.path)
+            if not url.path=="/convert": return self.send(404,error_dict("request","Unknown path "+self.path))
+            options = {}
+            for k,v in parse_qsl(url.query):
+                if not k in ["use_rest_hack","dashes_as_ties","stencil_noteheads"] or not v in ["0","1"]:
+                    return self.send(400,error_dict("request","Unknown option %s=%s" % (k,v)))
+                options[k] = v=="1"
+            merged = dict(pool.options,**options)
+            if merged.get("use_rest_hack",use_rest_hack) and not merged.get("dashes_as_ties",dashes_as_ties):
+                return self.send(400,error_dict("request","use_rest_hack needs dashes_as_ties"))
+            try: text = self.rfile.read(int(self.headers.get("Content-Length",0))).decode("utf-8")
+            except (ValueError,UnicodeDecodeError): return self.send(400,error_dict("request","Body should be UTF-8 text with a Content-Length"))
+            if not type("")==type(u""): text = text.encode("utf-8") # Python 2
+            try: status,r = pool.convert(text,options)
+            except ServerBusy: return self.send(503,error_dict("busy","Too many requests waiting"))
+            except WorkerTimeout: return self.send(504,error_dict("timeout","Conversion took more than %g seconds" % pool.timeout))
+            if status=="ok": self.send(200,asUnicode(r),"text/x-lilypond")
+            elif r["error"]=="input": self.send(400,r)
+            else: self.send(500,r)
+        def address_string(self): return "local"
+        def log_message(self,format,*args): pass # (see /metrics)
+    if type(address)==type(0):
+        class Server(ThreadingMixIn,HTTPServer): daemon_threads = True
+        return Server(("127.0.0.1",address),Handler)
+    import socket
+    class Server(ThreadingMixIn,HTTPServer):
+        daemon_threads = True
+        address_family = socket.AF_UNIX
+        def server_bind(self):
+            if os.path.exists(self.server_address): os.remove(self.server_address)
+            TCPServer.server_bind(self)
+            self.server_name,self.server_port = "localhost",0
+        def server_close(self):
+            HTTPServer.server_close(self)
+            if os.path.exists(self.server_address): os.remove(self.server_address)
+        def get_request(self):
+            request,_ = self.socket.accept()
+            return request,["local",0]
+    return Server(address,Handler)
+
+def get_option(name,default=None):
+    # removes --name=value from sys.argv and returns value
+    for arg in sys.argv[1:]:
+        if arg.startswith(name+"="):
+            sys.argv.remove(arg)
+            return arg[len(name)+1:]
+    return default
+
+def get_cache():
+    # --cache=DIR [--cache-size=MB]
+    cacheDir,cacheMB = get_option("--cache"),get_option("--cache-size",100)
+    if cacheDir: return MovementCache(cacheDir,int(float(cacheMB)*1024*1024))
+
+def get_targets():
+    # --targets=jianpu,western,midi (or some of them)
+    targets = get_option("--targets")
+    if not targets: return all_targets
+    targets = targets.split(",")
+    for t in targets:
+        if not t in all_targets: errExit("Unknown target %s (should be some of %s)" % (t,",".join(all_targets)))
+    return targets
+
+def get_profile():
+    # --profile[=FILE] (JSON report, default to standard error)
+    # --profile-trace=FILE (Chrome trace)
+    report,trace = get_option("--profile"),get_option("--profile-trace")
+    if "--profile" in sys.argv:
+        sys.argv.remove("--profile") ; report = "-"
+    if report or trace: return Profile(),report,trace
+    return None,None,None
+
+def write_profile(profile,report,trace):
+    import json
+    if report=="-":
+        json.dump(profile.report(),sys.stderr,indent=1,sort_keys=True)
+        sys.stderr.write("\n")
+    elif report: json.dump(profile.report(),open(report,"w"),indent=1,sort_keys=True)
+    if trace: json.dump(profile.trace(),open(trace,"w"))
+
+def batch_main():
+    # jianpu-ly --batch [--compact] [--jobs=N] [--outdir=DIR] files
+    stylesheet = None
+    for a in ["--batch","--compact"]:
+        if a in sys.argv:
+            sys.argv.remove(a)
+            if a=="--compact": stylesheet = "jianpu-ly.ily"
+    jobs,outDir = get_option("--jobs"),get_option("--outdir")
+    if jobs: jobs = int(jobs)
+    cache = get_cache()
+    failed = 0
+    targets = get_targets()
+    for inFile,outFile,err in convert_files(sys.argv[1:],outDir,jobs,use_rest_hack=use_rest_hack,stencil_noteheads=stencil_noteheads,cache=cache,stylesheet=stylesheet,targets=targets):
+        if err:
+            sys.stderr.write("Error in %s: %s\n" % (inFile,err))
+            failed += 1
+    if failed:
+        sys.stderr.write("%d of %d files failed\n" % (failed,len(sys.argv)-1))
+        sys.exit(1)
+
+def watch_main():
+    # jianpu-ly --watch [--jobs=N] [--outdir=DIR] [--interval=SECONDS] files
+    sys.argv.remove("--watch")
+    jobs,outDir = int(get_option("--jobs",1)),get_option("--outdir")
+    interval = float(get_option("--interval",1))
+    if len(sys.argv) < 2: errExit("--watch needs the files to watch")
+    try: Watcher(sys.argv[1:],outDir,jobs=jobs,use_rest_hack=use_rest_hack,stencil_noteheads=stencil_noteheads).run(interval)
+    except KeyboardInterrupt: pass
+
+def render_main():
+    # jianpu-ly --render [--jobs=N] [--outdir=DIR] [--lilypond=COMMAND] [--render-cache=DIR] files
+    sys.argv.remove("--render")
+    jobs,outDir = get_option("--jobs"),get_option("--outdir")
+    if jobs: jobs = int(jobs)
+    lilypond,cacheDir = get_option("--lilypond","lilypond"),get_option("--render-cache")
+    failed = 0
+    for inFile,outFiles,err in render_files(sys.argv[1:],outDir,jobs,lilypond,cacheDir,use_rest_hack=use_rest_hack,stencil_noteheads=stencil_noteheads):
+        if err:
+            sys.stderr.write("Error in %s: %s\n" % (inFile,err))
+            failed += 1
+    if failed:
+        sys.stderr.write("%d of %d files failed\n" % (failed,len(sys.argv)-1))
+        sys.exit(1)
+
+class MethodNotFound(Exception): pass # a request LanguageServer doesn't handle
+
+class LanguageServer(object):
+    # A Language Server Protocol server over a pair of byte
+    # streams (jianpu-ly --lsp uses stdin and stdout).  It
+    # publishes the Diagnostics of check for each open
+    # document as it is edited, using an IncrementalChecker
+    # so only the changed lines are checked again.
+    def __init__(self,inStream,outStream,**options):
+        self.inStream,self.outStream,self.options = inStream,outStream,options
+        self.documents = {} # uri -> [text,IncrementalChecker]
+    def read(self):
+        # the next message, or None at the end of the input
+        import json
+        length = None
+        while True:
+            line = self.inStream.readline()
+            if not line: return None
+            line = line.strip()
+            if not line:
+                if length is None: continue
+                return json.loads(self.inStream.read(length).decode('utf-8'))
+            name,value = line.split(b":",1)
+            if name.strip().lower()==b"content-length": length = int(value)
+    def send(self,message):
+        import json
+        data = json.dumps(message).encode('utf-8')
+        self.outStream.write(("Content-Length: %d\r\n\r\n" % len(data)).encode('ascii')+data)
+        self.outStream.flush()
+    def run(self):
+        # until exit or the end of the input
+        while True:
+            message = self.read()
+            if message is None or message.get("method")=="exit": return
+            try: result = self.handle(message.get("method"),message.get("params") or {})
+            except MethodNotFound as e:
+                if "id" in message: self.send({"jsonrpc":"2.0","id":message["id"],"error":{"code":-32601,"message":"Method not found: "+str(e)}})
+                continue
+            if "id" in message: self.send({"jsonrpc":"2.0","id":message["id"],"result":result})
+    def handle(self,method,params):
+        # returns the result (notifications' are ignored)
+        if method=="initialize":
+            return {"capabilities":{"textDocumentSync":{"openClose":True,"change":2}}, # 2 = incremental
+                    "serverInfo":{"name":"jianpu-ly"}}
+        elif method in ["initialized","shutdown"] or method.startswith("$/"): return None
+        elif method=="textDocument/didOpen":
+            doc = params["textDocument"]
+            self.documents[doc["uri"]] = [doc["text"],IncrementalChecker(**self.options)]
+            self.publish(doc["uri"])
+        elif method=="textDocument/didChange":
+            uri = params["textDocument"]["uri"]
+            document = self.documents[uri]
+            for change in params["contentChanges"]: document[0] = lsp_edit(document[0],change)
+            self.publish(uri)
+        elif method=="textDocument/didClose":
+            uri = params["textDocument"]["uri"]
+            del self.documents[uri]
+            self.send({"jsonrpc":"2.0","method":"textDocument/publishDiagnostics","params":{"uri":uri,"diagnostics":[]}})
+        else: raise MethodNotFound(method)
+    def publish(self,uri):
+        text,checker = self.documents[uri]
+        lines = text.splitlines()
+        self.send({"jsonrpc":"2.0","method":"textDocument/publishDiagnostics",
+                   "params":{"uri":uri,"diagnostics":[lsp_diagnostic(d,lines) for d in checker.update(text)]}})
+
+def lsp_edit(text,change):
+    # text with an LSP content change made to it
+    if not "range" in change: return change["text"]
+    return text[:lsp_offset(text,change["range"]["start"])]+change["text"]+text[lsp_offset(text,change["range"]["end"]):]
+def lsp_offset(text,position):
+    # index in text of an LSP position (whose character is in UTF-16 units)
+    start = 0
+    for _ in xrange(position["line"]):
+        start = text.find("\n",start)+1
+        if not start: return len(text)
+    i,units = start,position["character"]
+    while units > 0 and i < len(text) and not text[i]=="\n":
+        units -= 1+(ord(text[i])>0xffff) ; i += 1
+    return i
+def lsp_character(line,i):
+    # the UTF-16 position of line[i]
+    return len(line[:i].encode('utf-16-le'))//2
+def lsp_diagnostic(d,lines):
+    # d for LSP: the word at its column, or its whole line
+    if d.lineNo <= len(lines): line = lines[d.lineNo-1]
+    else: line = ""
+    if d.col: start = min(d.col-1,len(line)) ; end = re.compile(r"\S*").match(line,start).end()
+    else: start,end = len(line)-len(line.lstrip()),len(line.rstrip())
+    line0 = max(0,d.lineNo-1)
+    return {"range":{"start":{"line":line0,"character":lsp_character(line,start)},
+                     "end":{"line":line0,"character":lsp_character(line,end)}},
+            "severity":{"error":1,"warning":2}[d.severity],
+            "source":"jianpu-ly",
+            "message":d.message.split("\n")[0]} # (not the copy of the line with the word marked)
+
+def lsp_main():
+    # jianpu-ly --lsp
+    sys.argv.remove("--lsp")
+    inStream,outStream = getattr(sys.stdin,"buffer",sys.stdin),getattr(sys.stdout,"buffer",sys.stdout)
+    LanguageServer(inStream,outStream,use_rest_hack=use_rest_hack,stencil_noteheads=stencil_noteheads).run()
+
+def serve_main(address):
+    # jianpu-ly --serve=PORT|unix:PATH [--jobs=N] [--timeout=SECONDS] [--queue=N]
+    jobs,timeout,queue = get_option("--jobs"),float(get_option("--timeout",30)),get_option("--queue")
+    if jobs: jobs = int(jobs)
+    if queue: queue = int(queue)
+    if address.startswith("unix:"): address = address[5:]
+    else: address = int(address)
+    pool = WorkerPool(jobs,timeout,queue,use_rest_hack=use_rest_hack,stencil_noteheads=stencil_noteheads)
+    server = make_server(address,pool)
+    if type(address)==type(0): where = "http://127.0.0.1:%d/" % server.server_address[1]
+    else: where = "Unix socket "+address
+    sys.stderr.write("Serving on %s with %d workers (Control-C to stop)\n" % (where,pool.workers))
+    try: server.serve_forever()
+    except KeyboardInterrupt: pass
+    server.server_close() ; pool.close()
+
+def check_main():
+    # jianpu-ly --check [files]
+    sys.argv.remove("--check")
+    if sys.argv[1:]: inputs = [(f,read_input_lines(f)) for f in sys.argv[1:]]
+    else: inputs = [("<stdin>",get_input_lines())]
+    errors = 0
+    for name,lines in inputs:
+        for d in check(lines,use_rest_hack=use_rest_hack,stencil_noteheads=stencil_noteheads):
+            sys.stderr.write("%s:%s\n" % (name,d))
+            if d.severity=="error": errors += 1
+    if errors:
+        sys.stderr.write("%d error%s\n" % (errors,"s"[:errors>1]))
+        sys.exit(1)
 
 def main():
     if "--html" in sys.argv or "--markdown" in sys.argv:
         return write_docs()
-    inDat = get_input()
-    out = process_input(inDat) # <-- you can also call this if importing as a module
-    print (out)
+    try:
+        if "--check" in sys.argv: return check_main()
+        if "--lsp" in sys.argv: return lsp_main()
+        if "--batch" in sys.argv or "--compact" in sys.argv: return batch_main()
+        if "--watch" in sys.argv: return watch_main()
+        if "--render" in sys.argv: return render_main()
+        serve = get_option("--serve")
+        if serve: return serve_main(serve)
+        midiFile = get_option("--midi")
+        if midiFile:
+            data = midi_file(get_input(),use_rest_hack=use_rest_hack,stencil_noteheads=stencil_noteheads)
+            f = open(midiFile,"wb") ; f.write(data) ; f.close()
+            return
+        svgFile = get_option("--svg")
+        if svgFile:
+            svg = svg_preview(get_input(),use_rest_hack=use_rest_hack,stencil_noteheads=stencil_noteheads)
+            f = open(svgFile,"wb") ; f.write(svg.encode('utf-8')) ; f.close()
+            return
+        jobs = int(get_option("--jobs",1))
+        cache = get_cache()
+        profile,report,trace = get_profile()
+        targets = get_targets()
+        for scoreNo,out in enumerate(iter_process(get_input_lines(),jobs,cache,profile,targets),1): # <-- you can also call iter_process (or process_input) if importing as a module
+            if profile: t0 = clock()
+            sys.stdout.write(out) ; sys.stdout.flush()
+            if profile: profile.add("write",scoreNo,t0)
+    except JianpuError as e:
+        sys.stderr.write("Error: "+str(e)+"\n")
+        sys.exit(1)
+    print ("")
+    if profile: write_profile(profile,report,trace)
 
 if __name__=="__main__": main()
@@ -3,3 +3,290 @@ jianpuly = __import__("jianpu-ly")
 out = jianpuly.process_input("WithStaff 1 - 0 -")
 
 assert "r2" in out
+
+# independent conversions give the same output, even concurrently
+import threading
+song = "WithStaff 2/4 q1 q2 s3 s4 q0 1 - 135 1\nL: a b c d e f g\nNextScore\nangka 2/4 q0 q1 #1 1' -"
+expected = jianpuly.process_input(song)
+assert jianpuly.process_input(song) == expected
+results = [None]*8
+def convert(i): results[i] = jianpuly.Converter().process_input(song)
+threads = [threading.Thread(target=convert,args=(i,)) for i in range(len(results))]
+for t in threads: t.start()
+for t in threads: t.join()
+assert results == [expected]*len(results)
+
+# batch mode: one .ly per input file, errors don't stop the batch
+import os, tempfile
+tmpDir = tempfile.mkdtemp()
+for name,text in [("good.txt","1 2 3 4"),("bad.txt","1 2 3")]:
+    open(os.path.join(tmpDir,name),"w").write(text)
+results = list(jianpuly.convert_files([os.path.join(tmpDir,"good.txt"),os.path.join(tmpDir,"bad.txt")],os.path.join(tmpDir,"out"),jobs=2))
+assert [os.path.basename(r[1]) for r in results] == ["good.ly","bad.ly"]
+assert results[0][2] is None and "Incomplete bar" in results[1][2]
+assert open(results[0][1]).read() == jianpuly.process_input("1 2 3 4")+"\n"
+
+# movements converted in parallel are assembled as if sequential
+song2 = "2/4 q0 q1 2\nL: a b\nNextScore\n2/4 q1 q0 2 3 q0 q5\nL: c d e f\nNextScore\n" + song
+parallel = jianpuly.process_input(song2,jobs=2)
+assert parallel == jianpuly.process_input(song2)
+assert parallel.count("#(define (note-one ") == 1 and 'Voice="tmp2"' in parallel
+
+# cached movements are reused wherever they occur, giving the same output
+cache = jianpuly.MovementCache(os.path.join(tmpDir,"cache"))
+assert jianpuly.process_input(song2,cache=cache) == parallel
+assert len(os.listdir(cache.directory)) == 4
+song3 = song2.replace("q0 q5","q5 q0")+"\nNextScore\n2/4 q0 q1 2\nL: a b"
+assert jianpuly.process_input(song3,cache=cache) == jianpuly.process_input(song3)
+assert len(os.listdir(cache.directory)) == 5
+assert cache.total == sum(os.path.getsize(os.path.join(cache.directory,f)) for f in os.listdir(cache.directory))
+assert jianpuly.MovementCache(cache.directory).total == cache.total
+cache.max_bytes = 1 ; cache.evict()
+assert not os.listdir(cache.directory)
+
+# watch mode reconverts only the movements that changed
+watched = os.path.join(tmpDir,"watched.txt")
+open(watched,"w").write(song2)
+watcher = jianpuly.Watcher([watched],os.path.join(tmpDir,"out"))
+assert watcher.check() == [(watched,os.path.join(tmpDir,"out","watched.ly"),None,4)]
+assert watcher.check() == []
+open(watched,"w").write(song3)
+os.utime(watched,(0,0)) # (in case the filesystem's timestamps are coarse)
+assert [r[2:] for r in watcher.check()] == [(None,1)]
+assert open(os.path.join(tmpDir,"out","watched.ly")).read() == jianpuly.process_input(song3)+"\n"
+
+# streaming: each movement is output once its input has been read
+linesRead = []
+def lines():
+    for line in song2.splitlines(True):
+        linesRead.append(line) ; yield line
+movements = jianpuly.iter_process(lines())
+first = next(movements)
+assert len(linesRead) == 3 and first == jianpuly.process_input(song2.split("NextScore")[0])
+assert first+"".join(movements) == jianpuly.process_input(song2)
+
+# errors give the position of the word in the input
+try:
+    jianpuly.process_input("1 2 3 4\nNextScore\n1 2\n 3 xyz 4")
+    assert False
+except jianpuly.JianpuError as e:
+    assert "xyz in score 2 (line 4 column 4)" in str(e)
+
+# Scheme definitions are written once, outside the scores
+out = jianpuly.process_input("g[3] 1 2 3 4 NextScore g[3] 1 2 3 4")
+assert out.count("(jianpu-grace layout") == 1 and out.count("#(define (note-one ") == 1
+assert out.index("#(define (note-four ") < out.index("\\score {")
+
+# 5-line staff combines tied crotchets and crotchet rests
+out = jianpuly.process_input("WithStaff 1 - - 0 0 0 0 0")
+assert "c'2. r4 | %{ bar 2: %} R1 \\bar" in out
+out = jianpuly.process_input("WithStaff 6/8 1. -. 0. 0.")
+assert "c'2. | %{ bar 2: %} R2. \\bar" in out
+
+# the benchmarks' synthetic scores are valid, whatever the seed
+import bench
+for seed in range(5):
+    maker = bench.ScoreMaker(seed,bars=12,movements=3)
+    text = maker.document()
+    assert text == bench.ScoreMaker(seed,bars=12,movements=3).document()
+    assert jianpuly.process_input(text).count("\\score {") >= 3
+
+# profiling records each phase and counts, in or out of worker processes
+for jobs in [1,2]:
+    profile = jianpuly.Profile()
+    assert jianpuly.process_input(song2,jobs=jobs,profile=profile) == parallel
+    report = profile.report()
+    assert [m["score"] for m in report["movements"]] == [1,2,3,4]
+    assert report["counters"]["notes"] == 16 and report["counters"]["bars"] == 8
+    assert report["counters"]["output_bytes"] == len(parallel.encode("utf-8"))
+    assert "timing" in report["phases"] and "western" in report["movements"][2]["seconds"]
+    assert len(profile.trace()["traceEvents"]) == len(profile.events)
+
+# --serve: conversions over local HTTP by warm worker processes
+try: from urllib.request import urlopen ; from urllib.error import HTTPError
+except ImportError: from urllib2 import urlopen,HTTPError # Python 2
+import json
+pool = jianpuly.WorkerPool(1,timeout=30)
+server = jianpuly.make_server(0,pool)
+threading.Thread(target=server.serve_forever).start()
+url = "http://127.0.0.1:%d/" % server.server_address[1]
+assert urlopen(url+"convert",song.encode("utf-8")).read().decode("utf-8") == expected
+assert urlopen(url+"convert?use_rest_hack=0",b"q0 q1 2 3 4").read().decode("utf-8") == jianpuly.Converter(use_rest_hack=False).process_input("q0 q1 2 3 4")
+try:
+    urlopen(url+"convert",b"1 2 3 4\nNextScore\n1 2\n 3 xyz 4")
+    assert False
+except HTTPError as e:
+    assert e.code == 400
+    err = json.loads(e.read().decode("utf-8"))
+    assert err["error"] == "input" and (err["score"],err["line"],err["column"]) == (2,4,4)
+pool.timeout = 0.0001
+try:
+    urlopen(url+"convert",(" ".join(["1 2 3 4"]*2000)).encode("utf-8"))
+    assert False
+except HTTPError as e: assert e.code == 504
+pool.timeout = 30
+assert urlopen(url+"convert",b"1 2 3 4").read().decode("utf-8") == jianpuly.process_input("1 2 3 4") # (after replacing the worker)
+metrics = json.loads(urlopen(url+"metrics").read().decode("utf-8"))
+assert (metrics["requests"],metrics["converted"],metrics["errors"],metrics["timeouts"],metrics["queued"]) == (5,3,1,1,0)
+server.shutdown() ; server.server_close() ; pool.close()
+pool = jianpuly.WorkerPool(1,timeout=30,stencil_noteheads=True) # the server's settings, under each request's options
+assert pool.convert("1 2 3 4") == ("ok",jianpuly.Converter(stencil_noteheads=True).process_input("1 2 3 4"))
+assert pool.convert("1 2 3 4",{"stencil_noteheads":False}) == ("ok",jianpuly.process_input("1 2 3 4"))
+pool.close()
+
+# tuplets can be nested, and the bar check is exact whatever the tuplet
+out = jianpuly.process_input("3[ q1 3[ s1 s2 s3 ] q4 ] 2 3 4 7[ d1 d2 d3 d4 d5 d6 d7 ] q1 5[ s1 s2 s3 s4 s5 ] 2 3")
+assert out.count("\\times 2/3 {") == 4 and "\\times 4/7 {" in out and "\\times 4/5 {" in out
+try:
+    jianpuly.process_input("3[ q1 q1 q1 ] 2 3")
+    assert False
+except jianpuly.JianpuError as e: assert "(pos 48, should be 0)" in str(e)
+assert jianpuly.check("4/4,64. h1. 1 1 1 1 1 1 1 q1 s1 h1 h1.") == [] # an anacrusis can need a rescale
+assert "should be 62.5)" in jianpuly.check("4/4,64. h1. 1 1 1 1 1 1 1 1")[0].message
+
+# --render runs LilyPond (here a stub) once per changed movement
+import sys
+stub = os.path.join(tmpDir,"lilypond-stub.py")
+open(stub,"w").write("""import sys,os
+base,ly = sys.argv[2],sys.argv[3]
+open(os.path.join(os.path.dirname(sys.argv[0]),"stub.log"),"a").write(ly+"\\n")
+open(base+".pdf","w").write("PDF "+open(ly).read())
+open(base+".midi","w").write("MIDI")
+""")
+lilypond = '"%s" "%s"' % (sys.executable,stub)
+def render(text,lilypond=lilypond):
+    open(os.path.join(tmpDir,"render.txt"),"w").write(text)
+    r = list(jianpuly.render_files([os.path.join(tmpDir,"render.txt")],os.path.join(tmpDir,"rendered"),2,lilypond))
+    assert len(r) == 1 ; return r[0][1:]
+def stub_runs():
+    try: return len(open(os.path.join(tmpDir,"stub.log")).readlines())
+    except IOError: return 0
+outFiles,err = render(song2)
+assert err is None and [os.path.basename(f) for f in outFiles] == ["render-%d.%s" % (i,ext) for i in [1,2,3,4] for ext in ["midi","pdf"]]
+assert stub_runs() == 4
+assert open(outFiles[1]).read() == "PDF "+jianpuly.process_input("2/4 q0 q1 2\nL: a b")
+assert render(song2.replace("q0 q5","q5 q0")) == (outFiles,None) and stub_runs() == 5
+outFiles,err = render("1 2 3 4")
+assert [os.path.basename(f) for f in outFiles] == ["render.midi","render.pdf"] and stub_runs() == 6
+assert "exit status 3" in render("5 6 7 1",'"%s" -c "import sys; sys.exit(3)"' % sys.executable)[1]
+assert "Incomplete bar" in render("1 2 3")[1]
+
+# MIDI written directly: repeats unfolded, ties joined, tuplets and key applied
+def midi_notes(data):
+    # [(start,end,pitch)] of a format 0 MIDI file, and its tempos
+    assert data[:14] == b"MThd\0\0\0\6\0\0\0\1\3\xc0" and data[14:18] == b"MTrk"
+    data = bytearray(data) ; i,t,on,notes,tempos = 22,0,{},[],[]
+    while i < len(data):
+        d = 0
+        while True:
+            i += 1 ; d = (d<<7)|(data[i-1]&0x7f)
+            if data[i-1] < 0x80: break
+        t += d
+        if data[i]==0xff:
+            if data[i+1]==0x51: tempos.append((t,(data[i+3]<<16)|(data[i+4]<<8)|data[i+5]))
+            i += 3+data[i+2]
+        elif data[i]==0x90: on[data[i+1]] = t ; i += 3
+        else: notes.append((on.pop(data[i+1]),t,data[i+1])) ; i += 3
+    return sorted(notes),tempos
+notes,tempos = midi_notes(jianpuly.midi_file("1=Bb 4=120 R{ 5 - 3[ q6 q7 q1' ] 0 } A{ 1 2 3 4 | 135 - ~ 135 - }\nNextScore\n6=F# 1 ~ 1 #4 q0 q4,"))
+assert tempos == [(0,714286),(0,500000)]
+assert notes[:5] == [(0,1920,65),(1920,2240,67),(2240,2560,69),(2560,2880,70),(3840,4800,58)]
+assert notes[8:16] == [(7680,9600,65),(9600,9920,67),(9920,10240,69),(10240,10560,70),(11520,15360,58),(11520,15360,62),(11520,15360,65),(15360,17280,57)]
+assert notes[16:] == [(17280,18240,63),(18720,19200,50)]
+
+# input is normalised once: a leading byte-order mark, full-width characters; closing quotes are ' only in notes
+open(os.path.join(tmpDir,"bom.txt"),"wb").write(u"﻿title=Don’t Stop\n１ ２ ３ ４\n1’ 2 3 4\nLP:\n\\mark \\markup { It’s }\n:LP\nL: don’t a b c d e f g".encode("utf-8"))
+out = jianpuly.process_input(jianpuly.read_input_file(os.path.join(tmpDir,"bom.txt")))
+assert out == jianpuly.process_input(u"title=Don’t Stop\n1 2 3 4\n1' 2 3 4\nLP:\n\\mark \\markup { It’s }\n:LP\nL: don’t a b c d e f g")
+out = jianpuly.asUnicode(out)
+assert u"don’t" in out and u"Don’t Stop" in out and u"{ It’s }" in out and "c''4" in out
+assert u"A\ufeffB" in jianpuly.asUnicode(jianpuly.process_input(u"title=A\ufeffB\n1 2 3 4"))
+
+# --check: every error reported with its line and bar, carrying on from the next bar or movement
+diags = jianpuly.check("1 2 3 4\n1 2 3 4.\nx 1 2 3 4 5 6 7 1\n1 2 3 4 R{ 1 2 3 4\nNextScore\nWithStaff WithStaff\n1 } 2 3 4\nNextScore\n5 6 7 1")
+assert [(d.severity,d.scoreNo,d.lineNo,d.col,d.barNo) for d in diags] == [("error",1,2,None,2),("error",1,3,1,3),("error",1,4,None,7),("warning",2,6,None,1),("error",2,7,3,1)]
+assert "Unterminated repeat" in diags[2].message and "Duplicate WithStaff" in diags[3].message
+assert jianpuly.check("1 2 3 4 5 6 7 1\nL: a b c x") == [] and jianpuly.check("1 2 3 4 R{ 5 6 7 1 } A{ 1 2 3 4 | 5 6 7 1 }") == []
+try:
+    jianpuly.process_input("1 } 2 3 4") ; assert 0
+except jianpuly.JianpuError as e: assert "} without R{" in str(e)
+
+# stencil_noteheads: single notes and rests drawn by one override per staff, chords and dashes still by \applyOutput
+out = jianpuly.Converter(stencil_noteheads=True).process_input("1 q2 q#4 0 q0 q5, 135 - 0 -\nNextScore\nangka 1 #2 3 4")
+assert out.count(r"\override NoteHead #'stencil = #jianpu-note-stencil") == 1 and out.count(r"\override NoteHead #'stencil = #angka-note-stencil") == 1
+assert out.count("#(define (jianpu-note-stencil") == 1 and out.count(r"\applyOutput") == 4 and "fis'8" in out
+assert out.count("#(define (note-") == 4 # nought (rest hack), onethreefive, dashonethreefive, dash
+assert jianpuly.process_input("1 2 3 4").count(r"\applyOutput") == 4
+results = list(jianpuly.convert_files([os.path.join(tmpDir,"good.txt"),os.path.join(tmpDir,"bom.txt")],os.path.join(tmpDir,"stencil"),jobs=2,stencil_noteheads=True))
+assert [r[2] for r in results] == [None,None] and open(results[0][1]).read() == jianpuly.Converter(stencil_noteheads=True).process_input("1 2 3 4")+"\n"
+
+# compact batch output: shared stylesheet, a .ly per movement, and a file that \includes them
+open(os.path.join(tmpDir,"compact.txt"),"w").write("title=A\n1 2 3 45\nNextScore\nWithStaff angka 5 6 7 1\nL: a b c d")
+results = list(jianpuly.convert_files([os.path.join(tmpDir,"compact.txt")],os.path.join(tmpDir,"compact"),jobs=1,stylesheet="jianpu-ly.ily"))
+assert results[0][2] is None
+def compact(name): return open(os.path.join(tmpDir,"compact",name)).read()
+assert compact("compact.ly") == '\\version "2.18.0"\n\\include "compact-1.ly"\n\\include "compact-2.ly"\n\n'
+ily,m1,m2 = compact("jianpu-ly.ily"),compact("compact-1.ly"),compact("compact-2.ly")
+assert "\\paper {" in ily and "jianpuVoice = {" in ily and "notAngkaStaff = \\with {" in ily and "#(define (note-three " in ily
+assert m1.startswith('\\version "2.18.0"\n\\include "jianpu-ly.ily"\n') and "\\paper" not in m1 and "\\paper" in m2
+assert "#(define (note-fourfive " in m1 and not "#(define (note-three " in m1 and "\\override" not in m1.split("\\new Voice")[1]
+assert "\\notAngkaVoice \\override Stem #'length-fraction = #0.4" not in m2 and "\\westernVoice" in m2
+
+# targets: skipped staves aren't written, and iter_parts gives each part separately
+song = "title=T\nWithStaff 1 2 3 4\nL: a b c d\nNextScore\n5 6 7 1"
+out = jianpuly.process_input(song,targets=["jianpu"])
+assert out.count("BEGIN JIANPU STAFF") == 2 and "5-LINE" not in out and "MIDI" not in out and "\\midi" not in out
+out = jianpuly.process_input(song,targets=["midi"])
+assert out.count("BEGIN MIDI STAFF") == 2 and "JIANPU" not in out and "\\layout" not in out and "lyricsto" not in out and 'title="T"' in out
+out = jianpuly.process_input(song,targets=["western"])
+assert out.count("BEGIN 5-LINE STAFF") == 2 and "JIANPU" not in out and '\\lyricsto "5line" { a b c d }' in out and "define" not in out
+parts = list(jianpuly.iter_parts(song,targets=["jianpu","western"]))
+assert [p["western"] is None for p in parts] == [False,True] and [p["midi"] for p in parts] == [None,None]
+assert parts[0]["headers"] == {"title":"T"} and parts[0]["lyrics"] == ['\\new Lyrics = "IX" { \\lyricsto "5line" { a b c d } } ']
+assert "#(define (note-one " in parts[0]["defines"] and "note-one" not in parts[1]["defines"] and "BEGIN JIANPU STAFF" in parts[1]["jianpu"]
+
+# svg_preview: figures, beams restarting each beat, ties and slurs, and lyrics skipping rests and tied or slurred notes
+import re
+svg = jianpuly.svg_preview("title=A & B\n1=Bb 4/4 R{ 1 q2 q3 5' - } A{ 0 1 ( 2 3 ) | 3 ~ 3 s4 s5 q6, 1 }\nL: 1. a b- c d e f g h")
+assert svg.startswith('<svg xmlns="http://www.w3.org/2000/svg" width="760" ') and ">A &amp; B</text>" in svg and u">1=B\u266d 4/4</text>" in svg
+assert re.findall('class="n">([^<]*)',svg) == list(u"1235\u2013012333456"+"1")
+assert re.findall('class="l">([^<]*)',svg) == ["1. a","b","c","d","e","f","g","h","-"]
+assert len(re.findall('<line x1="([0-9.]+)" y1="([0-9.]+)" x2="[0-9.]+" y2="\\2"/>',svg)) == 3 and svg.count("<path") == 2
+assert svg.count('stroke-width="3"') == 3 and svg.count("<circle") == 6 # repeat signs and the final barline, octave dots
+
+# IncrementalChecker: after an edit, only lines up to where the parse state is as before are checked again
+checker = jianpuly.IncrementalChecker()
+song = ["1 2 3 4","5 6 7 1","1 2 3 4","5 6 7 1","NextScore","3/4 1 2 3","4 5 6"]
+assert checker.update("\n".join(song)) == [] and checker.reparsed == 6
+def incremental_matches_check():
+    text = "\n".join(song)
+    return [str(d) for d in checker.update(text)] == [str(d) for d in jianpuly.check(text)]
+for line,new,reparsed in [(1,"5 6 x 7 1",2),(2,"1 2 3 4 5",3),(2,"1 2 3 4",3),(5,"3/4 1 2",3),(5,"3/4 1 2 3",3)]:
+    song[line] = new
+    assert incremental_matches_check() and checker.reparsed == reparsed
+song.insert(0,"title=T")
+assert incremental_matches_check() and checker.reparsed == 2 and "(line 3 column 5)" in checker.update("\n".join(song))[0].message
+song = ["1 2 3 4","NextScore","5 6 7 1","1 2 3",""] # movements are split exactly as split_movements does, and end where parse_score ends them
+assert incremental_matches_check()
+song.insert(2,"NextScore")
+assert incremental_matches_check() and "Unrecognised command NextScore in score 2 (line 3 column 1)" in checker.update("\n".join(song))[0].message
+
+# --lsp: diagnostics are published on opening and on each edit
+import io
+def lsp_message(m):
+    data = json.dumps(m).encode("utf-8")
+    return ("Content-Length: %d\r\n\r\n" % len(data)).encode("ascii")+data
+inStream,outStream = io.BytesIO(), io.BytesIO()
+inStream.write(lsp_message({"jsonrpc":"2.0","id":1,"method":"initialize","params":{}})+lsp_message({"jsonrpc":"2.0","method":"textDocument/didOpen","params":{"textDocument":{"uri":"file:///a","text":u"1 2 3 4\n5 6 x 7 1 2"}}})+lsp_message({"jsonrpc":"2.0","method":"textDocument/didChange","params":{"textDocument":{"uri":"file:///a"},"contentChanges":[{"range":{"start":{"line":1,"character":4},"end":{"line":1,"character":6}},"text":""},{"range":{"start":{"line":1,"character":7},"end":{"line":1,"character":9}},"text":""}]}})+lsp_message({"jsonrpc":"2.0","id":2,"method":"shutdown"})+lsp_message({"jsonrpc":"2.0","method":"exit"}))
+inStream.seek(0) ; jianpuly.LanguageServer(inStream,outStream).run()
+outStream.seek(0) ; server = jianpuly.LanguageServer(outStream,None)
+replies = [server.read() for _ in range(4)]
+assert replies[0]["result"]["capabilities"]["textDocumentSync"]["change"] == 2 and replies[3] == {"jsonrpc":"2.0","id":2,"result":None}
+assert [(d["range"]["start"]["character"],d["range"]["end"]["character"],d["message"][:24]) for d in replies[1]["params"]["diagnostics"]] == [(4,5,"Unrecognised command x i"),(0,11,"Incomplete bar at end of")]
+assert replies[2]["params"]["diagnostics"] == []
+
+# note templates: kept per mode, so the same notes in angka and with stencil_noteheads are written differently
+jianpuly.note_templates.clear()
+out = jianpuly.Converter(stencil_noteheads=True).process_input("1' q2 q0 3 -\nNextScore\nangka 1' q2 q0 3 -")
+assert sorted(jianpuly.note_templates) == [(True,True,False),(True,True,True)] and len(jianpuly.note_templates[(True,True,False)]) == 5
+assert out.count("  c''4^.") == 1 and out.count("c''4-\\tweak #'extra-offset #'(0.4 . 2.7)") == 1 and re.findall("applyOutput #'Voice #(\\S+)",out) == ["note-nought","note-dashthree"]*2